@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Peak/retained memory benchmark for ResultStore.
+
+    Resolves every name in $PATH (or the first --limit names) once, then
+    keeps the results either as full ResolvedPath objects, or as compact
+    StoredPath records in a ResultStore. Memory is measured with
+    tracemalloc, so libmagic's own (C) allocations are not counted.
+
+    Usage:
+        python3 benchmarks/store_memory.py [--limit N] [--copies N]
+
+    --copies keeps N copies of every result, each under a different fake
+    directory prefix, to show how both layouts grow with large batches.
+    Copies are made one at a time, so the store's peak includes the one
+    full ResolvedPath that is being added.
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__
+))))
+sys.argv, argv = sys.argv[:1], sys.argv[1:]
+
+from whichfile.__main__ import (  # noqa
+    PathIndex,
+    ResolvedPath,
+    ResultStore,
+    StatCache,
+)
+
+
+def copy_result(resolved, prefix):
+    """ Return a copy of a ResolvedPath with every path moved under
+        `prefix`, like results from another directory tree.
+    """
+    copy = ResolvedPath.__new__(ResolvedPath)
+    for attr in ResolvedPath.__slots__:
+        setattr(copy, attr, getattr(resolved, attr, None))
+    move = lambda p: None if p is None else prefix + p  # noqa
+    copy.path = move(resolved.path)
+    copy.target = move(resolved.target)
+    copy.circular = move(resolved.circular)
+    copy.symlink_to = [move(p) for p in resolved.symlink_to]
+    # Each copy has it's own type string, like separately read files.
+    copy.filetype = None if resolved.filetype is None else (
+        ''.join(list(resolved.filetype))
+    )
+    return copy
+
+
+def measure(label, results, keep):
+    """ Keep every result from the `results` iterable with `keep()`, and
+        print the memory that is retained afterwards, and the peak while
+        keeping them.
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    kept = keep(results)
+    duration = time.perf_counter() - start
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:<12} {:>9} results {:>10.1f} KiB retained {:>10.1f} KiB peak'
+          ' {:>6.0f} B/result {:>7.3f}s'.format(
+              label,
+              len(kept),
+              current / 1024,
+              peak / 1024,
+              current / max(len(kept), 1),
+              duration,
+          ))
+    return kept
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--limit', type=int, default=0)
+    parser.add_argument('--copies', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    stats = StatCache()
+    names = sorted(PathIndex().names)
+    if args.limit > 0:
+        names = names[:args.limit]
+    print('Resolving {} names, keeping {} copies of each...'.format(
+        len(names),
+        args.copies,
+    ))
+    resolved = [
+        ResolvedPath(name, ignore_cwd=True, stats=stats) for name in names
+    ]
+
+    def iter_results():
+        """ Yield fresh copies of every result, so each layout starts from
+            the same objects a real batch would make.
+        """
+        for i in range(args.copies):
+            prefix = '/copy{}'.format(i)
+            for r in resolved:
+                yield copy_result(r, prefix)
+
+    def store_all(results):
+        store = ResultStore(stats=stats)
+        for r in results:
+            store.add(r)
+        return store
+
+    measure('ResolvedPath', iter_results(), list)
+    measure('ResultStore', iter_results(), store_all)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Tests for DpkgIndex, with a fake dpkg admin directory. """
+
+import os
+import tempfile
+import unittest
+
+from whichfile.__main__ import DpkgIndex, RootFS
+
+
+class DpkgIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        # Canonical, so paths match what DpkgIndex._canonical() returns.
+        self.root = os.path.realpath(self.tmpdir.name)
+        self.admindir = os.path.join(self.root, 'dpkg')
+        self.infodir = os.path.join(self.admindir, 'info')
+        self.cachedir = os.path.join(self.root, 'cache')
+        os.makedirs(self.infodir)
+        os.makedirs(os.path.join(self.admindir, 'alternatives'))
+        self.bindir = os.path.join(self.root, 'bin')
+        os.mkdir(self.bindir)
+        self.write_list('tool', [
+            self.root,
+            self.bindir,
+            self.path('tool'),
+            self.path('shared'),
+            self.path('sh'),
+        ])
+        self.write_list('other', [self.bindir, self.path('shared')])
+        self.write_list('shell', [self.bindir, self.path('sh')])
+        self.write_admin('diversions', [
+            self.path('sh'),
+            self.path('sh.distrib'),
+            'shell',
+        ])
+        self.write_admin(os.path.join('alternatives', 'editor'), [
+            'auto',
+            self.path('editor'),
+            'editor.1.gz',
+            '/usr/share/man/man1/editor.1.gz',
+            '',
+            self.path('tool'),
+            '10',
+        ])
+
+    def path(self, name):
+        return os.path.join(self.bindir, name)
+
+    def write_admin(self, name, lines):
+        with open(os.path.join(self.admindir, name), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def write_list(self, pkg, paths):
+        filepath = os.path.join(self.infodir, '{}.list'.format(pkg))
+        with open(filepath, 'w') as f:
+            f.write('\n'.join(paths) + '\n')
+
+    def index(self, **kwargs):
+        kwargs.setdefault('use_cache', False)
+        return DpkgIndex(
+            infodir=self.infodir,
+            cachedir=self.cachedir,
+            **kwargs
+        )
+
+    def test_owner(self):
+        index = self.index()
+        self.assertEqual(index.owner(self.path('tool')), 'tool')
+        self.assertEqual(index.owner(self.path('shared')), 'tool, other')
+        # Directories are shared between packages, and skipped.
+        self.assertIsNone(index.owner(self.bindir))
+        self.assertIsNone(index.owner(self.path('missing')))
+
+    def test_diverted(self):
+        index = self.index()
+        self.assertEqual(index.owner(self.path('sh')), 'shell')
+        self.assertEqual(
+            index.owner(self.path('sh.distrib')),
+            'tool (diverted by shell)',
+        )
+
+    def test_alternatives(self):
+        index = self.index()
+        self.assertEqual(
+            index.owner(self.path('editor')),
+            'alternatives: editor',
+        )
+        self.assertEqual(
+            index.owner('/etc/alternatives/editor.1.gz'),
+            'alternatives: editor',
+        )
+        # Packaged files are not replaced by alternatives.
+        self.assertEqual(index.owner(self.path('tool')), 'tool')
+
+    def test_invalidation(self):
+        self.assertEqual(len(self.index(use_cache=True)), 8)
+        self.assertTrue(os.path.exists(self.index().cache_file))
+        st = os.stat(self.infodir)
+        self.write_list('newpkg', [self.path('new')])
+        # Unchanged mtime, the cached index is used.
+        os.utime(self.infodir, ns=(st.st_atime_ns, st.st_mtime_ns))
+        index = self.index(use_cache=True)
+        self.assertIsNone(index.owner(self.path('new')))
+        # The info dir changed, the index is rebuilt.
+        os.utime(
+            self.infodir,
+            ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000),
+        )
+        index = self.index(use_cache=True)
+        self.assertEqual(index.owner(self.path('new')), 'newpkg')
+
+
+class DpkgIndexRootTests(unittest.TestCase):
+    """ DpkgIndex for packages installed in a RootFS, where the root's
+        symlinks are used instead of the host's.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.root = os.path.realpath(self.tmpdir.name)
+        infodir = os.path.join(self.root, 'var', 'lib', 'dpkg', 'info')
+        os.makedirs(infodir)
+        # Not merged-/usr, even when the host is.
+        os.makedirs(os.path.join(self.root, 'bin'))
+        os.makedirs(os.path.join(self.root, 'usr', 'bin'))
+        # A link that only exists in the root.
+        os.makedirs(os.path.join(self.root, 'opt', 'tool', 'bin'))
+        os.symlink('opt/tool/bin', os.path.join(self.root, 'toolbin'))
+        lists = {
+            'base': ['/bin', '/bin/x'],
+            'usr': ['/usr', '/usr/bin', '/usr/bin/x'],
+            'tool': ['/toolbin', '/toolbin/y'],
+        }
+        for pkg, paths in lists.items():
+            filepath = os.path.join(infodir, '{}.list'.format(pkg))
+            with open(filepath, 'w') as f:
+                f.write('\n'.join(paths) + '\n')
+        self.index = DpkgIndex(
+            cachedir=os.path.join(self.root, 'cache'),
+            use_cache=False,
+            root=RootFS(self.root),
+        )
+
+    def test_owner(self):
+        self.assertEqual(self.index.infodir, os.path.join(
+            self.root,
+            'var',
+            'lib',
+            'dpkg',
+            'info',
+        ))
+        self.assertEqual(self.index.owner('/bin/x'), 'base')
+        self.assertEqual(self.index.owner('/usr/bin/x'), 'usr')
+
+    def test_root_links(self):
+        self.assertEqual(self.index.owner('/opt/tool/bin/y'), 'tool')
+        self.assertEqual(self.index.owner('/toolbin/y'), 'tool')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Tests for #! interpreter following, see: ResolvedPath.interpreter """
+
+import os
+import tempfile
+import unittest
+
+from whichfile.__main__ import ResolvedNames, parse_shebang
+
+
+class InterpreterTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def script(self, name, shebang):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'w') as f:
+            f.write('{}\nexit 0\n'.format(shebang))
+        os.chmod(path, 0o755)
+        return path
+
+    def test_concurrent_scripts(self):
+        """ Scripts that share an interpreter never see it half-resolved.
+        """
+        scripts = [
+            self.script('env{}'.format(i), '#!/usr/bin/env sh')
+            for i in range(40)
+        ] + [
+            self.script('sh{}'.format(i), '#!/bin/sh')
+            for i in range(40)
+        ]
+        resolved = ResolvedNames(
+            scripts,
+            lazy=True,
+            jobs=16,
+            interpreter=True,
+        )
+        results = [
+            selected[0] for _, selected in resolved.iter_selected()
+        ]
+        self.assertEqual(len(results), len(scripts))
+        missing = [r.path for r in results if r.interpreter is None]
+        self.assertEqual(missing, [])
+
+    def test_circular(self):
+        """ Scripts that name each other as interpreters don't loop. """
+        first = os.path.join(self.tmpdir.name, 'first')
+        second = self.script('second', '#!{}'.format(first))
+        self.script('first', '#!{}'.format(second))
+        resolved = ResolvedNames([first], interpreter=True)
+        r = resolved.targets[first]['file']
+        self.assertEqual(r.interpreter.path, second)
+        # The cycle stops where `second` is needed again.
+        self.assertEqual(r.interpreter.interpreter.path, first)
+        self.assertIsNone(r.interpreter.interpreter.interpreter)
+
+    def test_tab_separator(self):
+        """ Tabs separate the interpreter from it's argument, like spaces.
+        """
+        self.assertEqual(parse_shebang('#!/bin/sh\t-e'), ('/bin/sh', None))
+        self.assertEqual(
+            parse_shebang('#!/usr/bin/env\tpython3'),
+            ('/usr/bin/env', 'python3'),
+        )
+        script = self.script('tabbed', '#!/bin/sh\t-e')
+        resolved = ResolvedNames([script], interpreter=True)
+        r = resolved.targets[script]['file']
+        self.assertIsNotNone(r.interpreter)
+        self.assertTrue(r.interpreter.exists)
+
+
+if __name__ == '__main__':
+    unittest.main()
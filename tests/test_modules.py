@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Tests for ModuleFinder. """
+
+import os
+import unittest
+
+from whichfile.__main__ import ModuleFinder
+
+
+class ModuleFinderTests(unittest.TestCase):
+    def test_submodule(self):
+        module = ModuleFinder().resolve('json.decoder')
+        self.assertEqual(
+            os.path.basename(module.resolved.path),
+            'decoder.py',
+        )
+
+    def test_os_path(self):
+        """ os.path is found through the module that `os` uses for it. """
+        module = ModuleFinder().resolve('os.path')
+        self.assertIsNotNone(module)
+        self.assertEqual(
+            os.path.basename(module.resolved.path),
+            '{}.py'.format(os.path.__name__),
+        )
+        self.assertIn(os.path.__name__, module.kind)
+
+    def test_missing(self):
+        self.assertIsNone(ModuleFinder().resolve('os.nope'))
+
+
+if __name__ == '__main__':
+    unittest.main()
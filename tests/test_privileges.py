@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Tests for PrivilegeAudit.sweep(), with file capabilities. """
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from whichfile.__main__ import PathIndex, PrivilegeAudit
+
+# cap_net_raw=ep, as a revision 2 security.capability xattr.
+CAP_NET_RAW = 1 << 13
+CAP_DATA = struct.pack('<5I', 0x02000001, CAP_NET_RAW, 0, 0, 0)
+
+
+class SweepTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.bindir = os.path.realpath(self.tmpdir.name)
+        self.target = os.path.join(self.bindir, 'zzz')
+        shutil.copy('/bin/true', self.target)
+        try:
+            os.setxattr(self.target, PrivilegeAudit.xattr, CAP_DATA)
+        except OSError as ex:
+            self.skipTest('Cannot set capabilities: {}'.format(ex))
+        # The link sorts first, so it is checked before it's target.
+        self.link = os.path.join(self.bindir, 'aaa')
+        os.symlink('zzz', self.link)
+
+    def test_symlink_first(self):
+        audit = PrivilegeAudit()
+        found = dict(audit.sweep(PathIndex(dirs=[self.bindir])))
+        self.assertEqual(sorted(found), [self.link, self.target])
+        for path, privileges in found.items():
+            self.assertEqual(
+                privileges.capabilities.permitted,
+                CAP_NET_RAW,
+                msg=path,
+            )
+        self.assertEqual(audit.swept_paths, 2)
+        self.assertEqual(audit.swept_dirs, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Tests for ResolveCache, through ResolvedNames(cache=...). """
+
+import os
+import tempfile
+import time
+import unittest
+
+from whichfile.__main__ import Environment, ResolveCache, ResolvedNames
+
+
+class ResolveCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.bindir = os.path.join(self.tmpdir.name, 'bin')
+        os.mkdir(self.bindir)
+        self.exe = os.path.join(self.bindir, 'wf-test-cmd')
+        with open(self.exe, 'w') as f:
+            f.write('#!/bin/sh\nexit 0\n')
+        os.chmod(self.exe, 0o755)
+        # An existing alias file is part of the fingerprint.
+        self.aliasfile = os.path.join(self.tmpdir.name, 'aliases')
+        with open(self.aliasfile, 'w') as f:
+            f.write("alias wf-test-alias='wf-test-cmd'\n")
+        self.env = Environment(
+            'test',
+            path=self.bindir,
+            shell='/bin/bash',
+            alias_files=self.aliasfile,
+        )
+
+    def resolve(self, cache, names=('wf-test-cmd',)):
+        return ResolvedNames(list(names), cache=cache, env=self.env)
+
+    def test_alias_file_fingerprint(self):
+        """ A cached ResolvedNames can be built with an alias file. """
+        resolved = self.resolve(ResolveCache())
+        self.assertIn('wf-test-cmd', resolved.targets)
+        self.assertEqual(resolved.targets['wf-test-cmd']['file'].path,
+                         self.exe)
+
+    def test_hits_and_misses(self):
+        cache = ResolveCache()
+        first = self.resolve(cache)
+        self.assertEqual(cache.stats()['misses'], 1)
+        second = self.resolve(cache)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertIs(
+            first.targets['wf-test-cmd']['file'],
+            second.targets['wf-test-cmd']['file'],
+        )
+
+    def test_alias_file_change(self):
+        """ Changing an alias file changes the fingerprint. """
+        cache = ResolveCache()
+        self.resolve(cache)
+        st = os.stat(self.aliasfile)
+        os.utime(
+            self.aliasfile,
+            ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000),
+        )
+        self.resolve(cache)
+        self.assertEqual(cache.stats()['misses'], 2)
+        self.assertEqual(len(cache), 2)
+
+    def test_invalidate(self):
+        cache = ResolveCache()
+        self.resolve(cache, names=('wf-test-cmd', 'wf-test-missing'))
+        self.assertEqual(cache.invalidate('wf-test-cmd'), 1)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.invalidate(), 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_eviction(self):
+        cache = ResolveCache(maxsize=1)
+        self.resolve(cache, names=('wf-test-cmd', 'wf-test-missing'))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_ttl(self):
+        cache = ResolveCache(ttl=0.01)
+        self.resolve(cache)
+        time.sleep(0.02)
+        self.resolve(cache)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 0)
+        self.assertEqual(stats['expired'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
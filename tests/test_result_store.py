@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Tests for ResultStore and StoredPath. """
+
+import os
+import tempfile
+import threading
+import unittest
+from concurrent.futures import Future
+
+from whichfile.__main__ import ResolvedPath, ResultStore
+
+
+class ResultStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.paths = []
+        for i in range(20):
+            path = os.path.join(self.tmpdir.name, 'cmd{}'.format(i))
+            with open(path, 'w') as f:
+                f.write('#!/bin/sh\nexit 0\n')
+            os.chmod(path, 0o755)
+            self.paths.append(path)
+
+    def test_concurrent_add(self):
+        """ Paths are interned once when results are added from threads.
+        """
+        resolved = [ResolvedPath(path) for path in self.paths]
+        store = ResultStore()
+        threads = [
+            threading.Thread(
+                target=lambda: [store.add(r) for r in resolved],
+            )
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(store), len(resolved) * len(threads))
+        self.assertEqual(len(store.dirs), 1)
+        self.assertEqual(len(store.paths), len(self.paths))
+        self.assertEqual(
+            sorted(set(record.path for record in store)),
+            sorted(self.paths),
+        )
+
+    def test_pending_digest(self):
+        """ Adding a result doesn't wait for it's hash to finish. """
+        resolved = ResolvedPath(self.paths[0])
+        resolved._digest = future = Future()
+        resolved.hash_algorithm = 'sha256'
+        record = ResultStore().add(resolved)
+        self.assertFalse(future.done())
+        future.set_result('abc')
+        self.assertEqual(record.digest, 'abc')
+        self.assertEqual(record.to_resolved().digest, 'abc')
+
+
+if __name__ == '__main__':
+    unittest.main()
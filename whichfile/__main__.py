@@ -10,10 +10,32 @@
     -Christopher Welborn 08-09-2014
 """
 
+import base64
+import bisect
+import errno
+import fnmatch
+import grp
+import hashlib
+import importlib.machinery
+import json
+import math
+import mmap
 import os
+import posixpath
+import pwd
 import re
+import shlex
+import sqlite3
+import stat
+import struct
 import subprocess
 import sys
+import tarfile
+import threading
+import time
+import zipimport
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import suppress
 from functools import cmp_to_key
 
@@ -35,34 +57,140 @@ USAGESTR = """{versionstr}
 
     Usage:
         {script} -h | -p | -v
-        {script} PATH... [-a | -B] [-c] [-C] [-D] [-N] [-s] [-w width]
-        {script} PATH... [-d | -m] [-c] [-C] [-D] [-N] [-s] [-w width]
+        {script} PATH... [-a | -B] [-c] [-C] [-D] [-e] [-E] [-f] [-i] [-l]
+                         [-L] [-n] [-N] [-o] [-s | -J] [-u] [-b num]
+                         [-H algo] [-j num] [-r dir] [-T secs] [-w width]
+        {script} PATH... [-d | -m] [-c] [-C] [-D] [-e] [-E] [-f] [-i] [-l]
+                         [-L] [-n] [-N] [-o] [-s | -J] [-u] [-b num]
+                         [-H algo] [-j num] [-r dir] [-T secs] [-w width]
+        {script} -u [-m] [-C] [-D] [-E] [-o] [-s | -J] [-H algo] [-j num]
+                    [-r dir] [-T secs] [-w width]
+        {script} -S [-m] [-C] [-D] [-E] [-i] [-o] [-s | -J] [-H algo]
+                    [-j num] [-r dir] [-T secs] [-w width]
+        {script} PATH... (-x spec)... [-B] [-c] [-C] [-D] [-E] [-i] [-J] [-l]
+                         [-m] [-j num]
+        {script} -t file [PATH...] [-d | -m] [-C] [-D] [-e] [-i] [-s | -J]
+                         [-j num] [-w width]
+        {script} --snapshot file [PATH...] [-m] [-D] [-j num] [-r dir]
+        {script} --diff OLD NEW [-C] [-D] [-J]
+        {script} (--pids pids | --all-procs) [-m] [-C] [-D] [-E] [-L]
+                            [-s | -J] [-H algo] [-j num] [-w width]
+        {script} -M PATH... [-d | -m] [-C] [-D] [-E] [-s | -J] [-H algo]
+                            [-j num] [-w width] [--python exe]
 
     Options:
         PATH                : Directory path or paths to resolve.
+                              Glob patterns, like 'python3*' or '*-config',
+                              are matched against every name in $PATH.
         -a,--all            : Show all aliases, functions, builtins, and
                               file paths that were found.
+        -b num,--bytes num  : Read at most this many bytes of each file to
+                              determine its type, for slow or network file
+                              systems. Files are opened without updating
+                              their access time, readahead is turned off,
+                              and the number of bytes read is shown.
+        --all-procs         : Resolve the executables of every running
+                              process, grouped by executable. Deleted or
+                              replaced executables are flagged.
         -B,--nobuiltins     : Don't check BASH builtins.
         -c,--ignorecwd      : Ignore files in the CWD, and try $PATH instead.
         -C,--color          : Use color, even when piping output.
         -d,--dir            : Print the parent directory of the final target.
                               This enables --nobuiltins.
         -D,--debug          : Print some debugging info.
+        --diff              : Compare two snapshots, and list names with
+                              changed targets, new names, and names that
+                              are gone.
+        -E,--elf            : Read ELF headers directly, instead of using
+                              libmagic for ELF files. Adds structured ELF
+                              info to JSON output.
+        -e,--every          : Show every match in $PATH, not just the first.
+                              Matches after the first one are shadowed.
+        -f,--follow         : Follow aliases and simple functions to the
+                              command that they run, through other
+                              aliases, functions, builtins, and files.
+        -H algo,--hash algo : Hash the final target of each file path with
+                              this hashlib algorithm, like: sha256
+                              Each distinct file is only hashed once.
         -h,--help           : Show this help message.
+        -i,--interpreter    : Follow the #! line of scripts, and resolve
+                              the interpreter that will run them.
+        -J,--json           : Print each result as a JSON object, one per
+                              line.
+        -j num,--jobs num   : Number of names to resolve concurrently.
+                              Results are still printed in order.
+                              Default: 1
+        -l,--live           : Get aliases, functions, and builtins from an
+                              interactive BASH shell, so everything from
+                              .bashrc, /etc/profile.d, and sourced files is
+                              seen. The shell runs once, and the results are
+                              cached until the startup files change.
+        -L,--libs           : Find the shared libraries that ELF files need,
+                              and the libraries they need, like the dynamic
+                              loader would (through /etc/ld.so.cache),
+                              without running anything. Names like
+                              libc.so.6 are looked up in the cache.
         -m,--mime           : Show mime type instead of human readable form.
                               This enables --nobuiltins.
+        -M,--module         : Resolve each PATH as a dotted Python module
+                              name, to the file that would be imported.
+                              Nothing is imported.
+        -n,--negative       : Remember names that can't be resolved, and
+                              skip every lookup for them next time. This
+                              is forgotten when a $PATH dir or alias file
+                              changes. Not used with --live or --root.
         -N,--debugname      : Shows bash alias/function lines that don't match
                               a function/alias pattern, but were found in the
                               line. This is for debugging `{script}` itself.
+        -o,--owner          : Show the dpkg package that owns each link and
+                              target.
         -p,--path           : List directories in $PATH, like:
                               echo "$PATH" | tr ':' '\\n'
+        --pids pids         : Like --all-procs, for a comma-separated list
+                              of process ids.
+        --python exe        : Find modules for -M with this Python
+                              interpreter's sys.path, instead of the
+                              current one.
+        -r dir,--root dir   : Resolve everything inside this root directory,
+                              like a container image or chroot, without
+                              chrooting. Absolute links and $PATH are
+                              anchored in the root. BASH aliases, functions,
+                              and builtins are not checked.
+        -S,--shadowed       : Show every name in $PATH that shadows another
+                              file with the same name.
+        --snapshot file     : Save what each name resolves to in an SQLite
+                              file. Existing names are only resolved again
+                              if their path, links, target, or $PATH dirs
+                              have changed. Without PATH, every name in
+                              $PATH is saved, and names that are gone are
+                              removed. The CWD is always ignored.
         -s,--short          : Short output, print only the target.
                               On error nothing is printed and non-zero is
                               returned.
                               Broken symlinks will be prepended with 'dead:'.
+        -T secs,--timeout secs
+                            : Give each $PATH dir this many seconds to
+                              respond, and skip the ones that don't, like
+                              a hung network mount. Skipped dirs are
+                              remembered for 5 minutes.
+        -t file,--tar file  : Resolve paths inside a tar archive (or image
+                              layer), without extracting it. Compressed
+                              archives are supported, and '-' reads from
+                              stdin. Without PATH, every file in the
+                              archive is resolved.
+        -u,--privileged     : Show setuid/setgid bits and file capabilities
+                              (security.capability) for the final target.
+                              Without PATH, every file in $PATH is audited,
+                              and only privileged ones are shown.
         -v,--version        : Show version.
         -w num,--width num  : Maximum width for type information.
                               Default: <terminal_width>
+        -x spec,--env spec  : Resolve names in a named environment, and
+                              compare the results side by side. Can be
+                              used more than once. The spec is NAME=DIRS,
+                              or NAME=PATH=DIRS;SHELL=shell;ALIASES=files
+                              Anything left out comes from the current
+                              environment.
 """.format(script=SCRIPT, versionstr=VERSIONSTR)
 
 # debug is used before arg-parsing.
@@ -85,6 +213,13 @@ COLOR_ARGS = {
     'type': {'fore': 'lightgreen'}
 }
 
+# BASH keywords that don't make a simple command, see: parse_command_word()
+SHELL_KEYWORDS = (
+    '!', '[[', ']]', '{', '}', 'case', 'coproc', 'do', 'done', 'elif',
+    'else', 'esac', 'fi', 'for', 'function', 'if', 'in', 'select', 'then',
+    'time', 'until', 'while',
+)
+
 # User's PATH as a list.
 PATH = [
     s.strip() for s in
@@ -175,28 +310,278 @@ def main(argd):
         print('\n'.join(paths))
         return 0 if paths else 1
 
+    max_width = parse_int(argd['--width'], default=get_terminal_size()[0])
+    jobs = parse_int(argd['--jobs'], default=1)
+    hasher = FileHasher(argd['--hash']) if argd['--hash'] else None
+    root = RootFS(argd['--root']) if argd['--root'] else None
+    if argd['--tar']:
+        root = TarIndex(argd['--tar'])
+    watchdog = None
+    if argd['--timeout']:
+        try:
+            timeout = float(argd['--timeout'])
+        except ValueError:
+            raise InvalidArg('invalid number: {}'.format(argd['--timeout']))
+        if timeout <= 0:
+            raise InvalidArg('expecting a positive number for --timeout.')
+        if not argd['--tar']:
+            watchdog = DirWatchdog(timeout=timeout)
+    audit = None
+    if argd['--privileged'] and not argd['--tar']:
+        audit = PrivilegeAudit(root=root)
+    read_size = parse_int(argd['--bytes'], default=None)
+    if (read_size is not None) and (read_size < 1):
+        raise InvalidArg('expecting a positive number for --bytes.')
+    owners = None
+    if argd['--owner']:
+        owners = DpkgIndex(root=root)
+    # JSON lines are not separated by blank lines.
+    sep = '' if argd['--json'] else '\n'
+    if argd['--diff']:
+        changes = 0
+        for change in Snapshot.diff(argd['OLD'], argd['NEW']):
+            changes += 1
+            print(format_diff(change, json_mode=argd['--json']))
+        return 1 if changes else 0
+    if argd['--pids'] or argd['--all-procs']:
+        pids = None
+        if argd['--pids']:
+            pids = [
+                parse_int(s.strip(), default=None)
+                for s in argd['--pids'].split(',') if s.strip()
+            ]
+            if (not pids) or any((pid is None) or (pid < 1) for pid in pids):
+                raise InvalidArg('expecting process ids for --pids.')
+        procs = ProcessIndex(pids=pids)
+        print_formatted(
+            procs.iter_formatted(
+                jobs=jobs,
+                short_mode=argd['--short'],
+                json_mode=argd['--json'],
+                use_mime=argd['--mime'],
+                max_width=max_width,
+                hasher=hasher,
+                elf=argd['--elf'],
+                libraries=LibraryResolver() if argd['--libs'] else None,
+            ),
+            sep=sep,
+        )
+        if procs.unreadable:
+            print_err('\nCannot read the executable for {} {}: {}'.format(
+                len(procs.unreadable),
+                'process' if len(procs.unreadable) == 1 else 'processes',
+                ', '.join(str(pid) for pid in procs.unreadable),
+            ))
+        if procs.missing:
+            print_err('\nNo executable for: {}'.format(
+                ', '.join(str(pid) for pid in procs.missing),
+            ))
+        return len(procs.missing)
+    if argd['--module']:
+        modules = ModuleFinder(python=argd['--python'])
+        print_formatted(
+            modules.iter_formatted(
+                argd['PATH'],
+                jobs=jobs,
+                dir_only=argd['--dir'],
+                short_mode=argd['--short'],
+                json_mode=argd['--json'],
+                use_mime=argd['--mime'],
+                max_width=max_width,
+                hasher=hasher,
+                elf=argd['--elf'],
+            ),
+            sep=sep,
+        )
+        if not argd['--short']:
+            for name in modules.unresolved:
+                print_err('\'{}\' is not a known module.'.format(name))
+        return len(modules.unresolved)
+    if argd['--snapshot']:
+        snapshot = Snapshot(argd['--snapshot'], root=root)
+        names = argd['PATH']
+        if not names:
+            index = PathIndex() if root is None else root.path_index
+            names = sorted(index.names)
+        counts = snapshot.refresh(
+            names,
+            lambda name: ResolvedPath(
+                name,
+                use_mime=argd['--mime'],
+                ignore_cwd=os.path.sep not in name,
+                stats=snapshot.stats,
+                root=root,
+            ),
+            jobs=jobs,
+            prune=not argd['PATH'],
+        )
+        snapshot.close()
+        print('{}: {} names, {} resolved, {} removed, {} missing'.format(
+            colr_str(snapshot.filename, **COLOR_ARGS['cmd']),
+            len(names),
+            counts['updated'],
+            counts['removed'],
+            counts['missing'],
+        ))
+        return 0
+    if (audit is not None) and not argd['PATH']:
+        index = PathIndex(watchdog=watchdog) if root is None else (
+            root.path_index
+        )
+        stats = StatCache() if root is None else root.stats
+        found = list(audit.sweep(index, stats=stats))
+        print_formatted(
+            iter_ordered(
+                lambda item: format_result(
+                    ResolvedPath(
+                        item[0],
+                        use_mime=argd['--mime'],
+                        max_width=max_width,
+                        stats=stats,
+                        hasher=hasher,
+                        elf=argd['--elf'],
+                        owners=owners,
+                        root=root,
+                        audit=audit,
+                    ),
+                    name=os.path.basename(item[0]),
+                    short_mode=argd['--short'],
+                    json_mode=argd['--json'],
+                ),
+                found,
+                jobs,
+            ),
+            sep=sep,
+        )
+        if not (argd['--short'] or argd['--json']):
+            print_err('\nAudited {} {} in {} {}, {} {} privileged.'.format(
+                audit.swept_paths,
+                'path' if audit.swept_paths == 1 else 'paths',
+                audit.swept_dirs,
+                'dir' if audit.swept_dirs == 1 else 'dirs',
+                C(str(len(found)), fore='red', style='bright'),
+                'is' if len(found) == 1 else 'are',
+            ))
+        return 0
+    if argd['--shadowed']:
+        index = PathIndex(watchdog=watchdog) if root is None else (
+            root.path_index
+        )
+        stats = StatCache() if root is None else root.stats
+        print_formatted(
+            iter_ordered(
+                lambda name: format_result(
+                    index.matches(
+                        name,
+                        use_mime=argd['--mime'],
+                        max_width=max_width,
+                        stats=stats,
+                        hasher=hasher,
+                        elf=argd['--elf'],
+                        interpreters={} if argd['--interpreter'] else None,
+                        owners=owners,
+                        root=root,
+                        watchdog=watchdog,
+                    ),
+                    name=name,
+                    short_mode=argd['--short'],
+                    json_mode=argd['--json'],
+                ),
+                (name for name, _ in index.shadowed()),
+                jobs,
+            ),
+            sep=sep,
+        )
+        return 0
+
+    if argd['--env']:
+        envs = ResolvedEnvs(
+            argd['PATH'],
+            [Environment.from_spec(spec) for spec in argd['--env']],
+            ignore_cwd=argd['--ignorecwd'],
+            use_mime=argd['--mime'],
+            jobs=jobs,
+            elf=argd['--elf'],
+            interpreter=argd['--interpreter'],
+            live=argd['--live'],
+        )
+        print_formatted(
+            envs.iter_formatted(
+                no_builtins=argd['--nobuiltins'] or argd['--mime'],
+                json_mode=argd['--json'],
+            ),
+            sep='',
+        )
+        return envs.differences
+
+    names = argd['PATH']
+    if argd['--tar'] and not names:
+        names = list(root.names())
+    negative = None
+    if argd['--negative'] and (root is None) and (not argd['--live']):
+        negative = NegativeCache(
+            dirs=None if watchdog is None else watchdog.healthy_dirs(
+                ResolvedPath.get_env_path()
+            ),
+        )
     resolved = ResolvedNames(
-        argd['PATH'],
+        names,
         ignore_cwd=argd['--ignorecwd'],
         use_mime=argd['--mime'],
-        max_width=parse_int(argd['--width'], default=get_terminal_size()[0]),
+        max_width=max_width,
+        lazy=True,
+        jobs=jobs,
+        every=argd['--every'],
+        hasher=hasher,
+        elf=argd['--elf'],
+        interpreter=argd['--interpreter'],
+        owners=owners,
+        root=root,
+        live=argd['--live'],
+        follow=argd['--follow'],
+        negative=negative,
+        read_size=read_size,
+        watchdog=watchdog,
+        libraries=argd['--libs'],
+        audit=audit,
     )
-    print(resolved.formatted(
-        all_types=argd['--all'],
-        dir_only=argd['--dir'],
-        no_builtins=argd['--nobuiltins'] or argd['--dir'] or argd['--mime'],
-        short_mode=argd['--short'],
-    ))
-    errs = len(resolved.unresolved)
+    print_formatted(
+        resolved.iter_formatted(
+            all_types=argd['--all'],
+            dir_only=argd['--dir'],
+            no_builtins=argd['--nobuiltins'] or argd['--dir'] or argd['--mime'],
+            short_mode=argd['--short'],
+            json_mode=argd['--json'],
+        ),
+        sep=sep,
+    )
+    errs = resolved.unresolved_count
     if errs and (not argd['--short']):
         errs = print_err_cmds(
             resolved.unresolved,
             ignore_cwd=argd['--ignorecwd'],
+            total=errs,
+            stats=resolved.stats,
+            root=root,
+            negative=negative,
+            suggest=resolved.suggest,
         )
+    if negative is not None:
+        negative.save()
     debug('Errors ({}): {!r}'.format(errs, resolved.unresolved))
     return errs
 
 
+def colr_str(text, **colrargs):
+    """ Colorize `text` with Colr, and return a str.
+        When colors are disabled the text is returned as-is, without
+        building a Colr object at all.
+    """
+    if colr_disabled():
+        return text if isinstance(text, str) else str(text)
+    return str(C(text, **colrargs))
+
+
 def entry_point():
     """ Entry point for setuptools, or script execution. """
     try:
@@ -219,33 +604,123 @@ def entry_point():
     sys.exit(mainret)
 
 
+def format_diff(change, json_mode=False):
+    """ Format a single change from Snapshot.diff() for printing.
+        In `json_mode` it is a single line of JSON.
+    """
+    if json_mode:
+        return json.dumps(change, sort_keys=False)
+    kind = change['change']
+    if kind == 'new':
+        return '{} {}: {}'.format(
+            colr_str('+', fore='green', style='bright'),
+            colr_str(change['name'], **COLOR_ARGS['cmd']),
+            colr_str(change['new_target'], **COLOR_ARGS['target']),
+        )
+    if kind == 'gone':
+        return '{} {}: {}'.format(
+            colr_str('-', fore='red', style='bright'),
+            colr_str(change['name'], **COLOR_ARGS['cmd']),
+            colr_str(change['old_target'], fore='red'),
+        )
+    lines = ['{} {}:'.format(
+        colr_str('~', fore='yellow', style='bright'),
+        colr_str(change['name'], **COLOR_ARGS['cmd']),
+    )]
+    labels = {
+        'path': 'Path:',
+        'chain': 'Links:',
+        'target': 'Target:',
+        'filetype': 'Type:',
+    }
+    for col in Snapshot.diff_columns:
+        old, new = change['old_{}'.format(col)], change['new_{}'.format(col)]
+        if old == new:
+            continue
+        if col == 'chain':
+            old, new = (
+                ' → '.join(chain) or '<none>' for chain in (old, new)
+            )
+        lines.append('{} {} ⯈ {}'.format(
+            labels[col].rjust(11),
+            old,
+            colr_str(new, **COLOR_ARGS['target']),
+        ))
+    return '\n'.join(lines)
+
+
+def format_result(
+        resolved, name=None, dir_only=False, short_mode=False,
+        json_mode=False):
+    """ Format a resolved object (Alias, Builtin, PathMatches, ResolvedPath)
+        for printing. In `json_mode` it is a single line of JSON, including
+        the `name` that was looked up.
+    """
+    if json_mode:
+        info = {'name': name} if name is not None else {}
+        info.update(resolved.as_dict())
+        return json.dumps(info, sort_keys=False)
+    return resolved.formatted(dir_only=dir_only, short_mode=short_mode)
+
+
+def format_type_block(text, width=0, prepend=''):
+    """ Wrap a type string to `width` with FormatBlock, prepending `prepend`
+        to every line but the first.
+        FormatBlock is only used when the text needs wrapping (or whitespace
+        normalization), otherwise the text is returned untouched.
+    """
+    if width < 1:
+        return text
+    if (len(text) <= width) and (' '.join(text.split()) == text):
+        # FormatBlock would return this exact string.
+        return text
+    return FormatBlock(text).format(
+        width=width,
+        prepend=prepend,
+        strip_first=True,
+    )
+
+
 def get_bash_builtin_help(name):
     """ Retrieve the first line of help for a bash builtin, using
         help `name`.
         Returns '' on error.
     """
+    helpmsg = get_bash_builtin_help.results.get(name, None)
+    if helpmsg is not None:
+        return helpmsg
     helpcmd = ['bash', '-c', 'help {}'.format(name)]
     try:
         rawoutput = subprocess.check_output(helpcmd, stderr=subprocess.PIPE)
     except subprocess.CalledProcessError:
-        return ''
-    lines = rawoutput.decode().split('\n')
-    return lines[1].strip()
+        helpmsg = ''
+    else:
+        helpmsg = rawoutput.decode().split('\n')[1].strip()
+    get_bash_builtin_help.results[name] = helpmsg
+    return helpmsg
+
+
+# This function remembers it's results from previous calls.
+get_bash_builtin_help.results = {}
 
 
-def get_bash_msgs(cmdnames, debug_name=False):
+def get_bash_msgs(
+        cmdnames, debug_name=False, alias_file=ALIAS_FILE, shell=None):
     """ Look for bash aliases/functions/builtins with this name, but only if
-        the user's shell is set to bash.
+        the user's shell (or `shell`) is set to bash.
+        Aliases are searched for in `alias_file`.
         Returns a dict of cmdnames and messages about the aliases possible
         location on success,
         Returns {} if the user's shell is not set to bash, or no bash alias
         file can be found.
         All values will be None if no commands were found in the file.
     """
-    if not ALIAS_FILE:
+    if shell is None:
+        shell = os.environ.get('SHELL', '')
+    if not alias_file:
         debug('No alias file to work with, cancelling.')
         return {}
-    elif 'bash' not in os.environ.get('SHELL', ''):
+    elif 'bash' not in shell:
         debug('Not a BASH environment, cancelling.')
         return {}
     bashfuncfmt = r'(^function {cmd}\(?\)? ?{{?$)'
@@ -274,7 +749,7 @@ def get_bash_msgs(cmdnames, debug_name=False):
         return {}
     # Set all messages to None, until proven othewise.
     cmdmsgs = {cmd: None for cmd in cmdnames}
-    with open(ALIAS_FILE, 'r') as f:
+    with open(alias_file, 'r') as f:
         for i, line in enumerate(f):
             lineno = i + 1
             stripped = line.strip()
@@ -306,7 +781,7 @@ def get_bash_msgs(cmdnames, debug_name=False):
                 elif cmdfuncpat.search(stripped):
                     # The message for this function is the output of
                     # findfunc if available.
-                    funcdefstr = run_find_func(cmdname, ALIAS_FILE)
+                    funcdefstr = run_find_func(cmdname, alias_file)
                     if funcdefstr is None:
                         # No findfunc available.
                         cmdmsgs[cmdname] = 'line {}: {}'.format(
@@ -327,29 +802,88 @@ def get_bash_msgs(cmdnames, debug_name=False):
     return cmdmsgs
 
 
-def get_bash_type(name, short=True):
+def get_bash_names(alias_files=ALIAS_FILES, shell=None, path=None):
+    """ Return a set of every alias/function name in `alias_files`, plus
+        BASH builtins and keywords, but only if the user's shell (or
+        `shell`) is set to bash.
+        If `path` is set, it is used as $PATH for the shell.
+    """
+    if shell is None:
+        shell = os.environ.get('SHELL', '')
+    if 'bash' not in shell:
+        debug('Not a BASH environment, no BASH names.')
+        return set()
+    names = set()
+    namepat = re.compile(
+        r'^(?:alias ([^=\s]+)=|function ([^\s(]+)|([^\s(]+)\(\))'
+    )
+    for alias_file in alias_files:
+        try:
+            with open(alias_file, 'r') as f:
+                for line in f:
+                    match = namepat.search(line.strip())
+                    if match is not None:
+                        names.update(n for n in match.groups() if n)
+        except OSError as ex:
+            debug('Cannot read alias file: {}\n{}'.format(alias_file, ex))
+    shellenv = None
+    if path is not None:
+        shellenv = dict(os.environ)
+        shellenv['PATH'] = ':'.join(path)
+    try:
+        output = subprocess.check_output(
+            ['bash', '-c', 'compgen -b; compgen -k'],
+            stderr=subprocess.DEVNULL,
+            env=shellenv,
+        )
+    except (OSError, subprocess.CalledProcessError) as ex:
+        debug('Cannot list BASH builtins: {}'.format(ex))
+    else:
+        names.update(output.decode(errors='replace').split())
+    return names
+
+
+def get_bash_type(name, short=True, path=None):
     """ Run `type name` in a BASH shell. Returns the decoded output.
         if `short` is truthy it returns one of:
             'alias', 'keyword', 'function', 'builtin', 'file'.
+        If `path` is set, it is used as $PATH for the shell.
         Always returns '' on error.
     """
+    key = (name, bool(short), path)
+    output = get_bash_type.results.get(key, None)
+    if output is not None:
+        return output
     typeargs = 'type -t' if short else 'type'
     typecmd = [
         'bash',
         '-c',
         '{} {}'.format(typeargs, name)
     ]
+    env = None
+    if path is not None:
+        env = dict(os.environ, PATH=path)
     try:
-        rawoutput = subprocess.check_output(typecmd, stderr=subprocess.PIPE)
+        rawoutput = subprocess.check_output(
+            typecmd,
+            stderr=subprocess.PIPE,
+            env=env,
+        )
     except subprocess.CalledProcessError as ex:
         debug('Failed to get bash type for: {}\n{}'.format(name, ex))
-        return ''
-    output = rawoutput.decode().strip()
+        output = ''
+    else:
+        output = rawoutput.decode().strip()
     if output:
         debug('{}: {}'.format(' '.join(typecmd), output))
+    get_bash_type.results[key] = output
     return output
 
 
+# This function remembers it's results from previous calls.
+get_bash_type.results = {}
+
+
 def get_cmd_location(cmdname):
     """ Find the actual path to an executable using `which` or `command -v`.
         Returns None if it cannot be found.
@@ -485,6 +1019,135 @@ def get_install_msg(cmdname, ignore_installed=True):
         return '\n'.join(msg).format(cmd=C(cmdname, **colr_args['cmd']))
 
 
+def iter_ordered(func, items, jobs=1):
+    """ Yield `func(item)` for each item, in the same order as `items`.
+        When `jobs` is more than 1, items are handled by a thread pool.
+        Pending results are held in a small reorder buffer, so each result
+        is yielded as soon as it and every result before it are done.
+    """
+    if jobs < 2:
+        for item in items:
+            yield func(item)
+        return
+    # Number of items that can be in flight (or finished, but waiting on
+    # an earlier item) at once.
+    window = jobs * 2
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def parse_shebang(line):
+    """ Parse a #! line, and return (interpreter, command).
+        `command` is the name that `env` will look up in $PATH,
+        for lines like `#!/usr/bin/env python3` or `#!/usr/bin/env -S cmd`,
+        otherwise it is None.
+        Returns (None, None) if this is not a #! line.
+    """
+    if not line.startswith('#!'):
+        return None, None
+    # Like the kernel, everything after the interpreter is a single arg,
+    # separated by spaces or tabs.
+    words = re.split(r'[ \t]', line[2:].strip(), maxsplit=1)
+    interp, arg = words[0], words[1] if len(words) > 1 else ''
+    if not interp:
+        return None, None
+    arg = arg.strip()
+    if (os.path.basename(interp) != 'env') or (not arg):
+        return interp, None
+    words = arg.split()
+    if words[0].startswith('-S') or (words[0] == '--split-string'):
+        # env -S splits the argument itself.
+        if len(words[0]) > 2 and (not words[0].startswith('--')):
+            # -Scmd
+            words[0] = words[0][2:]
+        else:
+            words = words[1:]
+    elif arg.startswith('-'):
+        # Options without -S, env would not find a command here.
+        return interp, None
+    else:
+        # Without -S, env receives (and looks up) the whole argument.
+        return interp, arg
+    # Options for env that take a value.
+    valueopts = ('-u', '--unset', '-C', '--chdir')
+    skip = False
+    for word in words:
+        if skip:
+            skip = False
+        elif word in valueopts:
+            skip = True
+        elif word.startswith('-') or ('=' in word):
+            # Other options, and VAR=value assignments.
+            continue
+        else:
+            return interp, word
+    return interp, None
+
+
+def parse_command_word(text, typename='alias'):
+    """ Parse the first command word from an alias line, or a function
+        definition (for simple functions only), as printed by BASH.
+        Returns (word, bypass), where `bypass` is None, or the kind of
+        lookup that BASH skips for the word:
+            'alias'   : The word is quoted/escaped, like: \\ls
+            'command' : The word follows `command`, no aliases/functions.
+            'builtin' : The word follows `builtin`, only builtins.
+        Returns (None, None) if there is no simple command word.
+    """
+    if typename == 'alias':
+        # Like: line 3: alias ll='ls -l'
+        _, _, definition = text.partition('alias ')
+        try:
+            words = shlex.split(definition.partition('=')[2])
+        except ValueError:
+            return None, None
+        command = ' '.join(words)
+    else:
+        # Like: line 5:\nfoo ()\n{\n    ls -l "$@"\n}
+        _, brace, body = text.partition('{')
+        if not brace:
+            return None, None
+        lines = [
+            s.strip().rstrip(';') for s in body.splitlines() if s.strip()
+        ]
+        if (not lines) or (lines[0] == '}'):
+            return None, None
+        command = lines[0]
+    command = command.strip()
+    bypass = None
+    if command[:1] in ('\\', '\'', '"'):
+        bypass = 'alias'
+    lexer = shlex.shlex(command, posix=True, punctuation_chars=True)
+    lexer.whitespace_split = True
+    try:
+        words = list(lexer)
+    except ValueError:
+        return None, None
+    prefixes = {'command': 'command', 'builtin': 'builtin', 'exec': None}
+    for word in words:
+        if re.match(r'^[A-Za-z_][A-Za-z0-9_]*=', word):
+            # Variable assignments.
+            continue
+        if word in prefixes:
+            bypass = prefixes[word] or bypass
+            continue
+        if (bypass in ('command', 'builtin')) and word.startswith('-'):
+            # Options for `command`, like: command -p ls
+            continue
+        if ('$' in word) or ('`' in word) or (word in SHELL_KEYWORDS) or (
+                word[0] in '&|;<>()'):
+            # Not a simple command.
+            return None, None
+        return word, bypass
+    return None, None
+
+
 def parse_int(s, default=None):
     """ Parse a string as an integer, returns `default` for falsey value.
         Raises InvalidArg with a message on invalid numbers.
@@ -510,18 +1173,54 @@ def print_err(*args, **kwargs):
     if nocolor:
         print(*args, **kwargs)
     else:
-        print(C(kwargs.get('sep', ' ').join(args), fore='red'), **kwargs)
+        print(
+            C(kwargs.get('sep', ' ').join(str(a) for a in args), fore='red'),
+            **kwargs
+        )
+
+
+def print_formatted(infos, sep='\n'):
+    """ Print formatted results as they arrive, separated by blank lines
+        (or `sep`).
+        Returns the number of results printed.
+    """
+    printed = 0
+    for info in infos:
+        print(info if not printed else '{}{}'.format(sep, info), flush=True)
+        printed += 1
+    if not printed:
+        print()
+    return printed
 
 
-def print_err_cmds(errcmds, ignore_cwd=False):
+def print_err_cmds(
+        errcmds, ignore_cwd=False, total=None, stats=None, root=None,
+        negative=None, suggest=None):
     """ Print all files that errored, with possible install suggestions.
+        If `total` is given, it is used as the number of errors instead
+        of len(errcmds), for when not all of the names were kept.
+        `stats` is the StatCache used to resolve the names, if any.
+        When a RootFS is given as `root`, there are no install suggestions
+        for the host.
+        Install suggestions are remembered in the NegativeCache
+        `negative`, if given.
+        When `suggest` is given, it is called with each name that has no
+        install suggestions, and should return a list of similar names
+        (see: Suggestions).
         Returns the number of errored files.
     """
-    errs = len(errcmds)
+    stats = StatCache() if stats is None else stats
+    errs = len(errcmds) if total is None else total
     if not errs:
         return 0
     # Get a list of (cmd, install_instructions) where available.
-    installable = ((cmd, get_install_msg(cmd)) for cmd in errcmds)
+    if root is not None:
+        getmsg = lambda cmd: None  # noqa
+    elif negative is not None:
+        getmsg = negative.install_msg
+    else:
+        getmsg = get_install_msg
+    installable = ((cmd, getmsg(cmd)) for cmd in errcmds)
     installable = {cmd: instr for cmd, instr in installable if instr}
     installlen = len(installable)
     print_err(
@@ -542,25 +1241,89 @@ def print_err_cmds(errcmds, ignore_cwd=False):
                 C(cmd, fore='red')
             )
             if ignore_cwd:
-                if os.path.exists(cmd):
+                if stats.exists(cmd):
                     instr = '\n'.join((
                         instr,
                         'It is an existing file, but was ignored.',
                     ))
-                elif os.path.islink(cmd):
+                elif stats.islink(cmd):
                     instr = '\n'.join((
                         instr,
                         'It is an existing symlink, but was ignored.',
                     ))
+            close = None
+            if (suggest is not None) and (os.path.sep not in cmd):
+                close = suggest(cmd)
+            if close:
+                instr = '\n'.join((
+                    instr,
+                    'Did you mean: {}?'.format(
+                        ', '.join(colr_str(s, fore='cyan') for s in close)
+                    ),
+                ))
 
         print_err(
             '\n    {}'.format(instr.replace('\n', '\n    ')),
             nocolor=True
         )
+    if errs > len(errcmds):
+        print_err(
+            '\n    ...and {} more.'.format(errs - len(errcmds)),
+            nocolor=True
+        )
 
     return errs
 
 
+def read_prefix(path, size):
+    """ Read up to `size` bytes from the start of a file, touching as
+        little as possible. The file is opened with O_NOATIME when it is
+        allowed (only the owner or root may use it), readahead is turned
+        off with posix_fadvise(), and everything is read into one buffer.
+        Returns the bytes that were read, which may be less than `size`.
+        Raises OSError if the file can't be opened or read.
+    """
+    flags = os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0)
+    noatime = getattr(os, 'O_NOATIME', 0)
+    try:
+        fd = os.open(path, flags | noatime)
+    except PermissionError:
+        if not noatime:
+            raise
+        # Not the owner, EPERM for O_NOATIME.
+        fd = os.open(path, flags)
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            with suppress(OSError):
+                os.posix_fadvise(fd, 0, size, os.POSIX_FADV_RANDOM)
+        buf = bytearray(size)
+        total = 0
+        with memoryview(buf) as view:
+            while total < size:
+                count = os.readv(fd, [view[total:]])
+                if not count:
+                    break
+                total += count
+    finally:
+        os.close(fd)
+    del buf[total:]
+    return bytes(buf)
+
+
+def read_shebang(path, maxsize=256):
+    """ Read the first line of a file, if it is a #! line.
+        At most `maxsize` bytes are read (the kernel only reads 256).
+        Returns None for anything else, or on errors.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read(maxsize)
+    except OSError as ex:
+        debug('Cannot read #! line from: {}\n{}'.format(path, ex))
+        return None
+    return shebang_line(data[:maxsize])
+
+
 def run_find_func(cmdname, filename):
     """ Run the external `findfunc` command, if available.
         Returns the output of findfunc on success, None on error.
@@ -599,6 +1362,15 @@ run_find_func.exepath = None
 run_find_func.disabled = False
 
 
+def shebang_line(data):
+    """ Return the first line of `data` (bytes) as a str, if it is a #!
+        line. Returns None for anything else.
+    """
+    if not data.startswith(b'#!'):
+        return None
+    return data.split(b'\n', 1)[0].decode(errors='replace').rstrip('\r')
+
+
 def str_contains(s, needles):
     """ Run `in` test for several strings.
         Returns True of s contains any of the strings in `needles`.
@@ -613,11 +1385,18 @@ def str_contains(s, needles):
 
 class CircularLink(EnvironmentError):
     """ Raised when ResolvedPath finds a circular symlink. """
-    def __init__(self, startpath, errorpath):
+    def __init__(self, startpath, errorpath, chain=None):
+        """ If the link `chain` is already known, it is used as-is, and
+            the `errorpath` is where the circle starts.
+        """
         self.path = startpath
         self.errorpath = errorpath
-        self.start = None
-        self.chain = self._find_link_chain()
+        if chain is None:
+            self.start = None
+            self.chain = self._find_link_chain()
+        else:
+            self.start = errorpath
+            self.chain = chain
 
     def __str__(self):
         if self.chain:
@@ -663,10 +1442,16 @@ class CircularLink(EnvironmentError):
 
 class Alias(object):
     """ Holds info about a resolved alias. """
+    typename = 'alias'
+
     def __init__(self, filepath, name, typeinfo):
         self.filepath = filepath
         self.name = name
         self.info = typeinfo
+        # Set when followed, see: ResolvedNames._follow()
+        self.command = None
+        self.expansion = None
+        self.cycle = None
 
     def __repr__(self):
         return '{}(filepath={!r}, name={!r}, info={!r})'.format(
@@ -676,29 +1461,67 @@ class Alias(object):
             self.info,
         )
 
+    def as_dict(self):
+        """ A JSON-friendly dict for this Alias. """
+        info = {
+            'type': self.typename,
+            'filepath': self.filepath,
+            'name': self.name,
+            'info': self.info,
+        }
+        if self.command is not None:
+            info['command'] = self.command
+            info['cycle'] = self.cycle
+            info['expansion'] = None if self.expansion is None else (
+                self.expansion.as_dict()
+            )
+        return info
+
     def formatted(self, dir_only=False, short_mode=False):
         """ Printable/colorized representation of this Alias. """
         if dir_only:
-            return str(C(
+            return colr_str(
                 os.path.split(self.filepath)[0],
                 **COLOR_ARGS['target']
-            ))
+            )
         if short_mode:
-            return str(C(self.filepath, **COLOR_ARGS['target']))
+            return colr_str(self.filepath, **COLOR_ARGS['target'])
 
-        return '{fname}:\n    ⯈ {cmd}\n        ⯈ {line}'.format(
-            fname=C(self.filepath, **COLOR_ARGS['cmd']),
-            cmd=C(self.name, **COLOR_ARGS['target']),
-            line=C(self.info, **COLOR_ARGS['type'])
-        )
+        lines = ['{fname}:\n    ⯈ {cmd}\n        ⯈ {line}'.format(
+            fname=colr_str(self.filepath, **COLOR_ARGS['cmd']),
+            cmd=colr_str(self.name, **COLOR_ARGS['target']),
+            line=colr_str(self.info, **COLOR_ARGS['type'])
+        )]
+        if self.command is not None:
+            status = ''
+            if self.cycle:
+                status = colr_str('⭠', fore='red', style='bright')
+            elif self.expansion is None:
+                status = colr_str('(missing)', fore='red')
+            lines.append('            ⯈ {} {}'.format(
+                colr_str(self.command, **COLOR_ARGS['link']),
+                status,
+            ))
+            if self.expansion is not None:
+                lines.extend(
+                    '                {}'.format(line)
+                    for line in self.expansion.formatted().split('\n')
+                )
+        return '\n'.join(lines)
 
 
 class Builtin(Alias):
     """ Holds info about a resolved bash builtin. """
-    def __init__(self, name, typestr):
+    typename = 'builtin'
+
+    def __init__(self, name, typestr, helpmsg=None):
         self.filepath = None
         self.name = name
         self.info = typestr
+        # Builtins are never followed.
+        self.command = None
+        self.expansion = None
+        self.cycle = None
         # It's possible for builtin_type to stay None, if the name isn't found.
         self.builtin_type = None
         for s in ('builtin', 'keyword', 'alias', 'function'):
@@ -709,7 +1532,9 @@ class Builtin(Alias):
             if ' is ' in typestr:
                 self.builtin_type = 'file'
                 self.filepath = '{}'.format(typestr.rpartition('is ')[-1])
-        self.builtin_help = get_bash_builtin_help(name)
+        if helpmsg is None:
+            helpmsg = get_bash_builtin_help(name)
+        self.builtin_help = helpmsg
 
     def __repr__(self):
         return '\n'.join((
@@ -725,6 +1550,15 @@ class Builtin(Alias):
             s=self,
         )
 
+    def as_dict(self):
+        """ A JSON-friendly dict for this Builtin. """
+        info = super().as_dict()
+        info.update({
+            'builtin_type': self.builtin_type,
+            'builtin_help': self.builtin_help,
+        })
+        return info
+
     def formatted(self, dir_only=False, short_mode=False):
         """ Printable/colorized representation of this Builtin.
             Arguments:
@@ -733,21 +1567,21 @@ class Builtin(Alias):
                 short_mode  : Return only the info string.
         """
         if short_mode:
-            return str(C(self.info, **COLOR_ARGS['target']))
+            return colr_str(self.info, **COLOR_ARGS['target'])
 
         if self.builtin_help:
             return '{name}:\n    ⯈ {msg}\n        Desc.: {helpmsg}'.format(
-                name=C(self.name, **COLOR_ARGS['cmd']),
-                msg=C(
+                name=colr_str(self.name, **COLOR_ARGS['cmd']),
+                msg=colr_str(
                     self.info.replace('shell', 'BASH'),
                     **COLOR_ARGS['target']
                 ),
-                helpmsg=C(self.builtin_help, **COLOR_ARGS['type'])
+                helpmsg=colr_str(self.builtin_help, **COLOR_ARGS['type'])
             )
 
         return '{name}:\n    ⯈ {msg}'.format(
-            name=C(self.name, **COLOR_ARGS['cmd']),
-            msg=C(
+            name=colr_str(self.name, **COLOR_ARGS['cmd']),
+            msg=colr_str(
                 self.info.replace('shell', 'BASH'),
                 **COLOR_ARGS['type']
             ),
@@ -756,28 +1590,347 @@ class Builtin(Alias):
 
 class Function(Alias):
     """ Holds info about a resolved function. """
-    pass
+    typename = 'function'
+
+
+class Environment(object):
+    """ A named environment to resolve names in, with its own $PATH,
+        $SHELL, and BASH alias files. Anything that isn't given comes from
+        the current process.
+    """
+    # Settings that can be used in a spec, see: from_spec()
+    keys = ('PATH', 'SHELL', 'ALIASES')
+
+    def __init__(self, name, path=None, shell=None, alias_files=None):
+        """
+            Arguments:
+                name (str)        : Name for this environment.
+                path (str)        : $PATH, like: /usr/bin:/bin
+                shell (str)       : $SHELL, like: /bin/bash
+                alias_files (str) : BASH alias files, separated by ':'.
+                                    The first existing file is used.
+        """
+        self.name = name
+        if path is None:
+            self.path = ResolvedPath.get_env_path()
+        else:
+            self.path = tuple(s.strip() for s in path.split(':') if s.strip())
+        self.shell = os.environ.get('SHELL', '') if shell is None else shell
+        if alias_files is None:
+            self.alias_files = ALIAS_FILES
+        else:
+            self.alias_files = tuple(
+                s for s in (
+                    os.path.expanduser(s) for s in alias_files.split(':') if s
+                ) if os.path.exists(s)
+            )
+        self.alias_file = self.alias_files[0] if self.alias_files else None
+
+    def __repr__(self):
+        return '{}({!r}, path={!r}, shell={!r}, alias_files={!r})'.format(
+            type(self).__name__,
+            self.name,
+            ':'.join(self.path),
+            self.shell,
+            self.alias_files,
+        )
+
+    @classmethod
+    def from_spec(cls, spec):
+        """ Parse an environment from the command line, like:
+                NAME=/usr/bin:/bin
+                NAME=PATH=/usr/bin:/bin;SHELL=/bin/sh;ALIASES=~/.aliases
+            `NAME=` alone is the current environment.
+            Raises InvalidArg for bad specs.
+        """
+        name, eq, rest = spec.partition('=')
+        name = name.strip()
+        if not (name and eq):
+            raise InvalidArg(
+                'expecting NAME=PATH for environment, got: {}'.format(spec)
+            )
+        settings = {}
+        parts = [s for s in rest.split(';') if s]
+        if parts and (parts[0].partition('=')[0] not in cls.keys):
+            # Just the $PATH.
+            settings['PATH'] = rest
+        else:
+            for part in parts:
+                key, eq, value = part.partition('=')
+                if (key not in cls.keys) or (not eq):
+                    raise InvalidArg(
+                        'unknown setting for environment {!r}: {}'.format(
+                            name,
+                            part,
+                        )
+                    )
+                settings[key] = value
+        return cls(
+            name,
+            path=settings.get('PATH', None),
+            shell=settings.get('SHELL', None),
+            alias_files=settings.get('ALIASES', None),
+        )
+
+
+class ResolveCache(object):
+    """ A bounded LRU cache of ResolvedNames results, for when the same
+        names are resolved over and over.
+        Keys are (name, fingerprint), see: ResolvedNames.env_fingerprint()
+        Values are {typename: resolved_object} dicts.
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        """
+            Arguments:
+                maxsize (int)  : Maximum number of entries to keep.
+                ttl (float)    : Seconds before an entry expires, or None
+                                 to keep entries until they are evicted.
+        """
+        self.maxsize = max(maxsize or 0, 1)
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return self.peek(key)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return '{}(maxsize={}, ttl={!r}, size={}, stats={!r})'.format(
+            type(self).__name__,
+            self.maxsize,
+            self.ttl,
+            len(self._items),
+            self.stats(),
+        )
+
+    def _is_expired(self, created):
+        return (self.ttl is not None) and (
+            (time.monotonic() - created) > self.ttl
+        )
+
+    def get(self, key):
+        """ Return a cached value, or None if it is missing or expired. """
+        with self._lock:
+            item = self._items.get(key, None)
+            if item is None:
+                self.misses += 1
+                return None
+            created, value = item
+            if self._is_expired(created):
+                del self._items[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def invalidate(self, name=None):
+        """ Remove all entries for `name`, or every entry if `name` is None.
+            Returns the number of entries removed.
+        """
+        with self._lock:
+            if name is None:
+                count = len(self._items)
+                self._items.clear()
+                return count
+            keys = [key for key in self._items if key[0] == name]
+            for key in keys:
+                del self._items[key]
+            return len(keys)
+
+    def peek(self, key):
+        """ Return True if a live entry exists for `key`, without touching
+            the statistics or the LRU order.
+        """
+        with self._lock:
+            item = self._items.get(key, None)
+            return (item is not None) and (not self._is_expired(item[0]))
+
+    def put(self, key, value):
+        """ Add or replace an entry, evicting the least recently used
+            entries when the cache is full.
+        """
+        with self._lock:
+            self._items[key] = (time.monotonic(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """ Return a dict of cache statistics. """
+        return {
+            'size': len(self._items),
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evictions': self.evictions,
+        }
 
 
 class ResolvedNames(object):
     """ Resolve a command/function/alias name as it would be interpreted
         in the console.
     """
-    def __init__(self, names, use_mime=False, ignore_cwd=False, max_width=0):
+    # Maximum number of unresolved names to remember in lazy mode.
+    # `unresolved_count` always has the real count.
+    max_unresolved = 1000
+    # Number of recent unique names remembered to skip duplicates in lazy
+    # mode, see: _iter_unique()
+    max_seen = 100000
+    # Non-lazy batches with at least this many names keep file results in
+    # a ResultStore, unless one is given.
+    store_min = 1000
+    # Maximum number of aliases/functions to follow for one name.
+    max_follow = 16
+
+    def __init__(
+            self, names, use_mime=False, ignore_cwd=False, max_width=0,
+            lazy=False, jobs=1, store=None, every=False, cache=None,
+            hasher=None, elf=False, interpreter=False, owners=None,
+            root=None, env=None, stats=None, listings=None, types=None,
+            live=False, follow=False, negative=None, read_size=None,
+            watchdog=None, libraries=False, audit=None):
         """
             Arguments:
                 names (list(str)) : A list of str names to resolve.
                 use_mime (bool)   : Use mime type for file paths.
                 ignore_cwd (bool) : Ignore paths in CWD, and use search.
                 max_width (int)   : Maximum width for `type` string.
+                lazy (bool)       : Don't resolve anything until
+                                    `iter_formatted()` is used, and don't
+                                    keep the results around afterwards.
+                jobs (int)        : Number of names to resolve concurrently.
+                store (ResultStore): Keep file path results in this compact
+                                     store. Non-lazy batches of
+                                     `store_min` names or more get one
+                                     automatically.
+                every (bool)      : Find every match in $PATH, not just the
+                                    first one.
+                cache (ResolveCache): Reuse results from this cache, and
+                                      add new ones to it.
+                hasher (FileHasher) : Hash the final target of file paths.
+                elf (bool)        : Parse ELF headers directly, see:
+                                    ElfInfo
+                interpreter (bool): Resolve the #! interpreter for scripts.
+                owners (DpkgIndex): Look up the owning package for links
+                                    and targets.
+                root (RootFS)     : Resolve names inside this root directory.
+                                    BASH aliases/functions/builtins are
+                                    skipped.
+                env (Environment) : Resolve names in this environment,
+                                    instead of the current one.
+                stats (StatCache) : Stat cache to use, to share it with
+                                    other instances.
+                listings (dict)   : Directory listings to share with other
+                                    instances, see: PathIndex
+                types (dict)      : File types to share with other
+                                    instances, see: ResolvedPath
+                live (bool)       : Use a ShellCapture for aliases,
+                                    functions, and builtins.
+                follow (bool)     : Follow aliases and functions to the
+                                    command they run, see: _follow()
+                negative (NegativeCache): Skip names that are known to be
+                                          unresolvable, and remember new
+                                          ones. Only used for the current
+                                          environment.
+                read_size (int)   : Only read this many bytes of each file
+                                    to determine its type, see:
+                                    ResolvedPath
+                watchdog (DirWatchdog): Skip $PATH dirs that don't respond
+                                        in time.
+                libraries (bool)  : Find the shared libraries that ELF
+                                    files need, and names like libc.so.6
+                                    in the loader cache.
+                audit (PrivilegeAudit): Check final targets for
+                                        setuid/setgid bits and file
+                                        capabilities.
         """
         self.use_mime = use_mime or False
         self.max_width = max(max_width or 0, 0)
         self.ignore_cwd = ignore_cwd or False
+        self.lazy = lazy or False
+        self.jobs = max(jobs or 1, 1)
+        self.store = store
+        self.every = every or False
+        self.hasher = hasher
+        self.elf = elf or False
+        self.read_size = read_size or None
+        self.watchdog = watchdog
+        self.audit = audit
+        # Resolved interpreters, shared by every script in the batch.
+        self.interpreters = {} if interpreter else None
+        # Libraries are shared by every file in the batch, and only
+        # found on the host.
+        self.libraries = None
+        if libraries and (root is None):
+            self.libraries = LibraryResolver()
+        self.owners = owners
+        self.root = root
+        self.env = env
+        self.alias_file = ALIAS_FILE if env is None else env.alias_file
+        self.listings = listings
+        self.types = types
+        # Captured aliases/functions/builtins, there are none in a root.
+        self.shell = None
+        if live and (root is None):
+            self.shell = ShellCapture(env=env)
+        self.follow = follow or False
+        self.negative = None
+        if (root is None) and (env is None) and (self.shell is None):
+            self.negative = negative
+        # {command word: Future(nameinfo)} for commands that
+        # aliases/functions run, shared by every name in the batch.
+        self.expansions = {}
+        self._expansions_lock = threading.Lock()
+        # Linking is serialized, so concurrent jobs never link two
+        # half-followed aliases to each other. Command words are resolved
+        # before taking this lock, see: _prefetch()
+        self._follow_lock = threading.RLock()
+        # ResolvedPath, or a subclass of it for archives.
+        self.path_class = ResolvedPath if root is None else root.path_class
+        # lstat()/stat() results shared by everything in this run.
+        if root is not None:
+            self.stats = root.stats
+        elif stats is not None:
+            self.stats = stats
+        else:
+            self.stats = StatCache() if store is None else store.stats
+        self.cache = cache
+        # Environment fingerprint for cache keys, see: env_fingerprint()
+        # This needs self.stats, for the alias files.
+        self.fingerprint = None if cache is None else self.env_fingerprint()
+        # PathIndex for `every` mode, built on first use.
+        self._path_index = None
+        # Suggestions for unresolved names, built on first use.
+        self._suggestions = None
 
-        self.names = names
+        # {name: path} for names from glob patterns, found in the index.
+        self._located = {}
+        self.names = self.expand(names)
+        if (self.store is None) and (not self.lazy) and (
+                len(self.names) >= self.store_min):
+            self.store = ResultStore(
+                use_mime=self.use_mime,
+                max_width=self.max_width,
+                stats=self.stats,
+                root=root,
+            )
         self.unresolved = []
-        self.targets = self._locate()
+        # The same names, for fast membership tests.
+        self._unresolved_names = set()
+        self.unresolved_count = 0
+        # Alias/function messages for all names, from get_bash_msgs().
+        self._bash_msgs = None
+        self.targets = {} if self.lazy else self._locate()
 
     def __repr__(self):
         targetlines = []
@@ -810,424 +1963,5557 @@ class ResolvedNames(object):
             ')',
         ))
 
+    def _add_unresolved(self, name):
+        """ Record an unresolved name. In lazy mode only the first
+            `max_unresolved` names are kept.
+        """
+        debug('Unresolved: {!r}'.format(name))
+        self.unresolved_count += 1
+        if (not self.lazy) or (len(self.unresolved) < self.max_unresolved):
+            self.unresolved.append(name)
+            self._unresolved_names.add(name)
+
+    def _expansion(self, word):
+        """ Return nameinfo for a command word that an alias/function
+            runs, resolving it only once per batch. Other jobs that need
+            the same word wait for it, without holding `_follow_lock`.
+        """
+        with self._expansions_lock:
+            future = self.expansions.get(word, None)
+            pending = future is None
+            if pending:
+                future = self.expansions[word] = Future()
+        if pending:
+            try:
+                future.set_result(self._resolve_name(word, follow=False))
+            except BaseException as ex:
+                future.set_exception(ex)
+                raise
+        return future.result()
+
+    def _follow(self, resolved, seen, depth=0):
+        """ Follow an Alias/Function to what its first command word
+            resolves to, recursively, setting `command`, `expansion`, and
+            `cycle` on it. Objects are shared through `self.expansions`,
+            and each one is only followed once.
+        """
+        if resolved.command is not None:
+            # Already followed.
+            return
+        word, bypass = parse_command_word(
+            resolved.info,
+            typename=resolved.typename,
+        )
+        if word is None:
+            return
+        if (resolved.typename == 'alias') and (word == resolved.name):
+            # BASH doesn't expand an alias inside of itself.
+            bypass = bypass or 'alias'
+        resolved.command = word
+        if depth >= self.max_follow:
+            debug('Not following {!r}, too deep: {}'.format(word, depth))
+            return
+        nameinfo = self._expansion(word)
+        order = {
+            None: ('alias', 'function', 'builtin', 'file'),
+            'alias': ('function', 'builtin', 'file'),
+            'command': ('builtin', 'file'),
+            'builtin': ('builtin',),
+        }[bypass]
+        for typename in order:
+            target = nameinfo.get(typename, None)
+            if (typename == 'builtin') and target and (
+                    target.builtin_type == 'file'):
+                continue
+            if target is not None:
+                break
+        else:
+            return
+        if typename in ('alias', 'function'):
+            if target.name in seen:
+                debug('Alias/function cycle: {} -> {}'.format(
+                    resolved.name,
+                    target.name,
+                ))
+                resolved.cycle = target.name
+                return
+            self._follow(target, seen | {target.name}, depth + 1)
+        resolved.expansion = target
+
+    def _prefetch(self, nameinfo):
+        """ Resolve the command words that _follow() will need for the
+            aliases/functions in `nameinfo`, so the (slow) lookups run
+            outside of `_follow_lock`.
+        """
+        pending = [
+            (nameinfo[typename], 0)
+            for typename in ('alias', 'function')
+            if typename in nameinfo
+        ]
+        words = set()
+        while pending:
+            resolved, depth = pending.pop()
+            if (resolved.command is not None) or (depth >= self.max_follow):
+                continue
+            word, _ = parse_command_word(
+                resolved.info,
+                typename=resolved.typename,
+            )
+            if (word is None) or (word in words):
+                continue
+            words.add(word)
+            wordinfo = self._expansion(word)
+            pending.extend(
+                (wordinfo[typename], depth + 1)
+                for typename in ('alias', 'function')
+                if typename in wordinfo
+            )
+
     def _locate(self):
-        """ Resolve this name to an alias, function, builtin, or file path.
+        """ Resolve all names to an alias, function, builtin, or file path.
         """
         targets = {}
-        # Check aliases/functions.
-        for name, typeinfo in get_bash_msgs(self.names).items():
-            if typeinfo is None:
-                # No alias/function info for this name.
+        for name, nameinfo in self._locate_all(self.names):
+            if nameinfo:
+                targets[name] = nameinfo
+            elif name not in self._unresolved_names:
+                self._add_unresolved(name)
+        return targets
+
+    def _iter_unique(self):
+        """ Yield each name once, so duplicates are skipped before they
+            are located. Only the last `max_seen` unique names are
+            remembered, so a name that repeats further apart than that is
+            resolved (and shown) again.
+        """
+        seen = OrderedDict()
+        for name in self.names:
+            if name in seen:
+                seen.move_to_end(name)
                 continue
+            seen[name] = None
+            if len(seen) > self.max_seen:
+                seen.popitem(last=False)
+            yield name
+
+    def _locate_all(self, names):
+        """ Yield (name, nameinfo) for every name in `names`, in order.
+            Names are resolved concurrently when `self.jobs` > 1.
+        """
+        if self._bash_msgs is None:
+            # Searches the alias file once, for all names that need it.
+            msgnames = list(OrderedDict.fromkeys(self.names))
+            if self.cache is not None:
+                msgnames = [
+                    name for name in msgnames
+                    if not self.cache.peek((name, self.fingerprint))
+                ]
+            if (self.root is not None) or (self.shell is not None):
+                # The host's aliases don't mean anything inside the root,
+                # and a captured shell already has all of them.
+                msgnames = []
+            elif self.negative is not None:
+                msgnames = [
+                    name for name in msgnames if not self._known_miss(name)
+                ]
+            self._bash_msgs = get_bash_msgs(
+                msgnames,
+                alias_file=self.alias_file,
+                shell=None if self.env is None else self.env.shell,
+            ) if msgnames else {}
+        yield from iter_ordered(
+            lambda name: (name, self._locate_name(name)),
+            names,
+            self.jobs,
+        )
+
+    def _known_miss(self, name):
+        """ Return True if `name` is in the NegativeCache, and can't be a
+            file in the CWD either.
+        """
+        if (self.negative is None) or (os.path.sep in name):
+            return False
+        if name not in self.negative:
+            return False
+        return self.ignore_cwd or not self.stats.lexists(name)
+
+    def _locate_name(self, name):
+        """ Resolve a single name to an alias, function, builtin, or file
+            path, using the cache if there is one.
+            Returns a dict of {typename: resolved_object}, which will
+            be empty if the name could not be resolved.
+        """
+        if self.cache is None:
+            return self._resolve_name(name)
+        key = (name, self.fingerprint)
+        nameinfo = self.cache.get(key)
+        if nameinfo is None:
+            nameinfo = self._resolve_name(name)
+            self.cache.put(key, nameinfo)
+        return nameinfo
+
+    def _resolve_name(self, name, follow=True):
+        """ Resolve a single name, without using the cache.
+            Aliases/functions are followed when `self.follow` and `follow`
+            are set.
+            See: _locate_name()
+        """
+        nameinfo = {}
+        if self._known_miss(name):
+            debug('Known miss: {!r}'.format(name))
+            return nameinfo
+        if self.shell is not None:
+            # Aliases, functions, and builtins from the captured shell.
+            nameinfo.update(self.shell.nameinfo(name))
+        # Check aliases/functions.
+        typeinfo = (self._bash_msgs or {}).get(name, None)
+        if typeinfo is not None:
             debug('Got bash alias/function info for: {!r}'.format(name))
-            targets.setdefault(name, {})
             if ': alias' in typeinfo:
                 cls = Alias
                 typename = 'alias'
             else:
                 cls = Function
                 typename = 'function'
-            targets[name][typename] = cls(ALIAS_FILE, name, typeinfo)
+            nameinfo[typename] = cls(self.alias_file, name, typeinfo)
 
         # Check bash builtins.
-        for name in self.names:
-            bashtype = get_bash_type(name, short=False)
-            if bashtype:
-                debug('Got bash builtin info for: {!r}'.format(name))
-                targets.setdefault(name, {})
-                targets[name]['builtin'] = Builtin(name, bashtype)
-
-        # Check file paths.
-        for name in self.names:
-            r = ResolvedPath(
+        bashtype = None
+        if (self.root is None) and (self.shell is None):
+            bashtype = get_bash_type(
                 name,
-                use_mime=self.use_mime,
-                ignore_cwd=self.ignore_cwd,
-                max_width=self.max_width,
+                short=False,
+                path=None if self.watchdog is None else ':'.join(
+                    self.watchdog.healthy_dirs(ResolvedPath.get_env_path())
+                ),
             )
-            if r.exists:
-                debug('Got file path info for: {!r}'.format(name))
-                targets.setdefault(name, {})
-                targets[name]['file'] = r
-            # If no info was set by now, it's unresolved.
-            if not targets.get(name, None):
-                debug('Unresolved: {!r}'.format(name))
-                self.unresolved.append(name)
-        return targets
+        if bashtype:
+            debug('Got bash builtin info for: {!r}'.format(name))
+            builtin = Builtin(name, bashtype)
+            # BASH only knows about files in the current $PATH.
+            if (self.env is None) or (builtin.builtin_type != 'file'):
+                nameinfo['builtin'] = builtin
 
-    def formatted(
-            self, all_types=False, dir_only=False,
-            no_builtins=False, short_mode=False):
-        """ Printable/colorized representation of this ResolvedNames. """
-        alltargets = []
-        for name, nameinfo in self.targets.items():
-            if all_types:
-                alltargets.extend(
-                    r
-                    for r in nameinfo.values()
-                    if getattr(r, 'builtin_type', '') != 'file'
+        if follow and self.follow:
+            self._prefetch(nameinfo)
+            with self._follow_lock:
+                for typename in ('alias', 'function'):
+                    if typename in nameinfo:
+                        self._follow(nameinfo[typename], {name})
+
+        # Check file paths.
+        if self.every and (os.path.sep not in name):
+            matches = self.path_index.matches(name, **self.path_args())
+            if (not self.ignore_cwd) and (self.root is None) and (
+                    self.stats.lexists(name)):
+                # The file in the CWD comes before anything in $PATH.
+                matches.resolved.insert(
+                    0,
+                    self.path_class(name, **self.path_args()),
                 )
-                # No precedence selection, just show all of them.
-                continue
-            alias = nameinfo.get('alias', nameinfo.get('function', None))
-            builtin = nameinfo.get('builtin', None)
-            # Skipping the builtin type if it is a 'file'.
-            if builtin and builtin.builtin_type == 'file':
-                builtin = None
-            resolved = nameinfo.get('file', None)
-            if alias:
-                # Prefer aliases.
-                alltargets.append(alias)
-            elif (not no_builtins) and builtin:
-                # A real builtin, it will be used before any file/link.
-                alltargets.append(builtin)
-            elif resolved:
-                # Just a file path (possibly a symlink).
-                alltargets.append(resolved)
-            else:
-                # Unhandled case.
-                print_err('\nUnhandled case in whichfile!:')
-                print_err('    alias: {!r}'.format(alias))
-                print_err('    builtin: {!r}'.format(builtin))
-                print_err('    resolved: {!r}'.format(resolved))
-                print_err(C(repr(self), 'normal'), '\n')
+            if matches.exists:
+                debug('Got every file path for: {!r}'.format(name))
+                nameinfo['file'] = matches
+            return nameinfo
 
-        return '\n\n'.join(
-            t.formatted(dir_only=dir_only, short_mode=short_mode)
-            for t in alltargets
-        )
+        if (self.negative is not None) and (os.path.sep not in name) and (
+                not self.negative.may_exist(name)) and (
+                self.ignore_cwd or not self.stats.lexists(name)):
+            # Not in any $PATH dir, no need to try them all.
+            if not nameinfo:
+                self.negative.add(name)
+            return nameinfo
 
+        path = name
+        if (name in self._located) and (
+                self.ignore_cwd or not self.stats.lexists(name)):
+            # Matched a glob pattern, already found in the index.
+            path = self._located[name]
+        elif (self.libraries is not None) and (os.path.sep not in name) and (
+                self.ignore_cwd or not self.stats.lexists(name)):
+            # Library names come from the loader cache.
+            path = self.libraries.lookup(name) or name
+        if (self.env is not None) and (os.path.sep not in name) and (
+                self.ignore_cwd or not self.stats.lexists(name)):
+            # Use the (shared) directory listings, instead of trying every
+            # directory in this environment's $PATH.
+            locations = self.path_index.locations(name)
+            if not locations:
+                return nameinfo
+            path = locations[0]
+        r = self.path_class(
+            path,
+            ignore_cwd=self.ignore_cwd and (path == name),
+            **self.path_args()
+        )
+        if r.exists:
+            debug('Got file path info for: {!r}'.format(name))
+            nameinfo['file'] = r if self.store is None else self.store.add(r)
+        elif (not nameinfo) and (self.negative is not None) and (
+                os.path.sep not in name):
+            self.negative.add(name)
+        return nameinfo
 
-class ResolvedPath(object):
+    def env_fingerprint(self):
+        """ Return a hashable fingerprint of everything outside of the
+            name itself that can change how a name is resolved.
+        """
+        aliasfiles = []
+        env = self.env or Environment('')
+        for filepath in env.alias_files:
+            st = self.stats.stat(filepath)
+            aliasfiles.append((
+                filepath,
+                None if st is None else (
+                    st.st_dev,
+                    st.st_ino,
+                    st.st_size,
+                    st.st_mtime_ns,
+                ),
+            ))
+        return (
+            ':'.join(env.path),
+            env.shell,
+            tuple(aliasfiles),
+            # Relative names are resolved against the CWD.
+            None if self.ignore_cwd else os.getcwd(),
+            self.use_mime,
+            self.ignore_cwd,
+            self.every,
+            self.max_width,
+            None if self.hasher is None else self.hasher.algorithm,
+            self.elf,
+            self.interpreters is not None,
+            None if self.owners is None else tuple(self.owners.key),
+            None if self.root is None else self.root.root,
+            None if self.shell is None else self.shell.key,
+            self.follow,
+            None if self.negative is None else self.negative.key,
+            self.read_size,
+            self.libraries is not None,
+            self.audit is not None,
+        )
 
-    """ Resolve a single path, following any symlinks and determining
-        the file type. This is for file paths only, not aliases or bash
-        builtins.
-    """
+    def expand(self, names):
+        """ Replace glob patterns in `names` with every matching name in
+            $PATH, from the PathIndex. The first location of each match is
+            kept, so $PATH isn't searched again to resolve it. Patterns
+            without matches are kept, and reported as unresolved.
+            Patterns are not expanded for other environments.
+        """
+        if (self.env is not None) or not any(
+                PathIndex.is_pattern(name) for name in names):
+            return names
+        expanded = []
+        for name in names:
+            matches = None
+            if PathIndex.is_pattern(name):
+                matches = self.path_index.glob(name)
+            if not matches:
+                expanded.append(name)
+                continue
+            debug('Pattern {!r} matched {} names.'.format(name, len(matches)))
+            for match in matches:
+                self._located.setdefault(
+                    match,
+                    self.path_index.locations(match)[0],
+                )
+            expanded.extend(matches)
+        return expanded
 
-    def __init__(self, path, use_mime=False, ignore_cwd=False, max_width=0):
+    def path_args(self):
+        """ Keyword arguments for every ResolvedPath made by this instance.
         """
-            Arguments:
-                path     (str)      : A str path to resolve.
-                use_mime (bool)     : Use mime type, not human readable text.
-                ignore_cwd (bool)   : Ignore paths in the CWD, and search
-                                      anyway.
-                max_width (int)     : Maximum width for type string.
-                                      If not 0, type info is passed through
-                                      FormatBlock.
+        return {
+            'use_mime': self.use_mime,
+            'max_width': self.max_width,
+            'stats': self.stats,
+            'hasher': self.hasher,
+            'elf': self.elf,
+            'interpreters': self.interpreters,
+            'owners': self.owners,
+            'root': self.root,
+            'env_path': None if self.env is None else self.env.path,
+            'types': self.types,
+            'read_size': self.read_size,
+            'watchdog': self.watchdog,
+            'libraries': self.libraries,
+            'audit': self.audit,
+        }
+
+    @property
+    def path_index(self):
+        """ A PathIndex for $PATH, built the first time it is needed. """
+        if self._path_index is None:
+            if self.root is None:
+                self._path_index = PathIndex(
+                    dirs=None if self.env is None else self.env.path,
+                    listings=self.listings,
+                    watchdog=self.watchdog,
+                )
+            else:
+                self._path_index = self.root.path_index
+        return self._path_index
+
+    def _suggestion_names(self):
+        """ Return every name that could have been meant, for
+            Suggestions.
+        """
+        names = set(self.path_index.names)
+        if self.root is not None:
+            # No aliases/functions/builtins in a root.
+            return names
+        if self.shell is not None:
+            names.update(self.shell.aliases)
+            names.update(self.shell.functions)
+            names.update(self.shell.builtins)
+            names.update(self.shell.keywords)
+            return names
+        env = self.env or Environment('')
+        names.update(
+            get_bash_names(
+                alias_files=env.alias_files,
+                shell=env.shell,
+                path=env.path,
+            )
+        )
+        return names
+
+    def _select(self, nameinfo, all_types=False, no_builtins=False):
+        """ Return a list of resolved objects to show for a name,
+            choosing by precedence unless `all_types` is used.
+        """
+        if all_types:
+            # No precedence selection, just show all of them.
+            return [
+                r
+                for r in nameinfo.values()
+                if getattr(r, 'builtin_type', '') != 'file'
+            ]
+        alias = nameinfo.get('alias', nameinfo.get('function', None))
+        builtin = nameinfo.get('builtin', None)
+        # Skipping the builtin type if it is a 'file'.
+        if builtin and builtin.builtin_type == 'file':
+            builtin = None
+        resolved = nameinfo.get('file', None)
+        if alias:
+            # Prefer aliases.
+            return [alias]
+        elif (not no_builtins) and builtin:
+            # A real builtin, it will be used before any file/link.
+            return [builtin]
+        elif resolved:
+            # Just a file path (possibly a symlink).
+            return [resolved]
+        # Unhandled case.
+        print_err('\nUnhandled case in whichfile!:')
+        print_err('    alias: {!r}'.format(alias))
+        print_err('    builtin: {!r}'.format(builtin))
+        print_err('    resolved: {!r}'.format(resolved))
+        print_err(C(repr(self), 'normal'), '\n')
+        return []
+
+    def formatted(
+            self, all_types=False, dir_only=False,
+            no_builtins=False, short_mode=False):
+        """ Printable/colorized representation of this ResolvedNames. """
+        return '\n\n'.join(
+            self.iter_formatted(
+                all_types=all_types,
+                dir_only=dir_only,
+                no_builtins=no_builtins,
+                short_mode=short_mode,
+            )
+        )
+
+    def iter_formatted(
+            self, all_types=False, dir_only=False,
+            no_builtins=False, short_mode=False, json_mode=False):
+        """ Yield printable/colorized strings for each resolved target,
+            or JSON strings if `json_mode` is used.
+            In lazy mode names are resolved as they are needed, and each
+            result is yielded as soon as it (and every result before it)
+            is ready.
+        """
+        fmtargs = {
+            'dir_only': dir_only,
+            'short_mode': short_mode,
+            'json_mode': json_mode,
+        }
+        for name, selected in self.iter_selected(all_types, no_builtins):
+            for t in selected:
+                yield format_result(t, name=name, **fmtargs)
+
+    def iter_selected(self, all_types=False, no_builtins=False):
+        """ Yield (name, [resolved_object, ...]) for each name, with the
+            objects that would be shown for it (see: _select()).
+            In lazy mode, unresolved names are recorded and yielded with
+            an empty list. Duplicate names are skipped before they are
+            located, see: _iter_unique()
+        """
+        if not self.lazy:
+            for name, nameinfo in self.targets.items():
+                yield name, self._select(nameinfo, all_types, no_builtins)
+            return
+
+        for name, nameinfo in self._locate_all(self._iter_unique()):
+            if not nameinfo:
+                self._add_unresolved(name)
+                yield name, []
+                continue
+            yield name, self._select(nameinfo, all_types, no_builtins)
+
+    def suggest(self, name):
+        """ Return a list of names that are close to an unresolved
+            `name`, see: Suggestions
+        """
+        if self._suggestions is None:
+            env = self.env or Environment('')
+            self._suggestions = Suggestions(
+                self.path_index.dirs,
+                self._suggestion_names,
+                files=() if self.root is not None else env.alias_files,
+                # Root dirs can't be checked for changes from here.
+                use_cache=self.root is None,
+            )
+        return self._suggestions.suggest(name)
+
+
+class ResolvedEnvs(object):
+    """ Resolve the same names in several Environments, for comparing
+        them side by side. The environments share one stat cache, the
+        listings for $PATH dirs, and file types, so directories that are
+        in more than one $PATH are only read once.
+    """
+    def __init__(self, names, envs, **kwargs):
+        """
+            Arguments:
+                names (list(str))       : Names to resolve.
+                envs (list(Environment)): Environments to compare.
+                kwargs                  : Passed on to ResolvedNames.
+        """
+        seen = set()
+        for env in envs:
+            if env.name in seen:
+                raise InvalidArg('duplicate environment: {}'.format(env.name))
+            seen.add(env.name)
+        self.names = names
+        self.envs = envs
+        self.stats = StatCache()
+        # {dirpath: [name, ...]}
+        self.listings = {}
+        # {(target, use_mime, use_elf): (filetype, elf)}
+        self.types = {}
+        self.resolved = [
+            ResolvedNames(
+                names,
+                lazy=True,
+                env=env,
+                stats=self.stats,
+                listings=self.listings,
+                types=self.types,
+                **kwargs
+            )
+            for env in envs
+        ]
+        # Number of names that resolved differently, see: iter_formatted()
+        self.differences = 0
+
+    def __repr__(self):
+        return '{}(envs={!r}, names={})'.format(
+            type(self).__name__,
+            [env.name for env in self.envs],
+            len(self.names),
+        )
+
+    def identity(self, resolved):
+        """ Return something to compare results by. Targets are compared
+            by device and inode, so /bin/ls and /usr/bin/ls are the same
+            when /bin is a link to /usr/bin.
+        """
+        if isinstance(resolved, ResolvedPath) and not (
+                resolved.broken or resolved.circular):
+            st = self.stats.stat(resolved.target)
+            if st is not None:
+                return (st.st_dev, st.st_ino)
+        return self.summary(resolved)
+
+    def iter_formatted(self, no_builtins=False, json_mode=False):
+        """ Yield a header and one line for each name, with a column for
+            each environment. Names that don't resolve the same way in
+            every environment are highlighted.
+            In `json_mode` a JSON object is yielded for each name instead.
+        """
+        rows = []
+        for name, results in self.iter_rows(no_builtins=no_builtins):
+            cells = [self.summary(r) for r in results]
+            differs = len(set(self.identity(r) for r in results)) > 1
+            self.differences += differs
+            if json_mode:
+                yield json.dumps({
+                    'name': name,
+                    'differs': differs,
+                    'environments': {
+                        env.name: None if r is None else r.as_dict()
+                        for env, r in zip(self.envs, results)
+                    },
+                })
+            else:
+                rows.append((name, cells, differs))
+        if json_mode:
+            return
+        namewidth = max([len('name')] + [len(name) for name, _, _ in rows])
+        widths = [
+            max([len(env.name)] + [len(cells[i]) for _, cells, _ in rows])
+            for i, env in enumerate(self.envs)
+        ]
+        yield '  {}  {}'.format(
+            'name'.ljust(namewidth),
+            '  '.join(
+                colr_str(env.name.ljust(width), **COLOR_ARGS['cmd'])
+                for env, width in zip(self.envs, widths)
+            ).rstrip(),
+        )
+        for name, cells, differs in rows:
+            colorargs = {'fore': 'yellow'} if differs else COLOR_ARGS['target']
+            yield '{} {}  {}'.format(
+                colr_str('*', fore='red', style='bright') if differs else ' ',
+                name.ljust(namewidth),
+                '  '.join(
+                    colr_str(
+                        cell.ljust(width),
+                        **({'fore': 'red'} if cell == '<missing>' else
+                           colorargs)
+                    )
+                    for cell, width in zip(cells, widths)
+                ).rstrip(),
+            )
+
+    def iter_rows(self, no_builtins=False):
+        """ Yield (name, [resolved_object or None, ...]) for each name, with
+            the object that would be shown for each environment.
+        """
+        selected = zip(*(
+            resolved.iter_selected(no_builtins=no_builtins)
+            for resolved in self.resolved
+        ))
+        for envresults in selected:
+            yield envresults[0][0], [
+                results[0] if results else None
+                for _, results in envresults
+            ]
+
+    @staticmethod
+    def summary(resolved):
+        """ A short, plain description of what a name resolved to,
+            for comparing environments.
+        """
+        if resolved is None:
+            return '<missing>'
+        if isinstance(resolved, Alias):
+            # Also Builtins and Functions.
+            return getattr(resolved, 'builtin_type', None) or (
+                resolved.typename
+            )
+        if resolved.circular:
+            return 'circular:{}'.format(resolved.target)
+        if resolved.broken:
+            return 'dead:{}'.format(resolved.target)
+        return resolved.target
+
+
+class PathIndex(object):
+    """ An index of every name in the $PATH directories, built with one
+        directory listing per directory.
+    """
+    def __init__(self, dirs=None, root=None, listings=None, watchdog=None):
+        """
+            Arguments:
+                dirs (list(str))  : Directories to index, in search order.
+                                    Default: ResolvedPath.get_env_path()
+                root (RootFS)     : Directories are inside this root.
+                listings (dict)   : {dirpath: [name, ...]} to share
+                                    directory listings with other indexes.
+                watchdog (DirWatchdog): Skip directories that don't respond
+                                        in time.
+        """
+        self.dirs = tuple(
+            ResolvedPath.get_env_path() if dirs is None else dirs
+        )
+        self.root = root
+        if watchdog is not None:
+            self.dirs = watchdog.healthy_dirs(self.dirs)
+        self.listings = {} if listings is None else listings
+        # {name: [dirpath, ...]}, with directories in search order.
+        self.names = {}
+        # Sorted names, and sorted reversed names, for glob(). These are
+        # built the first time they are needed.
+        self._sorted = None
+        self._reversed = None
+        self._build()
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return '{}(dirs={!r}, names={})'.format(
+            type(self).__name__,
+            self.dirs,
+            len(self.names),
+        )
+
+    def _build(self):
+        """ List each directory once, and fill in self.names. """
+        seen = set()
+        for dirpath in self.dirs:
+            key = self._dir_key(dirpath)
+            if key in seen:
+                # Listed twice in $PATH, or the same directory through a
+                # link (like /bin -> usr/bin). The second one never
+                # matters, and it's files would only shadow themselves.
+                debug('Skipping duplicate $PATH dir: {}'.format(dirpath))
+                continue
+            seen.add(key)
+            names = self.listings.get(dirpath, None)
+            if names is not None:
+                debug('Using listing for $PATH dir: {}'.format(dirpath))
+            else:
+                try:
+                    if self.root is None:
+                        with os.scandir(dirpath) as entries:
+                            names = [entry.name for entry in entries]
+                    else:
+                        names = self.root.listdir(dirpath)
+                except OSError as ex:
+                    debug('Cannot index $PATH dir: {}\n{}'.format(
+                        dirpath,
+                        ex,
+                    ))
+                    names = ()
+                self.listings[dirpath] = names
+            for name in names:
+                self.names.setdefault(name, []).append(dirpath)
+
+    def _dir_key(self, dirpath):
+        """ Return something that identifies the directory itself, so
+            two $PATH entries for the same directory are only indexed once.
+            Host directories are compared by device and inode, and
+            directories inside a root by their real path in the root.
+        """
+        if self.root is not None:
+            return self.root.resolve_dir(self.root.normpath(dirpath))
+        try:
+            st = os.stat(dirpath)
+        except OSError:
+            return dirpath
+        return (st.st_dev, st.st_ino)
+
+    def locations(self, name):
+        """ Return a list of full paths for `name`, in search order. """
+        return [
+            os.path.join(dirpath, name)
+            for dirpath in self.names.get(name, ())
+        ]
+
+    def matches(self, name, **kwargs):
+        """ Resolve every location for `name`, and return a PathMatches.
+            Keyword arguments are passed on to ResolvedPath().
+        """
+        cls = ResolvedPath
+        if self.root is not None:
+            kwargs['root'] = self.root
+            cls = self.root.path_class
+        return PathMatches(
+            name,
+            [cls(path, **kwargs) for path in self.locations(name)]
+        )
+
+    def shadowed(self):
+        """ Yield (name, [fullpath, ...]) for every name that is found in
+            more than one directory, sorted by name.
+        """
+        for name in sorted(self.names):
+            if len(self.names[name]) > 1:
+                yield name, self.locations(name)
+
+    @staticmethod
+    def _span(names, prefix):
+        """ Return (start, stop) for the items in a sorted list that start
+            with `prefix`, with a binary search.
+        """
+        if not prefix:
+            return 0, len(names)
+        start = bisect.bisect_left(names, prefix)
+        stop = bisect.bisect_left(
+            names,
+            prefix[:-1] + chr(ord(prefix[-1]) + 1),
+            lo=start,
+        )
+        return start, stop
+
+    def glob(self, pattern):
+        """ Return a sorted list of names that match a glob pattern.
+            Only names that start with the pattern's literal prefix (or end
+            with its literal suffix, whichever is less) are tried, so a
+            query like 'python3*' costs about log(N) plus the matches.
+        """
+        if self._sorted is None:
+            self._sorted = sorted(self.names)
+            self._reversed = sorted(name[::-1] for name in self.names)
+        prefix = re.split(r'[*?[]', pattern, 1)[0]
+        suffix = pattern[max(pattern.rfind(c) for c in '*?]') + 1:]
+        start, stop = self._span(self._sorted, prefix)
+        candidates = self._sorted[start:stop]
+        if suffix:
+            rstart, rstop = self._span(self._reversed, suffix[::-1])
+            if rstop - rstart < stop - start:
+                candidates = [
+                    name[::-1] for name in self._reversed[rstart:rstop]
+                ]
+        regex = re.compile(fnmatch.translate(pattern))
+        return sorted(name for name in candidates if regex.match(name))
+
+    @staticmethod
+    def is_pattern(name):
+        """ Return True if a name is a glob pattern for glob(). """
+        return (os.path.sep not in name) and any(c in name for c in '*?[')
+
+
+class PathMatches(object):
+    """ Holds every ResolvedPath found for a name in $PATH.
+        The first one is active, the rest are shadowed by it.
+    """
+    def __init__(self, name, resolved):
+        self.name = name
+        self.resolved = resolved
+
+    def __repr__(self):
+        return '{}(name={!r}, resolved={!r})'.format(
+            type(self).__name__,
+            self.name,
+            self.resolved,
+        )
+
+    def as_dict(self):
+        """ A JSON-friendly dict for these matches. """
+        matches = []
+        for i, r in enumerate(self.resolved):
+            info = r.as_dict()
+            info['shadowed'] = i > 0
+            matches.append(info)
+        return {'type': 'matches', 'matches': matches}
+
+    @property
+    def active(self):
+        """ The ResolvedPath that would be used, or None. """
+        return self.resolved[0] if self.resolved else None
+
+    @property
+    def exists(self):
+        return bool(self.resolved)
+
+    @property
+    def shadowed(self):
+        """ ResolvedPaths that are shadowed by the active one. """
+        return self.resolved[1:]
+
+    def formatted(self, dir_only=False, short_mode=False):
+        """ Printable/colorized representation of these matches. """
+        if dir_only or short_mode:
+            return '\n'.join(
+                r.formatted(dir_only=dir_only, short_mode=short_mode)
+                for r in self.resolved
+            )
+        blocks = []
+        for i, r in enumerate(self.resolved):
+            if i == 0:
+                status = colr_str('(active)', fore='green')
+            else:
+                status = colr_str('(shadowed)', fore='yellow')
+            header, _, rest = r.formatted().partition('\n')
+            blocks.append('\n'.join(
+                s for s in ('{} {}'.format(header, status), rest) if s
+            ))
+        return '\n'.join(blocks)
+
+
+class ModuleFinder(object):
+    """ Find the files for dotted Python module names, the way the
+        import system's PathFinder would, without importing anything.
+        Each part of a dotted name is found in its parent package's
+        search locations, so no package __init__ is run.
+        Modules that a package only adds to sys.modules when it is
+        imported can't be found this way, except for `os.path`, which is
+        found through the module it stands for (posixpath or ntpath).
+    """
+    # Used to get the search path from another interpreter.
+    query = '; '.join((
+        'import importlib.machinery as m, json, os, sys',
+        'print(json.dumps({'
+        '"path": sys.path, '
+        '"aliases": {"os.path": os.path.__name__}, '
+        '"builtins": sys.builtin_module_names, '
+        '"extension": m.EXTENSION_SUFFIXES, '
+        '"source": m.SOURCE_SUFFIXES, '
+        '"bytecode": m.BYTECODE_SUFFIXES}))',
+    ))
+
+    def __init__(self, python=None):
+        """
+            Arguments:
+                python (str) : Python executable to get sys.path, builtin
+                               modules, and file suffixes from.
+                               Default: the current interpreter.
+        """
+        self.python = python
+        info = self._interpreter_info()
+        self.path = tuple(info['path'])
+        self.builtins = frozenset(info['builtins'])
+        # {module name: real module name}, for modules that are set in
+        # sys.modules instead of being files in their package.
+        self.aliases = info.get('aliases', None) or {}
+        self.loader_details = (
+            (importlib.machinery.ExtensionFileLoader, info['extension']),
+            (importlib.machinery.SourceFileLoader, info['source']),
+            (importlib.machinery.SourcelessFileLoader, info['bytecode']),
+        )
+        # {dirpath: finder}, like sys.path_importer_cache.
+        self.finders = {}
+        # {dotted name: ModuleSpec or None}, parent packages are shared.
+        self.specs = {}
+        self.unresolved = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '{}(python={!r}, path={!r})'.format(
+            type(self).__name__,
+            self.python,
+            self.path,
+        )
+
+    def _find_spec(self, fullname, path):
+        """ Find the spec for one module in a list of directories.
+            Namespace package portions are collected, unless a regular
+            module/package is found in a later directory.
+        """
+        namespace = []
+        for dirpath in path:
+            finder = self._finder(dirpath)
+            if finder is None:
+                continue
+            spec = finder.find_spec(fullname)
+            if spec is None:
+                continue
+            if spec.loader is not None:
+                return spec
+            namespace.extend(spec.submodule_search_locations or ())
+        if not namespace:
+            return None
+        spec = importlib.machinery.ModuleSpec(fullname, None, is_package=True)
+        spec.submodule_search_locations = namespace
+        return spec
+
+    def _finder(self, dirpath):
+        """ Return a (cached) finder for a sys.path entry, or None if it
+            is not a directory or zip file.
+        """
+        if dirpath in self.finders:
+            return self.finders[dirpath]
+        finder = None
+        if os.path.isdir(dirpath or '.'):
+            finder = importlib.machinery.FileFinder(
+                dirpath,
+                *self.loader_details
+            )
+        elif os.path.isfile(dirpath):
+            try:
+                finder = zipimport.zipimporter(dirpath)
+            except zipimport.ZipImportError as ex:
+                debug('Not a zip file: {}\n{}'.format(dirpath, ex))
+        self.finders[dirpath] = finder
+        return finder
+
+    def _interpreter_info(self):
+        """ Return a dict with sys.path, builtin modules, and module file
+            suffixes for self.python (or this interpreter).
+        """
+        if self.python is None:
+            return {
+                # Like `python -c`, the first entry is the CWD, not the
+                # directory for this script.
+                'path': [''] + sys.path[1:],
+                'aliases': {'os.path': os.path.__name__},
+                'builtins': sys.builtin_module_names,
+                'extension': importlib.machinery.EXTENSION_SUFFIXES,
+                'source': importlib.machinery.SOURCE_SUFFIXES,
+                'bytecode': importlib.machinery.BYTECODE_SUFFIXES,
+            }
+        try:
+            output = subprocess.check_output(
+                [self.python, '-c', self.query],
+                stderr=subprocess.PIPE,
+            )
+            return json.loads(output.decode())
+        except (OSError, subprocess.CalledProcessError, ValueError) as ex:
+            raise InvalidArg(
+                'cannot get sys.path from: {}\n{}'.format(self.python, ex)
+            )
+
+    def find_spec(self, name):
+        """ Return a ModuleSpec for a dotted module name, finding each
+            parent package first. Returns None if it can't be found.
+        """
+        if name in self.specs:
+            return self.specs[name]
+        parent, _, _ = name.rpartition('.')
+        if name in self.aliases:
+            spec = self.find_spec(self.aliases[name])
+        elif not parent:
+            spec = self._find_spec(name, self.path)
+        else:
+            parentspec = self.find_spec(parent)
+            if (parentspec is None) or (
+                    parentspec.submodule_search_locations is None):
+                # Not found, or not a package.
+                spec = None
+            else:
+                spec = self._find_spec(
+                    name,
+                    parentspec.submodule_search_locations,
+                )
+        self.specs[name] = spec
+        return spec
+
+    def iter_formatted(
+            self, names, jobs=1, dir_only=False, short_mode=False,
+            json_mode=False, **kwargs):
+        """ Resolve module names, and yield formatted results in order.
+            Names that can't be found are added to self.unresolved.
+            Keyword arguments are passed on to ResolvedPath().
+        """
+        stats = StatCache()
+        results = iter_ordered(
+            lambda name: self.resolve(name, stats=stats, **kwargs),
+            names,
+            jobs,
+        )
+        for name, module in zip(names, results):
+            if module is None:
+                self.unresolved.append(name)
+                continue
+            yield format_result(
+                module,
+                name=name,
+                dir_only=dir_only,
+                short_mode=short_mode,
+                json_mode=json_mode,
+            )
+
+    def resolve(self, name, **kwargs):
+        """ Find a module, and resolve its file with ResolvedPath.
+            Keyword arguments are passed on to ResolvedPath().
+            Returns a ResolvedModule, or None if it can't be found.
+        """
+        if name in self.builtins:
+            return ResolvedModule(name, 'built-in module')
+        with self._lock:
+            spec = self.find_spec(name)
+        if spec is None:
+            return None
+        if spec.origin is None:
+            locations = list(spec.submodule_search_locations)
+            return ResolvedModule(
+                name,
+                'namespace package',
+                locations=locations,
+                resolved=ResolvedPath(locations[0], **kwargs),
+            )
+        if isinstance(spec.loader, zipimport.zipimporter):
+            kind = 'zipped module'
+        elif isinstance(spec.loader, importlib.machinery.ExtensionFileLoader):
+            kind = 'extension module'
+        elif isinstance(
+                spec.loader,
+                importlib.machinery.SourcelessFileLoader):
+            kind = 'bytecode module'
+        else:
+            kind = 'source module'
+        if spec.submodule_search_locations is not None:
+            kind = kind.replace('module', 'package')
+        if name in self.aliases:
+            kind = '{} (alias for {})'.format(kind, self.aliases[name])
+        return ResolvedModule(
+            name,
+            kind,
+            locations=spec.submodule_search_locations,
+            resolved=ResolvedPath(spec.origin, **kwargs),
+        )
+
+
+class ProcessIndex(object):
+    """ The executables of running processes, from one sweep of /proc.
+        Processes are grouped by executable (the exe link's path, and the
+        device/inode it points to), so each one is resolved only once.
+    """
+    default_procdir = '/proc'
+    # Added to the exe link by the kernel, when the file was unlinked.
+    deleted_suffix = ' (deleted)'
+
+    def __init__(self, pids=None, procdir=None):
+        """
+            Arguments:
+                pids (list(int)) : Process ids to look at.
+                                   Default: every process.
+                procdir (str)    : Where procfs is mounted.
+        """
+        self.procdir = procdir or self.default_procdir
+        self.pids = pids
+        # {(exe, identity): ProcessGroup}
+        self.groups = {}
+        # Processes that we aren't allowed to look at.
+        self.unreadable = []
+        # Requested processes that don't exist, or have no executable
+        # (kernel threads).
+        self.missing = []
+        self._sweep()
+
+    def __repr__(self):
+        return '{}(procdir={!r}, groups={}, unreadable={})'.format(
+            type(self).__name__,
+            self.procdir,
+            len(self.groups),
+            len(self.unreadable),
+        )
+
+    def _cmdline(self, pid):
+        """ Return the argument list for a process, or [] on errors. """
+        try:
+            with open(self._procpath(pid, 'cmdline'), 'rb') as f:
+                data = f.read()
+        except OSError as ex:
+            debug('Cannot read cmdline for {}: {}'.format(pid, ex))
+            return []
+        return [
+            s.decode(errors='replace')
+            for s in data.rstrip(b'\0').split(b'\0')
+            if s
+        ]
+
+    def _procpath(self, pid, name):
+        return os.path.join(self.procdir, str(pid), name)
+
+    def _sweep(self):
+        """ Read the exe link and cmdline for every process, and fill in
+            self.groups.
+        """
+        pids = self.pids
+        if pids is None:
+            try:
+                pids = sorted(
+                    int(s) for s in os.listdir(self.procdir) if s.isdigit()
+                )
+            except OSError as ex:
+                raise InvalidArg('cannot list processes in: {}\n{}'.format(
+                    self.procdir,
+                    ex,
+                ))
+        for pid in pids:
+            procexe = self._procpath(pid, 'exe')
+            try:
+                exe = os.readlink(procexe)
+                # The link can be followed even when the file is deleted.
+                st = os.stat(procexe)
+            except (FileNotFoundError, ProcessLookupError):
+                if self.pids is not None:
+                    self.missing.append(pid)
+                continue
+            except OSError as ex:
+                debug('Cannot read exe for {}: {}'.format(pid, ex))
+                self.unreadable.append(pid)
+                continue
+            deleted = exe.endswith(self.deleted_suffix)
+            if deleted:
+                exe = exe[:-len(self.deleted_suffix)]
+            key = (exe, (st.st_dev, st.st_ino))
+            group = self.groups.get(key, None)
+            if group is None:
+                group = self.groups[key] = ProcessGroup(
+                    exe,
+                    identity=key[1],
+                    deleted=deleted,
+                )
+            group.add(pid, self._cmdline(pid), procexe)
+
+    def iter_formatted(
+            self, jobs=1, short_mode=False, json_mode=False, **kwargs):
+        """ Resolve each ProcessGroup, and yield formatted results, sorted
+            by executable. Keyword arguments are passed on to
+            ResolvedPath().
+        """
+        stats = StatCache()
+        groups = [self.groups[key] for key in sorted(self.groups)]
+        results = iter_ordered(
+            lambda group: group.resolve(stats=stats, **kwargs),
+            groups,
+            jobs,
+        )
+        for group in results:
+            yield format_result(
+                group,
+                short_mode=short_mode,
+                json_mode=json_mode,
+            )
+
+
+class ProcessGroup(object):
+    """ Running processes that share an executable, see: ProcessIndex
+    """
+    typename = 'process'
+    # Bytes of the running file to read for its type.
+    type_bytes = 1024 * 1024
+
+    def __init__(self, exe, identity=None, deleted=False):
+        """
+            Arguments:
+                exe (str)        : Path of the executable, from the exe
+                                   link, without ' (deleted)'.
+                identity (tuple) : (st_dev, st_ino) of the running file.
+                deleted (bool)   : Whether the running file was deleted.
+        """
+        self.exe = exe
+        self.identity = identity
+        self.deleted = deleted
+        # [(pid, [arg, ...]), ...]
+        self.processes = []
+        # /proc/PID/exe links, any of them can be used to read the file.
+        self.procexes = []
+        # ResolvedPath for `exe`, if it exists.
+        self.resolved = None
+        # Type of the running file, when `exe` isn't the same file.
+        self.filetype = None
+        # Set when `exe` is not the file that is running.
+        self.status = 'deleted' if deleted else None
+        # Command lines are cut to fit in this width, if not 0.
+        self.max_width = 0
+
+    def __repr__(self):
+        return '{}({!r}, status={!r}, processes={})'.format(
+            type(self).__name__,
+            self.exe,
+            self.status,
+            len(self.processes),
+        )
+
+    def _proc_filetype(self, use_mime=False):
+        """ Return the type of the running file through /proc, which
+            works even when it is deleted. libmagic would only see the
+            link itself, so it gets an open descriptor (or the data, for
+            older python-magic versions) instead.
+        """
+        from_descriptor = getattr(magic, 'from_descriptor', None)
+        for procexe in self.procexes:
+            try:
+                if from_descriptor is None:
+                    data = read_prefix(procexe, self.type_bytes)
+                    return magic.from_buffer(data, mime=use_mime)
+                fd = os.open(procexe, os.O_RDONLY)
+                try:
+                    return from_descriptor(fd, mime=use_mime)
+                finally:
+                    os.close(fd)
+            except EnvironmentError as ex:
+                debug('Cannot read type from: {}\n{}'.format(procexe, ex))
+        return '<unknown>'
+
+    def add(self, pid, cmdline, procexe):
+        """ Add a process that runs this executable. """
+        self.processes.append((pid, cmdline))
+        self.procexes.append(procexe)
+
+    def as_dict(self):
+        """ A JSON-friendly dict for this group of processes. """
+        return {
+            'type': self.typename,
+            'exe': self.exe,
+            'deleted': self.deleted,
+            'status': self.status,
+            'filetype': self.filetype,
+            'processes': [
+                {'pid': pid, 'cmdline': cmdline}
+                for pid, cmdline in self.processes
+            ],
+            'file': None if self.resolved is None else (
+                self.resolved.as_dict()
+            ),
+        }
+
+    def formatted(self, dir_only=False, short_mode=False):
+        """ Printable/colorized representation of this group.
+            `dir_only` is not used, for compatibility with the other
+            resolved classes.
+        """
+        count = len(self.processes)
+        status = ''
+        if self.status:
+            status = ' {}'.format(colr_str(
+                '({})'.format(self.status),
+                fore='red',
+                style='bright',
+            ))
+        if short_mode:
+            return '{:>6} {}{}'.format(
+                count,
+                colr_str(self.exe, **COLOR_ARGS['target']),
+                status,
+            )
+        lines = ['{}{}: {} {}'.format(
+            colr_str(self.exe, **COLOR_ARGS['cmd']),
+            status,
+            count,
+            'process' if count == 1 else 'processes',
+        )]
+        if self.filetype is not None:
+            lines.append('{} {}'.format(
+                'Running:'.rjust(12),
+                colr_str(
+                    format_type_block(
+                        self.filetype,
+                        width=self.max_width,
+                        prepend=' ' * 13,
+                    ),
+                    **COLOR_ARGS['type']
+                ),
+            ))
+        if self.resolved is not None:
+            if self.status:
+                lines.append('{} {}'.format(
+                    'Now:'.rjust(12),
+                    colr_str('a different file', fore='yellow'),
+                ))
+            lines.extend(
+                '    {}'.format(line)
+                for line in self.resolved.formatted().split('\n')
+            )
+        elif self.status:
+            lines.append('{} {}'.format(
+                'Now:'.rjust(12),
+                colr_str('(missing)', fore='red'),
+            ))
+        # Room for the label and pid.
+        cmdwidth = max(self.max_width - 21, 20) if self.max_width else 0
+        for i, (pid, cmdline) in enumerate(self.processes):
+            cmd = ' '.join(shlex.quote(arg) for arg in cmdline)
+            if cmdwidth and (len(cmd) > cmdwidth):
+                cmd = '{}…'.format(cmd[:cmdwidth - 1])
+            lines.append('{} {} {}'.format(
+                ('Pids:' if i == 0 else '').rjust(12),
+                colr_str(str(pid).rjust(7), **COLOR_ARGS['link']),
+                cmd,
+            ))
+        return '\n'.join(lines)
+
+    def resolve(self, **kwargs):
+        """ Resolve the executable's path with ResolvedPath, and check
+            that it is still the file that is running. When it isn't, the
+            running file's type is read through /proc.
+            Keyword arguments are passed on to ResolvedPath().
+            Returns this ProcessGroup.
+        """
+        self.max_width = kwargs.get('max_width', 0) or 0
+        resolved = ResolvedPath(self.exe, **kwargs)
+        if resolved.exists:
+            self.resolved = resolved
+            st = resolved.stats.stat(self.exe)
+            current = None if st is None else (st.st_dev, st.st_ino)
+            if current != self.identity:
+                # A new file was installed over it, or the process is in
+                # another mount namespace (a container).
+                self.status = 'replaced' if self.deleted else 'different'
+        elif not self.deleted:
+            self.status = 'missing'
+        if self.status:
+            self.filetype = self._proc_filetype(
+                use_mime=kwargs.get('use_mime', False),
+            )
+        return self
+
+
+class ResolvedModule(object):
+    """ Holds info about a Python module found by ModuleFinder. """
+    typename = 'module'
+
+    def __init__(self, name, kind, locations=None, resolved=None):
+        """
+            Arguments:
+                name (str)              : Dotted module name.
+                kind (str)              : Kind of module, like:
+                                          'source module', 'package'
+                locations (list)        : Search locations for packages.
+                resolved (ResolvedPath) : The module's file, or the first
+                                          directory for namespace packages.
+                                          None for built-in modules.
+        """
+        self.name = name
+        self.kind = kind
+        self.locations = None if locations is None else list(locations)
+        self.resolved = resolved
+
+    def __repr__(self):
+        return '{}(name={!r}, kind={!r}, resolved={!r})'.format(
+            type(self).__name__,
+            self.name,
+            self.kind,
+            None if self.resolved is None else self.resolved.path,
+        )
+
+    def as_dict(self):
+        """ A JSON-friendly dict for this module. """
+        return {
+            'type': self.typename,
+            'module': self.name,
+            'kind': self.kind,
+            'locations': self.locations,
+            'file': None if self.resolved is None else (
+                self.resolved.as_dict()
+            ),
+        }
+
+    def formatted(self, dir_only=False, short_mode=False):
+        """ Printable/colorized representation of this module. """
+        if self.resolved is None:
+            if dir_only or short_mode:
+                return colr_str(self.kind, **COLOR_ARGS['target'])
+        elif dir_only or short_mode:
+            return self.resolved.formatted(
+                dir_only=dir_only,
+                short_mode=short_mode,
+            )
+        lines = ['{}: {}'.format(
+            colr_str(self.name, **COLOR_ARGS['cmd']),
+            colr_str(self.kind, **COLOR_ARGS['type']),
+        )]
+        if self.resolved is None:
+            return lines[0]
+        lines.extend(
+            '    {}'.format(line)
+            for line in self.resolved.formatted().split('\n')
+        )
+        if self.locations and len(self.locations) > 1:
+            lines.extend(
+                '    ⯈ {}'.format(colr_str(path, **COLOR_ARGS['link']))
+                for path in self.locations[1:]
+            )
+        return '\n'.join(lines)
+
+
+class ResolvedPath(object):
+
+    """ Resolve a single path, following any symlinks and determining
+        the file type. This is for file paths only, not aliases or bash
+        builtins.
+    """
+    __slots__ = (
+        '_digest',
+        '_prefix',
+        'broken',
+        'bytes_read',
+        'circular',
+        'elf',
+        'exists',
+        'filetype',
+        'hash_algorithm',
+        'interpreter',
+        'libraries',
+        'max_width',
+        'packages',
+        'path',
+        'privileges',
+        'read_size',
+        'resolved',
+        'root',
+        'shebang',
+        'stats',
+        'symlink_to',
+        'target',
+        'use_elf',
+        'use_mime',
+    )
+    # Interpreters are resolved one at a time, see: _resolve_interpreter()
+    # It is reentrant, because interpreters can be scripts too.
+    _interpreter_lock = threading.RLock()
+
+    def __init__(
+            self, path, use_mime=False, ignore_cwd=False, max_width=0,
+            stats=None, hasher=None, elf=False, interpreters=None,
+            owners=None, root=None, env_path=None, types=None,
+            read_size=None, watchdog=None, libraries=None, audit=None):
+        """
+            Arguments:
+                path     (str)      : A str path to resolve.
+                use_mime (bool)     : Use mime type, not human readable text.
+                ignore_cwd (bool)   : Ignore paths in the CWD, and search
+                                      anyway.
+                max_width (int)     : Maximum width for type string.
+                                      If not 0, type info is passed through
+                                      FormatBlock.
+                stats (StatCache)   : Stat cache to share with other
+                                      ResolvedPaths in the same run.
+                hasher (FileHasher) : Hash the final target with this.
+                elf (bool)          : Parse ELF headers for ELF targets,
+                                      instead of using libmagic
+                                      (unless use_mime is set).
+                interpreters (dict) : If not None, the #! interpreter for
+                                      scripts is resolved, and memoized in
+                                      this dict.
+                owners (DpkgIndex)  : Look up the package that owns the
+                                      path, each link, and the target.
+                root (RootFS)       : Resolve the path inside this root
+                                      directory. All paths are relative to
+                                      the root, and $PATH is searched
+                                      inside of it.
+                env_path (tuple)    : $PATH dirs to search, instead of the
+                                      current $PATH.
+                types (dict)        : File types for targets, shared with
+                                      other ResolvedPaths, like:
+                                      {(target, use_mime, elf): info}
+                read_size (int)     : If set, only this many bytes are read
+                                      from regular files to determine their
+                                      type, see: read_prefix()
+                watchdog (DirWatchdog): Skip $PATH dirs that don't respond
+                                        in time.
+                libraries (LibraryResolver): Find the shared libraries
+                                             that ELF targets need.
+                audit (PrivilegeAudit): Check the target for setuid/setgid
+                                        bits and file capabilities.
 
             The path/link is resolved on initialization.
             Information about the path will be in the public attributes:
                 broken     : Whether this is an existing, but broken symlink.
+                bytes_read : Number of bytes read from the target, when
+                             `read_size` is used.
+                digest     : Hex digest for the final target, if a hasher
+                             was used.
+                elf        : ElfInfo for ELF targets, when `elf` is used.
                 exists     : Whether this is an existing path.
                 filetype   : File type from libmagic in human readable form,
                              or mime type if use_mime is True.
+                interpreter: ResolvedPath for the #! interpreter of a
+                             script, when `interpreters` is used.
+                libraries  : List of SharedLibrary for dynamic ELF
+                             targets, when `libraries` is used.
+                packages   : Dict of {path: package} for the path, links,
+                             and target, when `owners` is used.
+                privileges : Privileges for regular file targets, when
+                             `audit` is used.
                 resolved   : Whether this path is resolved yet.
                              This will be false for non-existing paths.
+                shebang    : The #! line for scripts, when `interpreters`
+                             is used.
                 symlink_to : List of link targets (in order).
                 target     : Final target for this link.
 
         """
 
-        self.use_mime = use_mime
-        # Expand the ~ (user) path, and use an absolute path when needed.
-        self.path = self._expand(path)
-        # If set to non-zero, use as width for FormatBlock on type info.
-        self.max_width = max(max_width or 0, 0)
+        self.use_mime = use_mime
+        self.use_elf = elf or False
+        self.elf = None
+        self.root = root
+        self.read_size = read_size or None
+        self.bytes_read = None
+        # Bytes read for the type in `read_size` mode, reused for the #!
+        # line and then dropped.
+        self._prefix = None
+        if stats is None:
+            stats = StatCache() if root is None else root.stats
+        self.stats = stats
+        # Expand the ~ (user) path, and use an absolute path when needed.
+        self.path = self._expand(path)
+        # If set to non-zero, use as width for FormatBlock on type info.
+        self.max_width = max(max_width or 0, 0)
+
+        # Set to starting path of a circular symlink  if `_follow_links()` or
+        # `_get_filetype()` finds a circular symlink.
+        self.circular = None
+        # Determine if this is an absolute path, or locate it in $PATH.
+        self.exists = False
+        self._locate(
+            ignore_cwd=ignore_cwd,
+            env_path=env_path,
+            watchdog=watchdog,
+        )
+        self.broken = self._broken()
+
+        self.symlink_to = []
+        # Assume an canonical path was passed, until proven otherwise.
+        self.target = self.path
+        self.filetype = None
+
+        self.resolved = False
+        # Set to a Future, and then a str, when a hasher is used.
+        self._digest = None
+        self.hash_algorithm = None
+        self.shebang = None
+        self.interpreter = None
+        self.libraries = None
+        self.packages = None
+        self.privileges = None
+        if self.exists:
+            self._resolve(types=types)
+            if (audit is not None) and not (self.broken or self.circular):
+                # The target's lstat() is already cached from resolving it.
+                hosttarget = self._host(self.target)
+                self.privileges = audit.check(
+                    hosttarget,
+                    self.stats.lstat(hosttarget),
+                )
+            if owners is not None:
+                self.packages = {
+                    p: owners.owner(p)
+                    for p in [self.path] + self.symlink_to
+                }
+            if (interpreters is not None) and not (
+                    self.broken or self.circular):
+                self._resolve_interpreter(
+                    interpreters,
+                    hasher=hasher,
+                    owners=owners,
+                    env_path=env_path,
+                    types=types,
+                    watchdog=watchdog,
+                )
+            if (libraries is not None) and not (self.broken or self.circular):
+                self.libraries = libraries.closure(self)
+            if (hasher is not None) and not (self.broken or self.circular):
+                self.hash_algorithm = hasher.algorithm
+                self._digest = hasher.submit(
+                    self._host(self.target),
+                    stats=self.stats,
+                )
+        self._prefix = None
+
+    def __repr__(self):
+        """ Print a correct representation of this class instance. """
+        if self.symlink_to:
+            symlinks = '[\n    {}\n    ],'.format(
+                ',\n        '.join(
+                    (repr(s) for s in self.symlink_to),
+                )
+            )
+        else:
+            symlinks = '[],'
+        return '\n'.join((
+            '{}('.format(type(self).__name__),
+            '    path={s.path!r},',
+            '    use_mime={s.use_mime},',
+            '    max_width={s.max_width},',
+            '    circular={s.circular!r},',
+            '    exists={s.exists},',
+            '    broken={s.broken},',
+            '    symlink_to={symlinks},',
+            '    target={s.target!r},',
+            '    filetype={s.filetype!r},',
+            '    resolved={s.resolved},',
+            ')',
+        )).format(
+            s=self,
+            symlinks=symlinks,
+        )
+
+    def __str__(self):
+        """ Printable string representation of this resolved path. """
+        if not self.exists:
+            debug('__str__() on non-existing file.')
+        if not self.resolved:
+            debug('__str__() on unresolved file.')
+        return self.formatted()
+
+    def _broken(self, path=None):
+        """ Determine if a path is a broken link. """
+        if self.root is not None:
+            return self.root.broken(path or self.path)
+        return self.stats.broken(self._host(path or self.path))
+
+    def _exists(self, path=None):
+        """ Determine whether a path exists,
+            or is at least an existing broken link.
+        """
+        return self.stats.lexists(self._host(path or self.path))
+
+    def _expand(self, path):
+        """ Expand user paths, and use abspath when needed.
+            Return the expanded path.
+        """
+        if self.root is not None:
+            # Bare names are searched for in $PATH, anything else is
+            # relative to the root.
+            if os.path.sep not in path:
+                return path
+            return self.root.normpath(path)
+        try:
+            if '~' in path:
+                path = path.expanduser(path)
+            if '..' in path:
+                path = path.abspath(path)
+        except Exception as exabs:
+            errfmt = 'Init error (abspath/expanduser): {}\n{}'
+            debug(errfmt.format(exabs, exabs))
+
+        return path
+
+    def _follow_links(self, path=None):
+        path = path or self.path
+        if self.root is not None:
+            yield from self._follow_root_links(path)
+            return
+        try:
+            symlink = self.stats.readlink(path)
+        except OSError as exreadlink:
+            debug('_follow_links(): readlink: {}'.format(exreadlink))
+        else:
+            basepath = os.path.split(path)[0]
+            absolutepath = os.path.join(basepath, symlink)
+            try:
+                absolutepath = os.path.abspath(absolutepath)
+            except RecursionError:
+                # Circular link.
+                # The "circle" can start anywhere in a symlink chain,
+                # so I'm using a RecursionError to detect it right now.
+                exc = CircularLink(self.path, path)
+                self.circular = exc.start
+                debug(exc)
+                raise exc
+            except Exception as exabs:
+                debug('_follow_links({}): abspath: {}'.format(path, exabs))
+            else:
+                yield absolutepath
+                yield from self._follow_links(absolutepath)
+
+    def _follow_root_links(self, path):
+        """ Like _follow_links(), but inside self.root.
+            Absolute link targets are anchored in the root, and `..` can't
+            go above it.
+        """
+        chain = [path]
+        # Host paths that were already seen, /bin/x and /usr/bin/x may
+        # be the same file.
+        seen = {self._host(path)}
+        while True:
+            try:
+                path = self.root.readlink(path)
+            except OSError as exreadlink:
+                debug('_follow_root_links(): readlink: {}'.format(
+                    exreadlink
+                ))
+                return
+            hostpath = self._host(path)
+            if hostpath in seen:
+                exc = CircularLink(self.path, path, chain=chain + [path])
+                self.circular = exc.start
+                debug(exc)
+                raise exc
+            seen.add(hostpath)
+            chain.append(path)
+            yield path
+
+    def _get_filetype(self, path=None):
+        """ Determine a file's type like the `file` command. """
+        path = path or self.path
+        hostpath = self._host(path)
+        if self.read_size:
+            ftype = self._get_filetype_prefix(hostpath)
+            if ftype is not None:
+                return ftype
+        if self.use_elf and self.stats.lexists(hostpath) and (
+                not self.stats.isdir(hostpath)):
+            self.elf = ElfInfo.from_file(hostpath)
+            if (self.elf is not None) and (not self.use_mime):
+                # No need for a full libmagic pass.
+                return self.elf.describe()
+        try:
+            ftype = magic.from_file(hostpath, mime=self.use_mime)
+        except EnvironmentError as ex:
+            if ex.errno == 40:
+                # Circular symlink, this should already be caught in
+                # _follow_links, which is called before this in _resolve.
+                debug('_get_filetype: Magic error: {}\n{}'.format(path, ex))
+                exc = CircularLink(self.path, path)
+                self.circular = exc.start
+            debug('_get_filetype: Magic error: {}\n{}'.format(path, ex))
+            if self.broken:
+                return '<broken link to: {}>'.format(path)
+            ftype = None
+        if ftype is None and self.stats.isdir(hostpath):
+            ftype = 'directory'
+
+        return ftype or '<unknown>'
+
+    def _get_filetype_prefix(self, hostpath):
+        """ Determine a regular file's type from the first `read_size`
+            bytes, through libmagic's buffer API.
+            Returns None for anything that isn't a readable regular file.
+        """
+        st = self.stats.stat(hostpath)
+        if (st is None) or (not stat.S_ISREG(st.st_mode)):
+            return None
+        data = self._prefix = self._read_prefix(hostpath, self.read_size)
+        if data is None:
+            return None
+        if self.use_elf:
+            self.elf = ElfInfo.from_buffer(hostpath, data)
+            if (self.elf is not None) and (not self.use_mime):
+                return self.elf.describe()
+        return magic.from_buffer(data, mime=self.use_mime) or '<unknown>'
+
+    def _host(self, path):
+        """ Return the path to use on the host for `path`, which is only
+            different when resolving inside a root directory.
+        """
+        return path if self.root is None else self.root.host(path)
+
+    def _locate(self, ignore_cwd=False, env_path=None, watchdog=None):
+        """ If this is not an absolute path, it will try to locate it
+            in one of the PATH dirs (or `env_path` dirs).
+            Dirs that don't pass the DirWatchdog `watchdog` are skipped.
+            Sets self.path, and returns the full absolute path on success.
+            Returns None for non-existing paths.
+        """
+        if self.root is not None:
+            # There is no CWD inside the root.
+            ignore_cwd = os.path.sep not in self.path
+        if self._exists(self.path):
+            debug('_locate(\'{p}\') = {p}'.format(p=self.path))
+            if not ignore_cwd:
+                self.exists = True
+                return self.path
+            debug('_locate(\'{p}\'): Ignoring CWD...'.format(p=self.path))
+
+        debug('_locate(\'{}\'): Not in CWD...'.format(self.path))
+
+        dirs = self.get_env_path() if env_path is None else env_path
+        for dirpath in dirs:
+            if (watchdog is not None) and not watchdog.check(
+                    self._host(dirpath)):
+                continue
+            trypath = os.path.join(dirpath, self.path)
+            if self.root is not None:
+                trypath = self.root.normpath(trypath)
+            if self._exists(trypath):
+                debug('_locate(\'{}\') = {}'.format(self.path, trypath))
+                self.path = trypath
+                self.exists = True
+                return self.path
+
+        debug('_locate(\'{}\') failed!'.format(self.path))
+        self.exists = False
+        return None
+
+    def _resolve(self, types=None):
+        """ Resolve this path, following symlinks, determining file type,
+            and filling in attributes along the way.
+            File types are reused from (and saved in) `types`, if given.
+        """
+        debug('Resolving: {}'.format(self.path))
+        try:
+            self.symlink_to = [p for p in self._follow_links()]
+        except CircularLink as ex:
+            self.symlink_to = ex.chain[1:]
+            symlink_len = len(self.symlink_to)
+            self.filetype = '<circular link: {} {} deep>'.format(
+                symlink_len,
+                'level' if symlink_len == 1 else 'levels',
+            )
+            self.target = self.path
+        else:
+            if self.symlink_to:
+                self.target = self.symlink_to[-1]
+            key = (self._host(self.target), self.use_mime, self.use_elf)
+            known = None if types is None else types.get(key, None)
+            if known is not None:
+                self.filetype, self.elf = known
+            else:
+                self.filetype = self._get_filetype(self.target)
+                try:
+                    # For old libmagic versions, the info will not be as
+                    # good.
+                    self.filetype = self.filetype.decode()
+                except AttributeError:
+                    pass
+                if (types is not None) and not (self.broken or self.circular):
+                    types[key] = (self.filetype, self.elf)
+        if self.filetype == 'directory':
+            self.target = os.path.abspath(self.target or self.path)
+        self.resolved = True
+
+    def _resolve_interpreter(self, interpreters, **kwargs):
+        """ Read the #! line for the target, and resolve the interpreter
+            through $PATH (for `env`) and any symlinks.
+            Results are memoized in the `interpreters` dict.
+        """
+        self.shebang = self._read_shebang()
+        if not self.shebang:
+            return
+        interp, cmd = parse_shebang(self.shebang)
+        key = (interp, cmd)
+        resolved = interpreters.get(key, None)
+        if resolved is None:
+            with self._interpreter_lock:
+                resolved = self._resolve_interpreter_key(
+                    interpreters,
+                    key,
+                    **kwargs
+                )
+        if (resolved is not None) and resolved.exists:
+            self.interpreter = resolved
+
+    def _resolve_interpreter_key(self, interpreters, key, **kwargs):
+        """ Resolve an (interpreter, env command) key from
+            parse_shebang(), and memoize it in `interpreters`.
+            This must be called with _interpreter_lock held, so other
+            threads wait for the result instead of seeing the None
+            placeholder. Only the resolving thread can see it, and only
+            for a circular #!, where None is returned.
+        """
+        if key in interpreters:
+            # Finished by another thread while waiting for the lock, or
+            # still being resolved by this one.
+            return interpreters[key]
+        interpreters[key] = None
+        interp, cmd = key
+        if cmd is None:
+            resolved = type(self)(
+                interp,
+                use_mime=self.use_mime,
+                max_width=self.max_width,
+                stats=self.stats,
+                elf=self.use_elf,
+                interpreters=interpreters,
+                root=self.root,
+                read_size=self.read_size,
+                **kwargs
+            )
+        else:
+            # `env` only looks in $PATH.
+            resolved = type(self)(
+                cmd,
+                use_mime=self.use_mime,
+                ignore_cwd=os.path.sep not in cmd,
+                max_width=self.max_width,
+                stats=self.stats,
+                elf=self.use_elf,
+                interpreters=interpreters,
+                root=self.root,
+                read_size=self.read_size,
+                **kwargs
+            )
+        # Missing interpreters are kept too, so they are never None once
+        # they are finished.
+        interpreters[key] = resolved
+        return resolved
+
+    def _read_prefix(self, hostpath, size):
+        """ Read the first `size` bytes of a file with read_prefix(),
+            and add them to `bytes_read`. Returns None on errors.
+        """
+        try:
+            data = read_prefix(hostpath, size)
+        except OSError as ex:
+            debug('Cannot read prefix of: {}\n{}'.format(hostpath, ex))
+            return None
+        self.bytes_read = (self.bytes_read or 0) + len(data)
+        return data
+
+    def _read_shebang(self):
+        """ Return the #! line for the target, if it is a regular file
+            with one.
+        """
+        st = self.stats.stat(self._host(self.target))
+        if (st is None) or (not stat.S_ISREG(st.st_mode)):
+            return None
+        if self.read_size:
+            data = self._prefix
+            if data is None:
+                data = self._read_prefix(
+                    self._host(self.target),
+                    min(self.read_size, 256),
+                )
+            return None if data is None else shebang_line(data[:256])
+        return read_shebang(self._host(self.target))
+
+    def as_dict(self):
+        """ A JSON-friendly dict for this resolved path. """
+        info = {
+            'type': 'file',
+            'path': self.path,
+            'exists': self.exists,
+            'broken': self.broken,
+            'circular': self.circular,
+            'symlink_to': list(self.symlink_to),
+            'target': self.target,
+            'filetype': self.filetype,
+        }
+        if self.hash_algorithm:
+            info['hash'] = {
+                'algorithm': self.hash_algorithm,
+                'digest': self.digest,
+            }
+        if self.elf is not None:
+            info['elf'] = self.elf.as_dict()
+        if self.bytes_read is not None:
+            info['bytes_read'] = self.bytes_read
+        if self.libraries is not None:
+            info['libraries'] = [lib.as_dict() for lib in self.libraries]
+        if self.packages is not None:
+            info['packages'] = self.packages
+        if self.privileges is not None:
+            info['privileges'] = self.privileges.as_dict()
+        if self.shebang:
+            info['shebang'] = self.shebang
+            info['interpreter'] = None if self.interpreter is None else (
+                self.interpreter.as_dict()
+            )
+        return info
+
+    @property
+    def digest(self):
+        """ Hex digest of the final target, or None if it wasn't hashed.
+            Waits for the hash to finish if it is still running.
+        """
+        if isinstance(self._digest, Future):
+            self._digest = self._digest.result()
+        return self._digest
+
+    def formatted(self, dir_only=False, short_mode=False):
+        """ Printable/colorized string representation of this resolved path.
+        """
+        if not self.exists:
+            return ''
+        if not self.resolved:
+            return str(self.path)
+
+        if dir_only:
+            return self.formatted_dir()
+        if short_mode:
+            return self.formatted_target()
+
+        lines = ['{}:{}'.format(
+            colr_str(self.path, **COLOR_ARGS['cmd']),
+            self._formatted_package(self.path, prefix=' '),
+        )]
+        indent = 4
+        linklen = len(self.symlink_to)
+        lastlink = linklen - 1
+        for i, symlink in enumerate(self.symlink_to):
+            linkstatus = ''
+            pkgstr = self._formatted_package(symlink)
+            if self.circular:
+                if symlink == self.circular:
+                    linkstatus = colr_str('⭠', fore='red', style='bright')
+                else:
+                    linkstatus = ''
+            elif self._broken(symlink):
+                linkstatus = colr_str('(broken)', fore='red')
+            elif not self._exists(symlink):
+                linkstatus = colr_str('(missing)', fore='red')
+            else:
+                symlink = colr_str(
+                    symlink,
+                    **COLOR_ARGS['target' if i == lastlink else 'link']
+                )
+            indention = ' ' * indent
+            if pkgstr:
+                linkstatus = ' '.join(s for s in (linkstatus, pkgstr) if s)
+            lines.append('{}⯈ {} {}'.format(indention, symlink, linkstatus))
+            indent += 4
+
+        # Indent some more for labels.
+        indent += 7
+        if self.resolved:
+            typelbl = 'Type:'.rjust(indent)
+            typeinfo = format_type_block(
+                self.filetype,
+                width=self.max_width,
+                prepend=' ' * (len(typelbl) + 1),
+            )
+            lines.append(
+                '{} {}'.format(
+                    typelbl,
+                    colr_str(typeinfo, **COLOR_ARGS['type'])
+                )
+            )
+        if self.hash_algorithm:
+            lines.append('{} {}:{}'.format(
+                'Hash:'.rjust(indent),
+                self.hash_algorithm,
+                colr_str(self.digest or '<not hashed>', **COLOR_ARGS['type']),
+            ))
+        if self.privileges is not None:
+            lines.append('{} {}'.format(
+                'Privs:'.rjust(indent),
+                self.privileges.formatted(),
+            ))
+        if self.bytes_read is not None:
+            lines.append('{} {}'.format(
+                'Read:'.rjust(indent),
+                colr_str(
+                    '{} {}'.format(
+                        self.bytes_read,
+                        'byte' if self.bytes_read == 1 else 'bytes',
+                    ),
+                    **COLOR_ARGS['type']
+                ),
+            ))
+        if self.shebang:
+            lines.append('{} {}'.format(
+                'Interp.:'.rjust(indent),
+                colr_str(self.shebang, **COLOR_ARGS['type']),
+            ))
+            if self.interpreter is None:
+                lines.append('{} {}'.format(
+                    ' ' * indent,
+                    colr_str('(missing)', fore='red'),
+                ))
+            else:
+                lines.extend(
+                    '{} {}'.format(' ' * indent, line)
+                    for line in self.interpreter.formatted().split('\n')
+                )
+        if self.libraries is not None:
+            lines.append('{} {}'.format(
+                'Libs:'.rjust(indent),
+                colr_str(
+                    '{} ({} missing)'.format(
+                        len(self.libraries),
+                        sum(1 for lib in self.libraries if lib.lib is None),
+                    ),
+                    **COLOR_ARGS['type']
+                ),
+            ))
+            for lib in self.libraries:
+                lines.extend(
+                    '{} {}'.format(' ' * indent, line)
+                    for line in lib.formatted().split('\n')
+                )
+        return '\n'.join(lines)
+
+    def _formatted_package(self, path, prefix=''):
+        """ Format the owning package for a path, if owners were looked up.
+            Returns '' when there is nothing to show.
+        """
+        if not self.packages:
+            return ''
+        return '{}[{}]'.format(
+            prefix,
+            colr_str(
+                self.packages.get(path, None) or 'no package',
+                **COLOR_ARGS['link']
+            ),
+        )
+
+    def formatted_dir(self):
+        """ Format the parent directory for self.target if it is set. """
+        if self.target:
+            pdir, _ = os.path.split(self.target)
+            if not pdir:
+                pdir = os.path.abspath(pdir)
+            return colr_str(pdir, **COLOR_ARGS['target'])
+        return ''
+
+    def formatted_target(self):
+        """ Formats self.target if it is set.
+            Broken links will have 'dead:' prepended to them,
+            circular links will have 'circular' prepended to them.
+            If the target was hashed, the digest comes first, like the
+            output of `sha256sum`.
+        """
+        if self.target and self.digest:
+            return '{}  {}'.format(
+                self.digest,
+                colr_str(self.target, **COLOR_ARGS['target']),
+            )
+        if self.target:
+            if self.broken:
+                msg = 'circular' if self.circular else 'dead'
+                return '{}:{}'.format(
+                    msg,
+                    colr_str(self.target, fore='red'),
+                )
+            return colr_str(self.target, **COLOR_ARGS['target'])
+        return ''
+
+    @classmethod
+    def get_env_path(cls):
+        """ Return a tuple of dirs in $PATH. """
+        return tuple(
+            path for path in
+            (s.strip() for s in os.environ.get('PATH', '').split(':'))
+            if path
+        )
+
+    def print_all(self):
+        """ Prints str(self) if it's not an empty string. """
+        info = str(self)
+        if info:
+            print('\n{}'.format(info))
+
+    def print_dir(self, end='\n'):
+        """ Prints the parent directory for self.target if it is set. """
+        s = self.formatted_dir()
+        if s:
+            print(s, end=end)
+
+    def print_target(self, end='\n'):
+        """ Prints self.target if it is set.
+            Broken links will have 'dead:' prepended to them,
+            circular links will have 'circular' prepended to them.
+        """
+        s = self.formatted_target()
+        if s:
+            print(s, end=end)
+
+
+class ResolvedMember(ResolvedPath):
+    """ A ResolvedPath for a member of a tar archive. `root` must be a
+        TarIndex. File types come from a bounded prefix of each member's
+        data, through libmagic's buffer API.
+    """
+    __slots__ = ()
+
+    def _get_filetype(self, path=None):
+        """ Determine a member's type like the `file` command. """
+        path = path or self.path
+        hostpath = self._host(path)
+        st = self.stats.stat(hostpath)
+        if st is None:
+            if self.broken:
+                return '<broken link to: {}>'.format(path)
+            return '<unknown>'
+        if stat.S_ISDIR(st.st_mode):
+            return 'inode/directory' if self.use_mime else 'directory'
+        data = self.stats.prefix(hostpath)
+        if data is None:
+            return TarMembers.describe_mode(st.st_mode, mime=self.use_mime)
+        return magic.from_buffer(data, mime=self.use_mime) or '<unknown>'
+
+    def _read_shebang(self):
+        """ Return the #! line for the target, from the member's data. """
+        return shebang_line(
+            (self.stats.prefix(self._host(self.target)) or b'')[:256]
+        )
+
+    def as_dict(self):
+        """ A JSON-friendly dict for this resolved member. """
+        info = super().as_dict()
+        info['archive'] = self.root.filename
+        hardlink = self.stats.hardlinks.get(self._host(self.target), None)
+        if hardlink is not None:
+            info['hardlink_to'] = hardlink
+        return info
+
+
+class RootFS(object):
+    """ An alternate root directory (like an extracted container image or
+        chroot), for resolving paths without chrooting.
+        Paths inside the root are absolute, like: /usr/bin/ls
+        Symlinks in directory components are resolved inside the root, so
+        absolute links and `..` can never reach the host's files.
+        The stat cache and PATH index are shared by everything resolved
+        inside this root.
+    """
+    # Maximum number of symlinks to follow for a single directory.
+    max_links = 40
+
+    def __init__(self, root, stats=None):
+        self.root = os.path.abspath(root)
+        if not os.path.isdir(self.root):
+            raise InvalidArg('root is not a directory: {}'.format(root))
+        self.stats = StatCache() if stats is None else stats
+        # {dir inside root: resolved dir inside root}
+        self._dirs = {'/': '/'}
+        self._path_index = None
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.root)
+
+    def _hostpath(self, path):
+        """ Host path for a path inside the root, with no symlinks in it.
+        """
+        return '{}{}'.format(self.root, path)
+
+    def broken(self, path):
+        """ Determine if a path inside the root is a broken link, without
+            letting the host follow links outside of the root.
+        """
+        if not self.stats.islink(self.host(path)):
+            return False
+        target = self.realpath(path)
+        return (target is None) or (not self.stats.lexists(self.host(target)))
+
+    def readlink(self, path):
+        """ Return the target of a link inside the root, as a normalized
+            absolute path inside the root.
+            Raises OSError if the path is not a link.
+        """
+        link = self.stats.readlink(self.host(path))
+        return self.normpath(posixpath.join(posixpath.dirname(path), link))
+
+    def realpath(self, path):
+        """ Follow all links for a path inside the root, and return the
+            final path. Returns None for circular links.
+        """
+        for _ in range(self.max_links):
+            try:
+                path = self.readlink(path)
+            except OSError:
+                return path
+        return None
+
+    def host(self, path):
+        """ Return the host path for an absolute path inside the root.
+            Directory symlinks are resolved inside the root, the final
+            component is left alone.
+        """
+        path = self.normpath(path)
+        if path == '/':
+            return self.root
+        dirpath, name = posixpath.split(path)
+        return self._hostpath(posixpath.join(self.resolve_dir(dirpath), name))
+
+    def listdir(self, dirpath):
+        """ List the names in a directory inside the root.
+            Raises OSError for missing directories.
+        """
+        return os.listdir(self.host(dirpath))
+
+    @staticmethod
+    def normpath(path):
+        """ Normalize a path inside the root, `..` stops at the root. """
+        # posixpath.normpath() keeps a leading '//'.
+        return '/{}'.format(
+            posixpath.normpath(posixpath.join('/', path)).lstrip('/')
+        )
+
+    @property
+    def path_class(self):
+        """ The ResolvedPath class to use for paths inside this root. """
+        return ResolvedPath
+
+    @property
+    def path_index(self):
+        """ A PathIndex for $PATH inside this root, built on first use. """
+        if self._path_index is None:
+            self._path_index = PathIndex(root=self)
+        return self._path_index
+
+    def resolve_dir(self, dirpath, depth=0):
+        """ Resolve symlinks in every component of a directory inside the
+            root, and return the real directory (inside the root).
+        """
+        resolved = self._dirs.get(dirpath, None)
+        if resolved is not None:
+            return resolved
+        parent, name = posixpath.split(dirpath)
+        candidate = posixpath.join(self.resolve_dir(parent, depth), name)
+        hostpath = self._hostpath(candidate)
+        resolved = candidate
+        if self.stats.islink(hostpath) and (depth < self.max_links):
+            try:
+                link = self.stats.readlink(hostpath)
+            except OSError:
+                pass
+            else:
+                resolved = self.resolve_dir(
+                    self.normpath(
+                        posixpath.join(posixpath.dirname(candidate), link)
+                    ),
+                    depth + 1,
+                )
+        self._dirs[dirpath] = resolved
+        return resolved
+
+
+class TarIndex(RootFS):
+    """ A tar archive (or container image layer) used like a RootFS,
+        without extracting anything. The archive is read once, as a
+        stream, into a TarMembers table that stands in for the StatCache.
+    """
+    def __init__(self, filename, prefix_size=None):
+        """
+            Arguments:
+                filename (str)    : Archive to read, or '-' for stdin.
+                                    Compression is detected by tarfile.
+                prefix_size (int) : Bytes of data to keep for each
+                                    regular file, for file types.
+                                    Default: TarMembers.prefix_size
+        """
+        self.filename = filename
+        # Used for fingerprints and repr(), archive paths are not
+        # prefixed with anything.
+        self.root = filename
+        self.stats = TarMembers(filename, prefix_size=prefix_size)
+        # Links inside the archive are followed with this index.
+        self.stats.root = self
+        self._dirs = {'/': '/'}
+        self._path_index = None
+
+    def _hostpath(self, path):
+        """ Archive paths are used as-is, there is no host directory. """
+        return path
+
+    def host(self, path):
+        """ Return the archive path for `path`, with directory symlinks
+            resolved inside the archive.
+        """
+        path = self.normpath(path)
+        return path if path == '/' else super().host(path)
+
+    def listdir(self, dirpath):
+        """ List the names in a directory inside the archive.
+            Raises OSError for missing directories.
+        """
+        hostpath = self.host(dirpath)
+        if not self.stats.isdir(hostpath):
+            raise OSError(errno.ENOTDIR, 'Not an archive directory', dirpath)
+        return self.stats.children.get(hostpath, [])
+
+    def names(self):
+        """ Yield every path in the archive that isn't a directory,
+            in archive order.
+        """
+        for path, st in self.stats.members.items():
+            if not stat.S_ISDIR(st.st_mode):
+                yield path
+
+    @property
+    def path_class(self):
+        """ The ResolvedPath class to use for archive members. """
+        return ResolvedMember
+
+
+class StatCache(object):
+    """ Per-run cache of lstat() and stat() results, so each path is only
+        stat'ed once. Failed calls are cached as None.
+        Link, directory, and broken-link checks are answered from the
+        cached results.
+    """
+    def __init__(self):
+        self._lstats = {}
+        self._stats = {}
+        self._links = {}
+
+    def __repr__(self):
+        return '{}(lstats={}, stats={}, links={})'.format(
+            type(self).__name__,
+            len(self._lstats),
+            len(self._stats),
+            len(self._links),
+        )
+
+    def broken(self, path):
+        """ Like: os.path.islink(path) and not os.path.exists(path) """
+        return self.islink(path) and (self.stat(path) is None)
+
+    def clear(self):
+        """ Forget all cached results. """
+        self._lstats.clear()
+        self._stats.clear()
+        self._links.clear()
+
+    def exists(self, path):
+        """ Like os.path.exists(). """
+        return self.stat(path) is not None
+
+    def isdir(self, path):
+        """ Like os.path.isdir(). """
+        st = self.stat(path)
+        return (st is not None) and stat.S_ISDIR(st.st_mode)
+
+    def islink(self, path):
+        """ Like os.path.islink(). """
+        st = self.lstat(path)
+        return (st is not None) and stat.S_ISLNK(st.st_mode)
+
+    def lexists(self, path):
+        """ Like os.path.lexists(), True for existing broken links. """
+        return self.lstat(path) is not None
+
+    def lstat(self, path):
+        """ Return a cached os.lstat() result, or None if it failed. """
+        try:
+            return self._lstats[path]
+        except KeyError:
+            pass
+        try:
+            st = os.lstat(path)
+        except (OSError, ValueError):
+            st = None
+        self._lstats[path] = st
+        return st
+
+    def readlink(self, path):
+        """ Return a cached os.readlink() result.
+            Raises OSError (every time) if the path is not a link.
+        """
+        try:
+            target = self._links[path]
+        except KeyError:
+            if not self.islink(path):
+                target = None
+            else:
+                try:
+                    target = os.readlink(path)
+                except OSError:
+                    target = None
+            self._links[path] = target
+        if target is None:
+            raise OSError(errno.EINVAL, 'Not a symlink', path)
+        return target
+
+    def stat(self, path):
+        """ Return a cached os.stat() result, or None if it failed.
+            For anything that isn't a symlink, the lstat() result is used.
+        """
+        try:
+            return self._stats[path]
+        except KeyError:
+            pass
+        st = self.lstat(path)
+        if (st is not None) and stat.S_ISLNK(st.st_mode):
+            try:
+                st = os.stat(path)
+            except (OSError, ValueError):
+                st = None
+        self._stats[path] = st
+        return st
+
+
+class TarMembers(StatCache):
+    """ A StatCache that answers from the headers of a tar archive,
+        which is read once as a stream. Nothing is extracted.
+        Symlink targets and hardlinks come from the member headers, and
+        a bounded prefix of each regular file's data is kept for libmagic.
+        Later members replace earlier ones, like they would when
+        extracting. Whiteout files (.wh.*) from image layers are skipped.
+    """
+    # Default number of bytes to keep from the start of each file.
+    prefix_size = 2048
+    # File types for members that have no data.
+    mode_types = (
+        (stat.S_ISCHR, 'character special', 'inode/chardevice'),
+        (stat.S_ISBLK, 'block special', 'inode/blockdevice'),
+        (stat.S_ISFIFO, 'fifo (named pipe)', 'inode/fifo'),
+        (stat.S_ISSOCK, 'socket', 'inode/socket'),
+    )
+
+    def __init__(self, filename, prefix_size=None):
+        self.filename = filename
+        if prefix_size is not None:
+            self.prefix_size = max(prefix_size, 0)
+        # Set to a TarIndex to follow symlinks in stat().
+        self.root = None
+        # {path: os.stat_result}, in archive order.
+        self.members = {}
+        # {symlink path: link target}
+        self.links = {}
+        # {hardlink path: path of the member it links to}
+        self.hardlinks = {}
+        # {regular file path: bytes}
+        self.prefixes = {}
+        # {directory path: [name, ...]}
+        self.children = {}
+        self._build()
+
+    def __repr__(self):
+        return '{}({!r}, members={}, links={}, hardlinks={})'.format(
+            type(self).__name__,
+            self.filename,
+            len(self.members),
+            len(self.links),
+            len(self.hardlinks),
+        )
+
+    def _add(self, path, st):
+        """ Add a member, and any missing parent directories. """
+        if path not in self.members:
+            dirpath, name = posixpath.split(path)
+            if (name and (dirpath not in self.members)):
+                self._add(
+                    dirpath,
+                    os.stat_result((stat.S_IFDIR | 0o755,) + (0,) * 9),
+                )
+            if name:
+                self.children.setdefault(dirpath, []).append(name)
+        self.members[path] = st
+
+    def _build(self):
+        """ Read the archive as a stream, and fill in the member tables.
+        """
+        try:
+            if self.filename == '-':
+                tar = tarfile.open(fileobj=sys.stdin.buffer, mode='r|*')
+            else:
+                tar = tarfile.open(self.filename, mode='r|*')
+        except (OSError, tarfile.TarError) as ex:
+            raise InvalidArg('cannot read archive: {}: {}'.format(
+                self.filename,
+                ex,
+            ))
+        self._add('/', os.stat_result((stat.S_IFDIR | 0o755,) + (0,) * 9))
+        with tar:
+            try:
+                for ino, info in enumerate(tar, start=1):
+                    self._build_member(tar, ino, info)
+            except (OSError, tarfile.TarError) as ex:
+                raise InvalidArg('cannot read archive: {}: {}'.format(
+                    self.filename,
+                    ex,
+                ))
+        debug('Read archive: {!r}'.format(self))
+
+    def _build_member(self, tar, ino, info):
+        """ Add a single member from the archive stream. """
+        path = RootFS.normpath(info.name)
+        if posixpath.basename(path).startswith('.wh.'):
+            return
+        # Replaced members don't keep any of their old data.
+        self.links.pop(path, None)
+        self.hardlinks.pop(path, None)
+        self.prefixes.pop(path, None)
+        if info.islnk():
+            target = RootFS.normpath(info.linkname)
+            st = self.members.get(target, None)
+            if st is not None:
+                # Same inode, same data (and the same link target, for
+                # hardlinked symlinks).
+                self.hardlinks[path] = self.hardlinks.get(target, target)
+                if target in self.links:
+                    self.links[path] = self.links[target]
+                if target in self.prefixes:
+                    self.prefixes[path] = self.prefixes[target]
+                self._add(path, st)
+                return
+            debug('Hardlink to missing member: {} -> {}'.format(
+                path,
+                target,
+            ))
+        if info.issym():
+            self.links[path] = info.linkname
+            typebits = stat.S_IFLNK
+        elif info.isdir():
+            typebits = stat.S_IFDIR
+        elif info.ischr():
+            typebits = stat.S_IFCHR
+        elif info.isblk():
+            typebits = stat.S_IFBLK
+        elif info.isfifo():
+            typebits = stat.S_IFIFO
+        else:
+            typebits = stat.S_IFREG
+            if info.isreg():
+                f = tar.extractfile(info)
+                self.prefixes[path] = f.read(self.prefix_size) if f else b''
+            else:
+                # A hardlink to a missing member has no data here.
+                self.prefixes[path] = b''
+        self._add(path, os.stat_result((
+            typebits | stat.S_IMODE(info.mode),
+            ino,
+            0,
+            1,
+            info.uid,
+            info.gid,
+            info.size if typebits == stat.S_IFREG else 0,
+            info.mtime,
+            info.mtime,
+            info.mtime,
+        )))
+
+    def clear(self):
+        """ Members are only read once, there is nothing to forget. """
+        return None
+
+    @classmethod
+    def describe_mode(cls, mode, mime=False):
+        """ Describe a member with no data (devices, fifos), from its
+            mode alone.
+        """
+        for check, desc, mimetype in cls.mode_types:
+            if check(mode):
+                return mimetype if mime else desc
+        return '<unknown>'
+
+    def lstat(self, path):
+        """ Return the stat result for a member, or None if it is not in
+            the archive.
+        """
+        return self.members.get(path, None)
+
+    def prefix(self, path):
+        """ Return the first bytes of a regular file's data, or None for
+            anything else.
+        """
+        return self.prefixes.get(path, None)
+
+    def readlink(self, path):
+        """ Return the link target for a symlink member.
+            Raises OSError if the path is not a symlink.
+        """
+        try:
+            return self.links[path]
+        except KeyError:
+            raise OSError(errno.EINVAL, 'Not a symlink', path)
+
+    def stat(self, path):
+        """ Return the stat result for a member, following symlinks inside
+            the archive (when `self.root` is set).
+        """
+        st = self.lstat(path)
+        if (st is None) or (not stat.S_ISLNK(st.st_mode)):
+            return st
+        if self.root is None:
+            return None
+        target = self.root.realpath(path)
+        return None if target is None else self.lstat(self.root.host(target))
+
+
+class ResultStore(object):
+    """ Compact storage for large numbers of ResolvedPath results.
+        Paths are split into interned directories and base names, link
+        chains are stored as indexes into a shared path table, and file
+        types are deduplicated through a symbol table.
+        Options like `use_mime` and `max_width` are stored once, here,
+        instead of on every result.
+    """
+    def __init__(self, use_mime=False, max_width=0, stats=None, root=None):
+        """
+            Arguments:
+                use_mime (bool)   : Results use mime types.
+                max_width (int)   : Maximum width for type strings.
+                stats (StatCache) : Stat cache used to format results.
+                root (RootFS)     : Results are inside this root.
+        """
+        self.use_mime = use_mime or False
+        self.max_width = max(max_width or 0, 0)
+        self.root = root
+        if stats is None:
+            stats = StatCache() if root is None else root.stats
+        self.stats = stats
+        # Set when hashed results are added.
+        self.hash_algorithm = None
+        # Directory table, and {dirpath: index}.
+        self.dirs = []
+        self._dir_ids = {}
+        # Path table of (dir_index, basename), and {(dir_index, basename):
+        # index}.
+        self.paths = []
+        self._path_ids = {}
+        # File type table, and {filetype: index}.
+        self.symbols = []
+        self._symbol_ids = {}
+        self.records = []
+        # Results are added from resolver threads, see: _intern()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, index):
+        return self.records[index]
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __repr__(self):
+        return '{}(records={}, paths={}, dirs={}, symbols={})'.format(
+            type(self).__name__,
+            len(self.records),
+            len(self.paths),
+            len(self.dirs),
+            len(self.symbols),
+        )
+
+    def _intern(self, table, ids, value):
+        """ Return the index for `value` in `table`, adding it if needed. """
+        with self._lock:
+            index = ids.get(value, None)
+            if index is None:
+                index = ids[value] = len(table)
+                table.append(value)
+        return index
+
+    def add(self, resolved):
+        """ Store a ResolvedPath, and return it's compact StoredPath record.
+        """
+        flags = 0
+        if resolved.exists:
+            flags |= StoredPath.EXISTS
+        if resolved.broken:
+            flags |= StoredPath.BROKEN
+        if resolved.resolved:
+            flags |= StoredPath.RESOLVED
+        record = StoredPath(
+            self,
+            self.path_id(resolved.path),
+            tuple(self.path_id(p) for p in resolved.symlink_to),
+            -1 if resolved.target is None else self.path_id(resolved.target),
+            -1 if resolved.filetype is None else self._intern(
+                self.symbols,
+                self._symbol_ids,
+                resolved.filetype,
+            ),
+            -1 if not resolved.circular else self.path_id(resolved.circular),
+            flags,
+            # The hash may still be running, it is finished when needed.
+            digest=resolved._digest,
+            elf=resolved.elf,
+            shebang=resolved.shebang,
+            interpreter=resolved.interpreter,
+            packages=resolved.packages,
+            libraries=resolved.libraries,
+            privileges=resolved.privileges,
+            bytes_read=resolved.bytes_read,
+        )
+        with self._lock:
+            if resolved.hash_algorithm:
+                self.hash_algorithm = resolved.hash_algorithm
+            self.records.append(record)
+        return record
+
+    def path(self, index):
+        """ Return the full path for a path index, or None for -1. """
+        if index < 0:
+            return None
+        dirindex, name = self.paths[index]
+        if dirindex < 0:
+            return name
+        return os.path.join(self.dirs[dirindex], name)
+
+    def path_id(self, path):
+        """ Return the index for a path, adding it to the path table if
+            needed.
+        """
+        dirpath, name = os.path.split(path)
+        dirindex = -1
+        if dirpath:
+            dirindex = self._intern(
+                self.dirs,
+                self._dir_ids,
+                sys.intern(dirpath),
+            )
+        # The (dir_index, basename) key is shared with the path table, so
+        # full path strings are never kept.
+        return self._intern(
+            self.paths,
+            self._path_ids,
+            (dirindex, sys.intern(name)),
+        )
+
+    def symbol(self, index):
+        """ Return the file type string for a symbol index. """
+        return None if index < 0 else self.symbols[index]
+
+
+class StoredPath(object):
+    """ A compact, read-only ResolvedPath record held by a ResultStore. """
+    __slots__ = (
+        'store',
+        'path_id',
+        'chain',
+        'target_id',
+        'type_id',
+        'circular_id',
+        'flags',
+        '_digest',
+        'elf',
+        'shebang',
+        'interpreter',
+        'packages',
+        'libraries',
+        'privileges',
+        'bytes_read',
+    )
+    # Bit flags for `flags`.
+    EXISTS = 1
+    BROKEN = 2
+    RESOLVED = 4
+
+    def __init__(
+            self, store, path_id, chain, target_id, type_id, circular_id,
+            flags, digest=None, elf=None, shebang=None, interpreter=None,
+            packages=None, libraries=None, privileges=None,
+            bytes_read=None):
+        self.store = store
+        self.path_id = path_id
+        self.chain = chain
+        self.target_id = target_id
+        self.type_id = type_id
+        self.circular_id = circular_id
+        self.flags = flags
+        # A hex digest, or a Future for one, see: digest
+        self._digest = digest
+        self.elf = elf
+        self.shebang = shebang
+        self.interpreter = interpreter
+        self.packages = packages
+        self.libraries = libraries
+        self.privileges = privileges
+        self.bytes_read = bytes_read
+
+    def __repr__(self):
+        return '{}(path={!r}, target={!r}, filetype={!r})'.format(
+            type(self).__name__,
+            self.path,
+            self.target,
+            self.filetype,
+        )
+
+    @property
+    def broken(self):
+        return bool(self.flags & self.BROKEN)
+
+    @property
+    def circular(self):
+        return self.store.path(self.circular_id)
+
+    @property
+    def digest(self):
+        """ Hex digest of the final target, see: ResolvedPath.digest """
+        if isinstance(self._digest, Future):
+            self._digest = self._digest.result()
+        return self._digest
+
+    @property
+    def exists(self):
+        return bool(self.flags & self.EXISTS)
+
+    @property
+    def filetype(self):
+        return self.store.symbol(self.type_id)
+
+    @property
+    def path(self):
+        return self.store.path(self.path_id)
+
+    @property
+    def resolved(self):
+        return bool(self.flags & self.RESOLVED)
+
+    @property
+    def symlink_to(self):
+        return [self.store.path(i) for i in self.chain]
+
+    @property
+    def target(self):
+        return self.store.path(self.target_id)
+
+    def as_dict(self):
+        """ A JSON-friendly dict, see: ResolvedPath.as_dict() """
+        return self.to_resolved().as_dict()
+
+    def formatted(self, dir_only=False, short_mode=False):
+        """ Printable/colorized string representation, see:
+            ResolvedPath.formatted()
+        """
+        return self.to_resolved().formatted(
+            dir_only=dir_only,
+            short_mode=short_mode,
+        )
+
+    def to_resolved(self):
+        """ Rebuild a full ResolvedPath from this record, without touching
+            the file system.
+        """
+        root = self.store.root
+        cls = ResolvedPath if root is None else root.path_class
+        resolved = cls.__new__(cls)
+        resolved.use_mime = self.store.use_mime
+        resolved.max_width = self.store.max_width
+        resolved.stats = self.store.stats
+        resolved.root = root
+        resolved.path = self.path
+        resolved.circular = self.circular
+        resolved.exists = self.exists
+        resolved.broken = self.broken
+        resolved.symlink_to = self.symlink_to
+        resolved.target = self.target
+        resolved.filetype = self.filetype
+        resolved.resolved = self.resolved
+        resolved._digest = self._digest
+        resolved._prefix = None
+        resolved.libraries = self.libraries
+        resolved.privileges = self.privileges
+        resolved.read_size = None
+        resolved.bytes_read = self.bytes_read
+        resolved.use_elf = self.elf is not None
+        resolved.elf = self.elf
+        resolved.shebang = self.shebang
+        resolved.interpreter = self.interpreter
+        resolved.packages = self.packages
+        resolved.hash_algorithm = self.store.hash_algorithm if (
+            self._digest is not None
+        ) else None
+        return resolved
+
+
+class Snapshot(object):
+    """ An SQLite inventory of what names resolve to, for tracking
+        changes across runs (or machines).
+        Each row keeps a stat identity for the name's path, links, and
+        the $PATH dirs that were searched to find it. A refresh only
+        resolves a name again when its identity has changed.
+    """
+    # Rows are written in batches of this size.
+    batch_size = 1000
+    schema = (
+        """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS names (
+            name TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            chain TEXT NOT NULL,
+            target TEXT NOT NULL,
+            filetype TEXT,
+            broken INTEGER NOT NULL,
+            circular TEXT,
+            dev INTEGER,
+            ino INTEGER,
+            size INTEGER,
+            mtime_ns INTEGER,
+            identity TEXT NOT NULL,
+            updated REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+        'CREATE INDEX IF NOT EXISTS names_target ON names (target)',
+    )
+    # Columns compared by diff(), besides the name.
+    diff_columns = ('path', 'chain', 'target', 'filetype')
+
+    def __init__(self, filename, root=None, stats=None):
+        """
+            Arguments:
+                filename (str) : SQLite file to create or update.
+                root (RootFS)  : Names are resolved inside this root.
+                stats (StatCache): Stat cache for identities.
+        """
+        self.filename = filename
+        self.root = root
+        if stats is None:
+            stats = StatCache() if root is None else root.stats
+        self.stats = stats
+        try:
+            self.db = sqlite3.connect(filename)
+            for sql in self.schema:
+                self.db.execute(sql)
+        except sqlite3.Error as ex:
+            raise InvalidArg('cannot open snapshot: {}: {}'.format(
+                filename,
+                ex,
+            ))
+
+    def __repr__(self):
+        return '{}({!r}, root={!r})'.format(
+            type(self).__name__,
+            self.filename,
+            self.root,
+        )
+
+    def _host(self, path):
+        """ Host path for a path that was resolved by this snapshot. """
+        return path if self.root is None else self.root.host(path)
+
+    @staticmethod
+    def _stat_id(st):
+        """ The parts of a stat result that change when a file does. """
+        if st is None:
+            return None
+        return (
+            st.st_dev,
+            st.st_ino,
+            st.st_mode,
+            st.st_size,
+            st.st_mtime_ns,
+            st.st_ctime_ns,
+        )
+
+    def _write(self, rows):
+        """ Write a batch of name rows, and empty the list.
+            Returns the number of rows written.
+        """
+        count = len(rows)
+        self.db.executemany(
+            'INSERT OR REPLACE INTO names VALUES ({})'.format(
+                ', '.join('?' * 13)
+            ),
+            rows,
+        )
+        del rows[:]
+        return count
+
+    def close(self):
+        """ Close the database. """
+        self.db.close()
+
+    @classmethod
+    def diff(cls, oldfile, newfile):
+        """ Compare two snapshot files, and yield a dict for each name
+            that changed, was added, or is gone, sorted by name.
+            The comparison is done by SQLite, with the primary key index
+            on both sides, so nothing is loaded into memory.
+        """
+        for filename in (oldfile, newfile):
+            if not os.path.isfile(filename):
+                raise InvalidArg('not a snapshot file: {}'.format(filename))
+        changed = ' OR '.join(
+            'o.{col} IS NOT n.{col}'.format(col=col)
+            for col in cls.diff_columns
+        )
+        columns = [
+            '{side}.{col}'.format(side=side, col=col)
+            for col in cls.diff_columns
+            for side in ('o', 'n')
+        ]
+        query = """
+            SELECT 'changed', o.name, {both}
+            FROM old.names o JOIN new.names n ON n.name = o.name
+            WHERE {changed}
+            UNION ALL
+            SELECT 'new', n.name, {new}
+            FROM new.names n
+            WHERE NOT EXISTS (SELECT 1 FROM old.names o WHERE o.name = n.name)
+            UNION ALL
+            SELECT 'gone', o.name, {old}
+            FROM old.names o
+            WHERE NOT EXISTS (SELECT 1 FROM new.names n WHERE n.name = o.name)
+            ORDER BY 2
+        """.format(
+            both=', '.join(columns),
+            new=', '.join(
+                'NULL' if c.startswith('o.') else c for c in columns
+            ),
+            old=', '.join(
+                'NULL' if c.startswith('n.') else c for c in columns
+            ),
+            changed=changed,
+        )
+        keys = ['change', 'name'] + [
+            '{side}_{col}'.format(side=side, col=col)
+            for col in cls.diff_columns
+            for side in ('old', 'new')
+        ]
+        db = sqlite3.connect(':memory:')
+        try:
+            db.execute('ATTACH DATABASE ? AS old', (oldfile,))
+            db.execute('ATTACH DATABASE ? AS new', (newfile,))
+            for row in db.execute(query):
+                change = dict(zip(keys, row))
+                for key in ('old_chain', 'new_chain'):
+                    if change[key] is not None:
+                        change[key] = json.loads(change[key])
+                yield change
+        except sqlite3.Error as ex:
+            raise InvalidArg('cannot compare snapshots: {}'.format(ex))
+        finally:
+            db.close()
+
+    def identity(self, name, path, chain):
+        """ Return a stat identity for a resolved name, from its path,
+            every link, and the $PATH dirs that were searched for it
+            (a new file in an earlier dir would shadow it).
+        """
+        parts = [
+            (p, self._stat_id(self.stats.lstat(self._host(p))))
+            for p in [path] + list(chain)
+        ]
+        if os.path.sep not in name:
+            dirpath = posixpath.dirname(path)
+            for searched in ResolvedPath.get_env_path():
+                parts.append((
+                    searched,
+                    self._stat_id(self.stats.stat(self._host(searched))),
+                ))
+                if posixpath.normpath(searched) == dirpath:
+                    break
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def refresh(self, names, resolve, jobs=1, prune=False):
+        """ Store names that are new, or whose stat identity changed.
+            `resolve(name)` must return a ResolvedPath, and is called
+            concurrently when `jobs` > 1. Names that don't resolve are
+            removed. With `prune`, names that aren't in `names` are
+            removed too.
+            Returns a dict of counts:
+                {'updated': n, 'removed': n, 'missing': n}
+        """
+        known = {
+            name: (path, chain, identity)
+            for name, path, chain, identity in self.db.execute(
+                'SELECT name, path, chain, identity FROM names'
+            )
+        }
+        stale = []
+        for name in names:
+            info = known.get(name, None)
+            if info is not None:
+                path, chain, identity = info
+                if self.identity(name, path, json.loads(chain)) == identity:
+                    continue
+            stale.append(name)
+        debug('Snapshot: {} of {} names are new or changed.'.format(
+            len(stale),
+            len(names),
+        ))
+        counts = {'updated': 0, 'removed': 0, 'missing': 0}
+        rows = []
+        gone = []
+        with self.db:
+            for name, r in zip(stale, iter_ordered(resolve, stale, jobs)):
+                if not r.exists:
+                    counts['missing'] += 1
+                    if name in known:
+                        gone.append((name,))
+                    continue
+                st = self.stats.lstat(self._host(r.target))
+                rows.append((
+                    name,
+                    r.path,
+                    json.dumps(r.symlink_to),
+                    r.target,
+                    r.filetype,
+                    int(bool(r.broken)),
+                    r.circular,
+                    None if st is None else st.st_dev,
+                    None if st is None else st.st_ino,
+                    None if st is None else st.st_size,
+                    None if st is None else st.st_mtime_ns,
+                    self.identity(name, r.path, r.symlink_to),
+                    time.time(),
+                ))
+                if len(rows) >= self.batch_size:
+                    counts['updated'] += self._write(rows)
+            counts['updated'] += self._write(rows)
+            if prune:
+                wanted = set(names)
+                gone.extend((name,) for name in known if name not in wanted)
+            self.db.executemany('DELETE FROM names WHERE name = ?', gone)
+            counts['removed'] = len(gone)
+            self.db.executemany(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                (
+                    ('version', VERSION),
+                    ('host', os.uname().nodename),
+                    ('path', os.environ.get('PATH', '')),
+                    ('root', None if self.root is None else self.root.root),
+                    ('updated', str(time.time())),
+                ),
+            )
+        return counts
+
+
+class DpkgIndex(object):
+    """ An index of {path: package} built from dpkg's *.list files, for
+        finding the package that owns a file without running `dpkg -S`.
+        Diverted files (dpkg-divert) and alternatives links
+        (update-alternatives) are included.
+        The index is cached on disk, and rebuilt when the modification
+        time of the dpkg info directory (or the diversions file, or the
+        alternatives directory) changes.
+    """
+    default_dir = '/var/lib/dpkg/info'
+    default_cache_dir = os.path.join(
+        os.environ.get('XDG_CACHE_HOME', None) or
+        os.path.expanduser('~/.cache'),
+        'whichfile',
+    )
+
+    def __init__(
+            self, infodir=None, cachedir=None, use_cache=True, root=None):
+        """
+            Arguments:
+                infodir (str)    : Directory with dpkg's *.list files.
+                                   Default: /var/lib/dpkg/info
+                                   (inside the root, when one is used)
+                cachedir (str)   : Directory for the cached index.
+                                   Default: ~/.cache/whichfile
+                use_cache (bool) : Whether to load/save the cached index.
+                root (RootFS)    : Packages are installed in this root.
+                                   Paths are resolved inside the root.
+        """
+        self.root = root
+        if (infodir is None) and (root is not None):
+            infodir = root.host(self.default_dir)
+        self.infodir = infodir or self.default_dir
+        # The dpkg admin dir, with the diversions file and alternatives.
+        self.admindir = os.path.dirname(self.infodir.rstrip(os.path.sep))
+        self.cachedir = cachedir or self.default_cache_dir
+        self.use_cache = use_cache
+        # Canonical directories, see: _canonical()
+        self._dirs = {}
+        try:
+            self.mtime_ns = os.stat(self.infodir).st_mtime_ns
+        except OSError as ex:
+            debug('No dpkg info dir: {}\n{}'.format(self.infodir, ex))
+            self.mtime_ns = None
+        # Cache key, with everything that the index is built from.
+        self.key = [self.mtime_ns]
+        for filepath in (self.diversions_file, self.alternatives_dir):
+            try:
+                self.key.append(os.stat(filepath).st_mtime_ns)
+            except OSError:
+                self.key.append(None)
+        self.owners = self._load()
+
+    def __contains__(self, path):
+        return self.owner(path) is not None
+
+    def __len__(self):
+        return len(self.owners)
+
+    def __repr__(self):
+        return '{}(infodir={!r}, paths={})'.format(
+            type(self).__name__,
+            self.infodir,
+            len(self.owners),
+        )
+
+    def _build(self):
+        """ Read every *.list file, and return {path: package}.
+            Directories (which are shared between packages) are skipped.
+            Diverted files and alternatives links are added, see:
+            _read_diversions() and _read_alternatives()
+        """
+        # {path: [package, ...]}
+        packages = {}
+        try:
+            entries = list(os.scandir(self.infodir))
+        except OSError as ex:
+            debug('Cannot read dpkg info dir: {}\n{}'.format(
+                self.infodir,
+                ex,
+            ))
+            return {}
+        for entry in entries:
+            if not entry.name.endswith('.list'):
+                continue
+            pkg = entry.name[:-5]
+            try:
+                with open(entry.path, 'r', errors='replace') as f:
+                    paths = f.read().splitlines()
+            except OSError as ex:
+                debug('Cannot read dpkg list: {}\n{}'.format(entry.path, ex))
+                continue
+            # The lists are sorted, directories come right before their
+            # contents.
+            for i, path in enumerate(paths):
+                nextpath = paths[i + 1] if i + 1 < len(paths) else ''
+                if nextpath.startswith(path.rstrip('/') + '/'):
+                    continue
+                pkgs = packages.setdefault(self._canonical(path), [])
+                if pkg not in pkgs:
+                    pkgs.append(pkg)
+        for frompath, topath, diverter in self._read_diversions():
+            frompath = self._canonical(frompath)
+            original = [
+                pkg for pkg in packages.get(frompath, ()) if pkg != diverter
+            ]
+            if original:
+                # The original package's file was moved here.
+                packages[self._canonical(topath)] = [
+                    '{} (diverted by {})'.format(
+                        ', '.join(original),
+                        diverter or 'local admin',
+                    )
+                ]
+            if diverter in packages.get(frompath, ()):
+                packages[frompath] = [diverter]
+            elif original:
+                # Whatever is there now isn't the original package's file.
+                del packages[frompath]
+        owners = {path: ', '.join(pkgs) for path, pkgs in packages.items()}
+        for path, name in self._read_alternatives():
+            owners.setdefault(
+                self._canonical(path),
+                'alternatives: {}'.format(name),
+            )
+        return owners
+
+    def _canonical(self, path):
+        """ Resolve symlinks in the directory part of a path, so /bin/ls and
+            /usr/bin/ls are the same on merged-/usr systems.
+            Inside a root, the root's own symlinks are used.
+        """
+        dirpath, name = os.path.split(path)
+        realdir = self._dirs.get(dirpath, None)
+        if realdir is None:
+            if self.root is None:
+                realdir = os.path.realpath(dirpath or '/')
+            else:
+                realdir = self.root.resolve_dir(
+                    self.root.normpath(dirpath)
+                )
+            self._dirs[dirpath] = realdir
+        return os.path.join(realdir, name)
+
+    def _read_alternatives(self):
+        """ Yield (path, name) for every link managed by
+            update-alternatives, and it's /etc/alternatives link.
+            Each alternatives file starts with the mode, the master link,
+            and then (name, link) pairs for slaves until a blank line.
+        """
+        try:
+            entries = list(os.scandir(self.alternatives_dir))
+        except OSError as ex:
+            debug('Cannot read alternatives dir: {}\n{}'.format(
+                self.alternatives_dir,
+                ex,
+            ))
+            return
+        for entry in entries:
+            try:
+                with open(entry.path, 'r', errors='replace') as f:
+                    lines = f.read().splitlines()
+            except OSError as ex:
+                debug('Cannot read alternatives: {}\n{}'.format(
+                    entry.path,
+                    ex,
+                ))
+                continue
+            if len(lines) < 2:
+                continue
+            links = [(entry.name, lines[1])]
+            slaves = lines[2:lines.index('')] if '' in lines else lines[2:]
+            links.extend(zip(slaves[::2], slaves[1::2]))
+            for name, link in links:
+                yield link, entry.name
+                yield os.path.join('/etc/alternatives', name), entry.name
+
+    def _read_diversions(self):
+        """ Return a list of (from, to, package) for every diversion.
+            The package is None for local diversions.
+            The diversions file has three lines for each one.
+        """
+        try:
+            with open(self.diversions_file, 'r', errors='replace') as f:
+                lines = f.read().splitlines()
+        except OSError as ex:
+            debug('No dpkg diversions: {}'.format(ex))
+            return []
+        return [
+            (frompath, topath, None if pkg == ':' else pkg)
+            for frompath, topath, pkg in zip(
+                lines[::3],
+                lines[1::3],
+                lines[2::3],
+            )
+        ]
+
+    @property
+    def alternatives_dir(self):
+        """ Directory with update-alternatives' state files. """
+        return os.path.join(self.admindir, 'alternatives')
+
+    @property
+    def cache_file(self):
+        """ File name for the cached index of this info directory. """
+        return os.path.join(
+            self.cachedir,
+            'dpkg-{}.json'.format(
+                hashlib.sha1(self.infodir.encode()).hexdigest()[:16]
+            ),
+        )
+
+    def _load(self):
+        """ Load the cached index if it is still fresh, otherwise build it
+            and save it for next time.
+        """
+        if self.mtime_ns is None:
+            return {}
+        if self.use_cache:
+            try:
+                with open(self.cache_file, 'r') as f:
+                    cached = json.load(f)
+            except (OSError, ValueError) as ex:
+                debug('No cached dpkg index: {}'.format(ex))
+            else:
+                if cached.get('key', None) == self.key:
+                    debug('Using cached dpkg index: {}'.format(
+                        self.cache_file
+                    ))
+                    return cached.get('owners', {})
+        owners = self._build()
+        if self.use_cache:
+            try:
+                os.makedirs(self.cachedir, exist_ok=True)
+                tmpfile = '{}.{}'.format(self.cache_file, os.getpid())
+                with open(tmpfile, 'w') as f:
+                    json.dump(
+                        {'key': self.key, 'owners': owners},
+                        f,
+                    )
+                os.replace(tmpfile, self.cache_file)
+            except OSError as ex:
+                debug('Cannot save dpkg index: {}'.format(ex))
+        return owners
+
+    @property
+    def diversions_file(self):
+        """ File with dpkg-divert's diversions. """
+        return os.path.join(self.admindir, 'diversions')
+
+    def owner(self, path):
+        """ Return the package that owns `path`, or None. """
+        if self.root is None:
+            path = os.path.abspath(path)
+        else:
+            path = self.root.normpath(path)
+        return self.owners.get(path, None) or self.owners.get(
+            self._canonical(path),
+            None
+        )
+
+
+class ShellCapture(object):
+    """ Aliases, functions, builtins, and keywords from a live BASH shell.
+        One interactive shell is started, so it reads .bashrc and anything
+        that sources, and it dumps everything at once. The results are
+        cached on disk, keyed by the environment and the startup files.
+    """
+    default_cache_dir = DpkgIndex.default_cache_dir
+    # Cached captures older than this are refreshed anyway, for files
+    # sourced from places that aren't checked, see: startup_files()
+    max_age = 3600
+    # Seconds to wait for the shell.
+    timeout = 10
+    marker = '@@whichfile:{}@@'
+    sections = ('aliases', 'functions', 'sources', 'builtins', 'keywords')
+    script = '; '.join((
+        "printf '\\n{m}\\n' aliases",
+        'alias -p',
+        "printf '\\n{m}\\n' functions",
+        'declare -f',
+        "printf '\\n{m}\\n' sources",
+        'shopt -s extdebug',
+        'while read -r _ _ f; do declare -F "$f"; done < <(declare -F)',
+        "printf '\\n{m}\\n' builtins",
+        'compgen -b',
+        "printf '\\n{m}\\n' keywords",
+        'compgen -k',
+        "printf '\\n{m}\\n' help",
+        'help -d $(compgen -b) $(compgen -k) 2>/dev/null',
+        "printf '\\n{m}\\n' end",
+    )).format(m=marker.format('%s'))
+    startup_files = (
+        '~/.bashrc',
+        '~/.bash_profile',
+        '~/.bash_login',
+        '~/.profile',
+        '~/.bash_aliases',
+        '/etc/bash.bashrc',
+        '/etc/bashrc',
+        '/etc/profile',
+    )
+
+    def __init__(self, env=None, cachedir=None, use_cache=True):
+        """
+            Arguments:
+                env (Environment) : Run the shell with this $PATH/$SHELL.
+                                    Default: the current environment.
+                cachedir (str)    : Directory for cached captures.
+                                    Default: ~/.cache/whichfile
+                use_cache (bool)  : Whether to load/save cached captures.
+        """
+        self.env = env or Environment('')
+        self.cachedir = cachedir or self.default_cache_dir
+        self.use_cache = use_cache
+        self.key = self.fingerprint()
+        # {name: alias line}
+        self.aliases = {}
+        # {name: function definition}
+        self.functions = {}
+        # {name: [lineno, file]}
+        self.sources = {}
+        self.builtins = set()
+        self.keywords = set()
+        # {name: first line of help}
+        self.help = {}
+        self._load()
+
+    def __repr__(self):
+        return '{}(env={!r}, aliases={}, functions={}, builtins={})'.format(
+            type(self).__name__,
+            self.env.name,
+            len(self.aliases),
+            len(self.functions),
+            len(self.builtins),
+        )
+
+    def _capture(self):
+        """ Run the shell, and return its output, or None on errors. """
+        shellenv = dict(os.environ)
+        shellenv['PATH'] = ':'.join(self.env.path)
+        shellenv['SHELL'] = self.env.shell
+        try:
+            proc = subprocess.run(
+                ['bash', '-i', '-c', self.script],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                env=shellenv,
+                timeout=self.timeout,
+            )
+        except (OSError, subprocess.SubprocessError) as ex:
+            debug('Cannot capture shell: {}'.format(ex))
+            return None
+        return proc.stdout.decode(errors='replace')
+
+    def _load(self):
+        """ Load a cached capture if it is still fresh, otherwise run the
+            shell and save the capture for next time.
+        """
+        cache_file = os.path.join(
+            self.cachedir,
+            'shell-{}.json'.format(self.key),
+        )
+        if self.use_cache:
+            try:
+                with open(cache_file, 'r') as f:
+                    cached = json.load(f)
+            except (OSError, ValueError) as ex:
+                debug('No cached shell capture: {}'.format(ex))
+            else:
+                if time.time() - cached.get('created', 0) < self.max_age:
+                    debug('Using cached shell capture: {}'.format(
+                        cache_file
+                    ))
+                    self._update(cached)
+                    return
+        output = self._capture()
+        if output is None:
+            return
+        captured = self.parse(output)
+        self._update(captured)
+        if self.use_cache:
+            captured['created'] = time.time()
+            try:
+                os.makedirs(self.cachedir, exist_ok=True)
+                tmpfile = '{}.{}'.format(cache_file, os.getpid())
+                with open(tmpfile, 'w') as f:
+                    json.dump(captured, f)
+                os.replace(tmpfile, cache_file)
+            except OSError as ex:
+                debug('Cannot save shell capture: {}'.format(ex))
+
+    def _update(self, captured):
+        """ Set attributes from a parsed (or cached) capture. """
+        self.aliases = captured.get('aliases', {})
+        self.functions = captured.get('functions', {})
+        self.sources = captured.get('sources', {})
+        self.builtins = set(captured.get('builtins', ()))
+        self.keywords = set(captured.get('keywords', ()))
+        self.help = captured.get('help', {})
+
+    def fingerprint(self):
+        """ Return a cache key for this environment and the current state
+            of the shell's startup files.
+        """
+        files = [os.path.expanduser(s) for s in self.startup_files]
+        files.extend(self.env.alias_files)
+        try:
+            files.extend(
+                entry.path for entry in os.scandir('/etc/profile.d')
+            )
+        except OSError:
+            pass
+        parts = [
+            ':'.join(self.env.path),
+            self.env.shell,
+            os.environ.get('HOME', ''),
+        ]
+        for filepath in sorted(files):
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                continue
+            parts.append((filepath, st.st_size, st.st_mtime_ns))
+        return hashlib.sha1(repr(parts).encode()).hexdigest()[:16]
+
+    def nameinfo(self, name):
+        """ Return a dict of {typename: resolved_object} for the aliases,
+            functions, builtins, and keywords named `name`.
+        """
+        nameinfo = {}
+        shell = self.env.shell or 'bash'
+        if name in self.aliases:
+            nameinfo['alias'] = Alias(shell, name, self.aliases[name])
+        elif name in self.functions:
+            lineno, filepath = self.sources.get(name, (None, shell))
+            typeinfo = self.functions[name]
+            if lineno:
+                typeinfo = 'line {}:\n{}'.format(lineno, typeinfo)
+            nameinfo['function'] = Function(filepath, name, typeinfo)
+        if name in self.keywords:
+            typestr = '{} is a shell keyword'
+        elif name in self.builtins:
+            typestr = '{} is a shell builtin'
+        else:
+            return nameinfo
+        nameinfo['builtin'] = Builtin(
+            name,
+            typestr.format(name),
+            helpmsg=self.help.get(name, ''),
+        )
+        return nameinfo
+
+    @classmethod
+    def parse(cls, output):
+        """ Parse the shell's output into a dict for each section.
+            Anything printed by the startup files, before the first
+            marker, is ignored.
+        """
+        lines = {}
+        section = None
+        markers = {cls.marker.format(s): s for s in cls.sections}
+        markers[cls.marker.format('help')] = 'help'
+        markers[cls.marker.format('end')] = None
+        for line in output.splitlines():
+            if line in markers:
+                if section and lines[section] and not lines[section][-1]:
+                    # The blank line printed before each marker.
+                    lines[section].pop()
+                section = markers[line]
+                lines.setdefault(section, [])
+            elif section is not None:
+                lines[section].append(line)
+
+        aliases = {}
+        lastname = None
+        for line in lines.get('aliases', ()):
+            if line.startswith('alias '):
+                lastname = line[6:].partition('=')[0]
+                aliases[lastname] = line
+            elif lastname is not None:
+                # A multi-line alias.
+                aliases[lastname] = '\n'.join((aliases[lastname], line))
+
+        functions = {}
+        body = None
+        for line in lines.get('functions', ()):
+            if body is None:
+                if line.rstrip().endswith(' ()'):
+                    name = line.rstrip()[:-3]
+                    body = [line.rstrip()]
+                continue
+            body.append(line)
+            if line == '}':
+                functions[name] = '\n'.join(body)
+                body = None
+
+        sources = {}
+        for line in lines.get('sources', ()):
+            name, _, rest = line.partition(' ')
+            lineno, _, filepath = rest.partition(' ')
+            if name and lineno.isdigit():
+                sources[name] = [int(lineno), filepath]
+
+        helpmsgs = {}
+        for line in lines.get('help', ()):
+            name, sep, msg = line.partition(' - ')
+            if sep and (name not in helpmsgs):
+                helpmsgs[name] = msg.strip()
+
+        return {
+            'aliases': aliases,
+            'functions': functions,
+            'sources': sources,
+            'builtins': [s for s in lines.get('builtins', ()) if s],
+            'keywords': [s for s in lines.get('keywords', ()) if s],
+            'help': helpmsgs,
+        }
+
+
+class BloomFilter(object):
+    """ A Bloom filter for str names. `name in bloom` is False only for
+        names that were never added, and rarely True for names that
+        weren't (about 1% of the time, with the default error rate).
+    """
+    def __init__(self, names=(), error_rate=0.01, bits=None, hashes=None):
+        """
+            Arguments:
+                names (list(str))  : Names to add, used for the size.
+                error_rate (float) : False positive rate to size for.
+                bits (bytes)       : A saved bit array, see: as_dict()
+                hashes (int)       : Number of hashes for saved bits.
+        """
+        if bits is not None:
+            self.bits = bytearray(bits)
+            self.hashes = hashes
+        else:
+            count = max(len(names), 1)
+            size = int(-count * math.log(error_rate) / (math.log(2) ** 2))
+            self.bits = bytearray(max(size // 8 + 1, 8))
+            self.hashes = max(
+                int(round(size / count * math.log(2))),
+                1,
+            )
+        self.size = len(self.bits) * 8
+        for name in names:
+            self.add(name)
+
+    def __contains__(self, name):
+        return all(
+            self.bits[i >> 3] & (1 << (i & 7))
+            for i in self._positions(name)
+        )
+
+    def __repr__(self):
+        return '{}(size={}, hashes={})'.format(
+            type(self).__name__,
+            self.size,
+            self.hashes,
+        )
+
+    def _positions(self, name):
+        """ Yield the bit positions for a name, using double hashing. """
+        digest = hashlib.blake2b(name.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, name):
+        """ Add a name to the filter. """
+        for i in self._positions(name):
+            self.bits[i >> 3] |= 1 << (i & 7)
+
+    def as_dict(self):
+        """ A JSON-friendly dict, see: from_dict() """
+        return {
+            'hashes': self.hashes,
+            'bits': base64.b64encode(bytes(self.bits)).decode(),
+        }
+
+    @classmethod
+    def from_dict(cls, info):
+        """ Load a filter saved with as_dict(). """
+        return cls(
+            bits=base64.b64decode(info['bits']),
+            hashes=info['hashes'],
+        )
+
+
+class BKTree(object):
+    """ A Burkhard-Keller tree of str words, to find every word within
+        an edit distance of a query without comparing it to all of them.
+        Distances are Levenshtein distances, computed with a bit-parallel
+        algorithm (Myers/Hyyrö) on Python ints.
+    """
+    def __init__(self, words=(), children=None):
+        """
+            Arguments:
+                words (list(str)) : Words to add, or saved words.
+                children (list)   : Saved children, see: as_dict()
+        """
+        self.words = []
+        # {distance: index} for each word, by index.
+        self.children = []
+        if children is not None:
+            self.words = list(words)
+            self.children = children
+            return
+        for word in words:
+            self.add(word)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __repr__(self):
+        return '{}(words={})'.format(type(self).__name__, len(self.words))
+
+    @staticmethod
+    def _bitmasks(word):
+        """ Return {char: bitmask} of the positions of each char. """
+        masks = {}
+        for i, c in enumerate(word):
+            masks[c] = masks.get(c, 0) | (1 << i)
+        return masks
+
+    @staticmethod
+    def distance(word, other, masks=None):
+        """ Return the Levenshtein distance between two words.
+            `masks` can be passed to reuse _bitmasks(word).
+        """
+        size = len(word)
+        if not size:
+            return len(other)
+        if masks is None:
+            masks = BKTree._bitmasks(word)
+        allbits = (1 << size) - 1
+        lastbit = 1 << (size - 1)
+        pv, mv, score = allbits, 0, size
+        for c in other:
+            eq = masks.get(c, 0)
+            xv = eq | mv
+            xh = (((eq & pv) + pv) ^ pv) | eq
+            ph = mv | ~(xh | pv)
+            mh = pv & xh
+            if ph & lastbit:
+                score += 1
+            elif mh & lastbit:
+                score -= 1
+            ph = (ph << 1) | 1
+            mh <<= 1
+            pv = (mh | ~(xv | ph)) & allbits
+            mv = ph & xv & allbits
+        return score
+
+    def add(self, word):
+        """ Add a word to the tree. """
+        if not self.words:
+            self.words.append(word)
+            self.children.append({})
+            return
+        masks = self._bitmasks(word)
+        index = 0
+        while True:
+            dist = self.distance(word, self.words[index], masks=masks)
+            if dist == 0:
+                # Already added.
+                return
+            child = self.children[index].get(dist, None)
+            if child is None:
+                self.children[index][dist] = len(self.words)
+                self.words.append(word)
+                self.children.append({})
+                return
+            index = child
+
+    def as_dict(self):
+        """ A JSON-friendly dict, see: from_dict() """
+        return {
+            'words': self.words,
+            'children': [
+                [[dist, index] for dist, index in children.items()]
+                for children in self.children
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, info):
+        """ Load a tree saved with as_dict(). """
+        return cls(
+            words=info['words'],
+            children=[
+                {dist: index for dist, index in children}
+                for children in info['children']
+            ],
+        )
+
+    def search(self, word, tolerance):
+        """ Return a sorted list of (distance, word) for every word that
+            is within `tolerance` edits of `word`.
+        """
+        if not self.words:
+            return []
+        masks = self._bitmasks(word)
+        found = []
+        stack = [0]
+        while stack:
+            index = stack.pop()
+            dist = self.distance(word, self.words[index], masks=masks)
+            if dist <= tolerance:
+                found.append((dist, self.words[index]))
+            # Triangle inequality, no other subtree can be close enough.
+            stack.extend(
+                child
+                for childdist, child in self.children[index].items()
+                if dist - tolerance <= childdist <= dist + tolerance
+            )
+        return sorted(found)
+
 
-        # Set to starting path of a circular symlink  if `_follow_links()` or
-        # `_get_filetype()` finds a circular symlink.
-        self.circular = None
-        # Determine if this is an absolute path, or locate it in $PATH.
-        self.exists = False
-        self._locate(ignore_cwd=ignore_cwd)
-        self.broken = self._broken()
+class Suggestions(object):
+    """ "Did you mean" suggestions for names that can't be resolved,
+        from a BKTree of every name that could have been meant.
+        The tree is built the first time it is needed, and saved on disk
+        until a $PATH dir (or one of `files`) changes.
+    """
+    default_cache_dir = DpkgIndex.default_cache_dir
+    max_suggestions = 3
 
-        self.symlink_to = []
-        # Assume an canonical path was passed, until proven otherwise.
-        self.target = self.path
-        self.filetype = None
+    def __init__(
+            self, dirs, get_names, files=(), cachedir=None, use_cache=True):
+        """
+            Arguments:
+                dirs (list(str))  : $PATH dirs, to know when the names
+                                    change.
+                get_names (func)  : Function that returns every name to
+                                    suggest, only called when the cached
+                                    tree can't be used.
+                files (list(str)) : Other files that names come from, like
+                                    alias files.
+                cachedir (str)    : Directory for the cache file.
+                                    Default: ~/.cache/whichfile
+                use_cache (bool)  : Whether to load/save the cache file.
+        """
+        self.dirs = tuple(dirs)
+        self.files = tuple(files)
+        self.get_names = get_names
+        self.cachedir = cachedir or self.default_cache_dir
+        self.use_cache = use_cache
+        self.key = self.fingerprint()
+        self.tree = None
 
-        self.resolved = False
-        if self.exists:
-            self._resolve()
+    def __repr__(self):
+        return '{}(dirs={}, tree={!r})'.format(
+            type(self).__name__,
+            len(self.dirs),
+            self.tree,
+        )
+
+    @property
+    def cache_file(self):
+        """ File name for the cached tree of this $PATH. """
+        return os.path.join(
+            self.cachedir,
+            'suggest-{}.json'.format(
+                hashlib.sha1(':'.join(self.dirs).encode()).hexdigest()[:16]
+            ),
+        )
+
+    def _load(self):
+        """ Load the cached tree if it matches the fingerprint, or build
+            a new one and save it.
+        """
+        if self.use_cache:
+            try:
+                with open(self.cache_file, 'r') as f:
+                    cached = json.load(f)
+            except (OSError, ValueError) as ex:
+                debug('No suggestion cache: {}'.format(ex))
+            else:
+                if cached.get('key', None) == self.key:
+                    self.tree = BKTree.from_dict(cached['tree'])
+                    return
+        self.tree = BKTree(sorted(set(self.get_names())))
+        if not self.use_cache:
+            return
+        try:
+            os.makedirs(self.cachedir, exist_ok=True)
+            tmpfile = '{}.{}'.format(self.cache_file, os.getpid())
+            with open(tmpfile, 'w') as f:
+                json.dump({'key': self.key, 'tree': self.tree.as_dict()}, f)
+            os.replace(tmpfile, self.cache_file)
+        except OSError as ex:
+            debug('Cannot save suggestion cache: {}'.format(ex))
+
+    def fingerprint(self):
+        """ Return a key for the current state of the dirs and files. """
+        parts = [os.environ.get('SHELL', '')]
+        for filepath in self.dirs + self.files:
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                parts.append((filepath, None))
+                continue
+            parts.append((filepath, st.st_ino, st.st_mtime_ns))
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def suggest(self, name):
+        """ Return a list of the closest names to `name`, best first.
+            Names shorter than 4 only get suggestions one edit away.
+            Ties are broken by favoring names with the same letters (a
+            swapped pair costs two edits), then the same first letter.
+        """
+        if self.tree is None:
+            self._load()
+        tolerance = 1 if len(name) < 4 else 2
+        letters = sorted(name)
+        close = sorted(
+            (
+                dist,
+                sorted(word) != letters,
+                word[:1] != name[:1],
+                word,
+            )
+            for dist, word in self.tree.search(name, tolerance)
+            if word != name
+        )
+        return [word for *_, word in close[:self.max_suggestions]]
+
+
+class NegativeCache(object):
+    """ Names that could not be resolved, saved on disk so they can be
+        skipped without any lookups next time, and a Bloom filter of every
+        name in the $PATH dirs, so a name that isn't in any of them is
+        known without trying every directory.
+        Everything is forgotten when a $PATH dir (or an alias file, or the
+        command-not-found database) changes.
+    """
+    default_cache_dir = DpkgIndex.default_cache_dir
+    cnf_db = '/var/lib/command-not-found/commands.db'
+
+    def __init__(self, dirs=None, cachedir=None, use_cache=True):
+        """
+            Arguments:
+                dirs (list(str)) : $PATH dirs.
+                                   Default: ResolvedPath.get_env_path()
+                cachedir (str)   : Directory for the cache file.
+                                   Default: ~/.cache/whichfile
+                use_cache (bool) : Whether to load/save the cache file.
+        """
+        self.dirs = tuple(
+            ResolvedPath.get_env_path() if dirs is None else dirs
+        )
+        self.cachedir = cachedir or self.default_cache_dir
+        self.use_cache = use_cache
+        self.key = self.fingerprint()
+        # {name: {'color' or 'plain': install message}}
+        self.misses = {}
+        self.bloom = None
+        self.changed = False
+        self._load()
+
+    def __contains__(self, name):
+        return name in self.misses
+
+    def __len__(self):
+        return len(self.misses)
 
     def __repr__(self):
-        """ Print a correct representation of this class instance. """
-        if self.symlink_to:
-            symlinks = '[\n    {}\n    ],'.format(
-                ',\n        '.join(
-                    (repr(s) for s in self.symlink_to),
+        return '{}(dirs={}, misses={}, bloom={!r})'.format(
+            type(self).__name__,
+            len(self.dirs),
+            len(self.misses),
+            self.bloom,
+        )
+
+    @property
+    def cache_file(self):
+        """ File name for the cache of this $PATH. """
+        return os.path.join(
+            self.cachedir,
+            'negative-{}.json'.format(
+                hashlib.sha1(':'.join(self.dirs).encode()).hexdigest()[:16]
+            ),
+        )
+
+    def _load(self):
+        """ Load the cache file if it matches the current fingerprint,
+            otherwise build a new Bloom filter from the $PATH dirs.
+        """
+        if self.use_cache:
+            try:
+                with open(self.cache_file, 'r') as f:
+                    cached = json.load(f)
+            except (OSError, ValueError) as ex:
+                debug('No negative cache: {}'.format(ex))
+            else:
+                if cached.get('key', None) == self.key:
+                    debug('Using negative cache: {}'.format(self.cache_file))
+                    self.misses = cached.get('misses', {})
+                    self.bloom = BloomFilter.from_dict(cached['bloom'])
+                    return
+        self.bloom = BloomFilter(list(PathIndex(dirs=self.dirs).names))
+        self.changed = True
+
+    def add(self, name):
+        """ Remember a name that could not be resolved. """
+        if name not in self.misses:
+            self.misses[name] = {}
+            self.changed = True
+
+    def fingerprint(self):
+        """ Return a key for the current state of the $PATH dirs, alias
+            files, and the command-not-found database.
+        """
+        parts = [os.environ.get('SHELL', '')]
+        for filepath in self.dirs + ALIAS_FILES + (self.cnf_db,):
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                parts.append((filepath, None))
+                continue
+            parts.append((filepath, st.st_ino, st.st_mtime_ns))
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def install_msg(self, name):
+        """ Return get_install_msg() for a name, remembering it for
+            known misses.
+        """
+        msgs = self.misses.get(name, None)
+        if msgs is None:
+            return get_install_msg(name)
+        mode = 'plain' if colr_disabled() else 'color'
+        if mode not in msgs:
+            msgs[mode] = get_install_msg(name)
+            self.changed = True
+        return msgs[mode]
+
+    def may_exist(self, name):
+        """ Return False if `name` is definitely not in any $PATH dir. """
+        return name in self.bloom
+
+    def save(self):
+        """ Save the cache file, if anything changed. """
+        if not (self.use_cache and self.changed):
+            return
+        try:
+            os.makedirs(self.cachedir, exist_ok=True)
+            tmpfile = '{}.{}'.format(self.cache_file, os.getpid())
+            with open(tmpfile, 'w') as f:
+                json.dump(
+                    {
+                        'key': self.key,
+                        'misses': self.misses,
+                        'bloom': self.bloom.as_dict(),
+                    },
+                    f,
                 )
+            os.replace(tmpfile, self.cache_file)
+        except OSError as ex:
+            debug('Cannot save negative cache: {}'.format(ex))
+        self.changed = False
+
+
+class DirWatchdog(object):
+    """ Probes $PATH directories from daemon threads, so a hung mount
+        (like a dead NFS server) can't stall everything else.
+        A directory that doesn't answer within `timeout` seconds is
+        quarantined for the rest of the run, and remembered in a cache
+        file for `max_age` seconds so the next runs skip it right away.
+    """
+    default_cache_dir = DpkgIndex.default_cache_dir
+    # Seconds to keep skipping a quarantined directory in later runs.
+    max_age = 300
+
+    def __init__(self, timeout=2, cachedir=None, use_cache=True):
+        """
+            Arguments:
+                timeout (float)  : Seconds to wait for each directory.
+                cachedir (str)   : Directory for the health cache file.
+                                   Default: ~/.cache/whichfile
+                use_cache (bool) : Whether to load/save the cache file.
+        """
+        self.timeout = timeout
+        self.cachedir = cachedir or self.default_cache_dir
+        self.use_cache = use_cache
+        # {dirpath: bool}, for directories that are done being probed.
+        self.healthy = {}
+        # {dirpath: time.time()} for directories that timed out.
+        self.quarantined = {}
+        # {dirpath: threading.Event}, set when a probe finishes.
+        self._probes = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def __repr__(self):
+        return '{}(timeout={!r}, healthy={}, quarantined={!r})'.format(
+            type(self).__name__,
+            self.timeout,
+            sum(1 for v in self.healthy.values() if v),
+            sorted(self.quarantined),
+        )
+
+    @property
+    def cache_file(self):
+        """ File name for the health cache. """
+        return os.path.join(self.cachedir, 'health.json')
+
+    def _load(self):
+        """ Load directories that were quarantined in recent runs. """
+        if not self.use_cache:
+            return
+        try:
+            with open(self.cache_file, 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError) as ex:
+            debug('No health cache: {}'.format(ex))
+            return
+        now = time.time()
+        for dirpath, when in cached.get('quarantined', {}).items():
+            if now - when < self.max_age:
+                self.quarantined[dirpath] = when
+
+    def _probe(self, dirpath, event):
+        """ Stat and start listing a directory, in a worker thread.
+            Errors are a fast answer too, only hanging counts.
+        """
+        try:
+            os.stat(dirpath)
+            with os.scandir(dirpath) as entries:
+                next(entries, None)
+        except OSError as ex:
+            debug('Probe error for $PATH dir: {}\n{}'.format(dirpath, ex))
+        with self._lock:
+            self.healthy.setdefault(dirpath, True)
+        event.set()
+
+    def _quarantine(self, dirpath):
+        """ Skip a directory that timed out, and warn about it once. """
+        with self._lock:
+            if dirpath in self.healthy:
+                # Another thread got to it, or the probe just finished.
+                return
+            self.healthy[dirpath] = False
+            self.quarantined[dirpath] = time.time()
+        print_err('Skipping $PATH dir, no response in {}s: {}'.format(
+            self.timeout,
+            dirpath,
+        ))
+        self.save()
+
+    def _start(self, dirpath):
+        """ Start probing a directory, if it isn't already.
+            Returns the Event for the probe, or None if the directory was
+            quarantined by a previous run.
+        """
+        with self._lock:
+            if dirpath in self.healthy:
+                return None
+            event = self._probes.get(dirpath, None)
+            if event is not None:
+                return event
+            when = self.quarantined.get(dirpath, None)
+            if when is not None:
+                self.healthy[dirpath] = False
+                event = None
+            else:
+                event = self._probes[dirpath] = threading.Event()
+                threading.Thread(
+                    target=self._probe,
+                    args=(dirpath, event),
+                    name='probe:{}'.format(dirpath),
+                    daemon=True,
+                ).start()
+        if event is None:
+            print_err('Skipping $PATH dir, it timed out {}s ago: {}'.format(
+                int(time.time() - when),
+                dirpath,
+            ))
+        return event
+
+    def check(self, dirpath):
+        """ Return True if `dirpath` answers in time, probing it the first
+            time it is seen. Probes are shared between threads.
+        """
+        healthy = self.healthy.get(dirpath, None)
+        if healthy is not None:
+            return healthy
+        event = self._start(dirpath)
+        if (event is not None) and not event.wait(self.timeout):
+            self._quarantine(dirpath)
+        return self.healthy[dirpath]
+
+    def healthy_dirs(self, dirs):
+        """ Probe every directory at once, and return a tuple of the ones
+            that answered in time (in order). This waits for `timeout`
+            seconds at most, no matter how many directories hang.
+        """
+        events = {dirpath: self._start(dirpath) for dirpath in dirs}
+        deadline = time.monotonic() + self.timeout
+        for dirpath, event in events.items():
+            if event is None:
+                continue
+            if not event.wait(max(deadline - time.monotonic(), 0)):
+                self._quarantine(dirpath)
+        return tuple(d for d in dirs if self.healthy[d])
+
+    def save(self):
+        """ Save the quarantined directories to the cache file. """
+        if not self.use_cache:
+            return
+        with self._lock:
+            quarantined = dict(self.quarantined)
+        try:
+            os.makedirs(self.cachedir, exist_ok=True)
+            tmpfile = '{}.{}'.format(self.cache_file, os.getpid())
+            with open(tmpfile, 'w') as f:
+                json.dump({'quarantined': quarantined}, f)
+            os.replace(tmpfile, self.cache_file)
+        except OSError as ex:
+            debug('Cannot save health cache: {}'.format(ex))
+
+
+class ElfInfo(object):
+    """ Structured information from an ELF file's headers.
+        The file is mmap'd and parsed through a memoryview, only the
+        headers, program headers, notes, and dynamic section are read.
+    """
+    __slots__ = (
+        'path',
+        'elf_class',
+        'endianness',
+        'osabi',
+        'machine',
+        'machine_id',
+        'elf_type',
+        'interpreter',
+        'build_id',
+        'dynamic',
+        'pie',
+        'stripped',
+        'needed',
+        'rpath',
+        'runpath',
+    )
+    # e_type values.
+    types = {
+        0: 'none',
+        1: 'relocatable',
+        2: 'executable',
+        3: 'shared object',
+        4: 'core file',
+    }
+    # e_machine values, named like the `file` command names them.
+    machines = {
+        2: 'SPARC',
+        3: 'Intel 80386',
+        8: 'MIPS',
+        20: 'PowerPC or cisco 4500',
+        21: '64-bit PowerPC or cisco 7500',
+        22: 'IBM S/390',
+        40: 'ARM',
+        43: 'SPARC V9',
+        50: 'IA-64',
+        62: 'x86-64',
+        183: 'ARM aarch64',
+        243: 'UCB RISC-V',
+        258: 'LoongArch',
+    }
+    # Program header types.
+    PT_LOAD = 1
+    PT_DYNAMIC = 2
+    PT_INTERP = 3
+    PT_NOTE = 4
+    # Dynamic section tags.
+    DT_NULL = 0
+    DT_NEEDED = 1
+    DT_STRTAB = 5
+    DT_STRSZ = 10
+    DT_RPATH = 15
+    DT_RUNPATH = 29
+    DT_FLAGS_1 = 0x6ffffffb
+    DF_1_PIE = 0x08000000
+    # Section header type for a symbol table.
+    SHT_SYMTAB = 2
+    NT_GNU_BUILD_ID = 3
+
+    def __init__(self, path):
+        self.path = path
+        self.elf_class = None
+        self.endianness = None
+        self.osabi = None
+        self.machine = None
+        self.machine_id = None
+        self.elf_type = None
+        self.interpreter = None
+        self.build_id = None
+        self.dynamic = False
+        self.pie = False
+        self.stripped = None
+        # Library names and search paths from the dynamic section.
+        self.needed = []
+        self.rpath = None
+        self.runpath = None
+
+    def __repr__(self):
+        return '{}({})'.format(
+            type(self).__name__,
+            ', '.join(
+                '{}={!r}'.format(k, v)
+                for k, v in self.as_dict().items()
             )
+        )
+
+    def _parse(self, mv):
+        """ Parse the headers from a memoryview of the whole file, or the
+            start of it. Anything past the end of `mv` (besides the
+            program headers) is skipped, and `stripped` stays None when
+            the section headers are not in it.
+            Raises ValueError if this is not an ELF file.
+        """
+        size = len(mv)
+        if bytes(mv[:4]) != b'\x7fELF':
+            raise ValueError('Not an ELF file: {}'.format(self.path))
+        is64 = mv[4] == 2
+        self.elf_class = 64 if is64 else 32
+        self.endianness = 'MSB' if mv[5] == 2 else 'LSB'
+        self.osabi = mv[7]
+        e = '>' if self.endianness == 'MSB' else '<'
+        if is64:
+            hdr = struct.unpack_from(e + 'HHIQQQIHHHHHH', mv, 16)
         else:
-            symlinks = '[],'
-        return '\n'.join((
-            '{}('.format(type(self).__name__),
-            '    path={s.path!r},',
-            '    use_mime={s.use_mime},',
-            '    max_width={s.max_width},',
-            '    circular={s.circular!r},',
-            '    exists={s.exists},',
-            '    broken={s.broken},',
-            '    symlink_to={symlinks},',
-            '    target={s.target!r},',
-            '    filetype={s.filetype!r},',
-            '    resolved={s.resolved},',
-            ')',
-        )).format(
-            s=self,
-            symlinks=symlinks,
+            hdr = struct.unpack_from(e + 'HHIIIIIHHHHHH', mv, 16)
+        (
+            e_type, e_machine, _, _, e_phoff, e_shoff, _, _,
+            e_phentsize, e_phnum, e_shentsize, e_shnum, _,
+        ) = hdr
+        self.elf_type = e_type
+        self.machine_id = e_machine
+        self.machine = self.machines.get(
+            e_machine,
+            'machine ({})'.format(e_machine),
         )
+        phfmt = e + ('IIQQQQQQ' if is64 else 'IIIIIIII')
+        dynamic = None
+        # (p_vaddr, p_offset, p_filesz) for PT_LOAD segments, to find the
+        # dynamic string table in the file.
+        loads = []
+        for i in range(e_phnum):
+            ph = struct.unpack_from(phfmt, mv, e_phoff + (i * e_phentsize))
+            if is64:
+                p_type, _, p_offset, p_vaddr, _, p_filesz, _, _ = ph
+            else:
+                p_type, p_offset, p_vaddr, _, p_filesz, _, _, _ = ph
+            if p_type == self.PT_LOAD:
+                loads.append((p_vaddr, p_offset, p_filesz))
+            elif (p_type == self.PT_INTERP) and (p_offset + p_filesz <= size):
+                self.interpreter = bytes(
+                    mv[p_offset:p_offset + p_filesz]
+                ).rstrip(b'\0').decode(errors='replace')
+            elif p_type == self.PT_DYNAMIC:
+                self.dynamic = True
+                dynamic = (p_offset, p_filesz)
+            elif (p_type == self.PT_NOTE) and (p_offset + p_filesz <= size):
+                self._parse_notes(mv, e, p_offset, p_filesz)
+        if (dynamic is not None) and (sum(dynamic) <= size):
+            # Sets `pie` when DF_1_PIE is found, like the `file` command.
+            self._parse_dynamic(mv, e, is64, *dynamic, loads=loads)
+        if e_shoff + (e_shnum * e_shentsize) > size:
+            return
+        self.stripped = True
+        for i in range(e_shnum):
+            sh_type, = struct.unpack_from(
+                e + 'I',
+                mv,
+                e_shoff + (i * e_shentsize) + 4,
+            )
+            if sh_type == self.SHT_SYMTAB:
+                self.stripped = False
+                break
 
-    def __str__(self):
-        """ Printable string representation of this resolved path. """
-        if not self.exists:
-            debug('__str__() on non-existing file.')
-        if not self.resolved:
-            debug('__str__() on unresolved file.')
-        return self.formatted()
+    def _parse_dynamic(self, mv, e, is64, offset, size, loads=()):
+        """ Parse the entries in the dynamic section.
+            DT_NEEDED, DT_RPATH, and DT_RUNPATH strings are read from the
+            dynamic string table, found through the PT_LOAD `loads`.
+        """
+        dynfmt = e + ('qQ' if is64 else 'iI')
+        entsize = struct.calcsize(dynfmt)
+        # {tag: [value, ...]} for tags that point into the string table.
+        strings = {self.DT_NEEDED: [], self.DT_RPATH: [], self.DT_RUNPATH: []}
+        strtab = strsz = None
+        for off in range(offset, offset + size - entsize + 1, entsize):
+            tag, val = struct.unpack_from(dynfmt, mv, off)
+            if tag == self.DT_NULL:
+                break
+            if (tag == self.DT_FLAGS_1) and (val & self.DF_1_PIE):
+                self.pie = True
+            elif tag in strings:
+                strings[tag].append(val)
+            elif tag == self.DT_STRTAB:
+                strtab = val
+            elif tag == self.DT_STRSZ:
+                strsz = val
+        if (strtab is None) or (strsz is None):
+            return
+        for vaddr, fileoff, filesz in loads:
+            if vaddr <= strtab < vaddr + filesz:
+                start = fileoff + (strtab - vaddr)
+                break
+        else:
+            return
+        if start + strsz > len(mv):
+            # Not in a partial buffer.
+            return
+        table = bytes(mv[start:start + strsz])
+
+        def getstr(index):
+            return table[index:table.find(b'\0', index)].decode(
+                errors='replace'
+            )
+
+        self.needed = [getstr(i) for i in strings[self.DT_NEEDED]]
+        if strings[self.DT_RPATH]:
+            self.rpath = getstr(strings[self.DT_RPATH][0])
+        if strings[self.DT_RUNPATH]:
+            self.runpath = getstr(strings[self.DT_RUNPATH][0])
+
+    def _parse_notes(self, mv, e, offset, size):
+        """ Look for the GNU build-id in a PT_NOTE segment. """
+        end = offset + size
+        while offset + 12 <= end:
+            namesz, descsz, ntype = struct.unpack_from(e + 'III', mv, offset)
+            offset += 12
+            name = bytes(mv[offset:offset + namesz])
+            offset += (namesz + 3) & ~3
+            if (ntype == self.NT_GNU_BUILD_ID) and (name == b'GNU\0'):
+                self.build_id = bytes(mv[offset:offset + descsz]).hex()
+                return
+            offset += (descsz + 3) & ~3
+
+    def as_dict(self):
+        """ A JSON-friendly dict for this ElfInfo. """
+        return {
+            'class': self.elf_class,
+            'endianness': self.endianness,
+            'machine': self.machine,
+            'type': self.type_name,
+            'interpreter': self.interpreter,
+            'build_id': self.build_id,
+            'dynamic': self.dynamic,
+            'pie': self.pie,
+            'stripped': self.stripped,
+            'needed': self.needed,
+            'rpath': self.rpath,
+            'runpath': self.runpath,
+        }
+
+    def describe(self):
+        """ A human readable description, similar to the `file` command. """
+        parts = [
+            'ELF {}-bit {} {}'.format(
+                self.elf_class,
+                self.endianness,
+                self.type_name,
+            ),
+            self.machine,
+        ]
+        if self.elf_type in (2, 3):
+            parts.append(
+                'dynamically linked' if self.dynamic else 'statically linked'
+            )
+        if self.interpreter:
+            parts.append('interpreter {}'.format(self.interpreter))
+        if self.build_id:
+            idtype = {16: 'md5/uuid', 20: 'sha1', 8: 'xxHash'}.get(
+                len(self.build_id) // 2,
+                'unknown',
+            )
+            parts.append('BuildID[{}]={}'.format(idtype, self.build_id))
+        if self.stripped is not None:
+            parts.append('stripped' if self.stripped else 'not stripped')
+        return ', '.join(parts)
+
+    @classmethod
+    def from_file(cls, path):
+        """ Parse an ELF file, and return an ElfInfo.
+            Returns None if it is not a readable ELF file.
+        """
+        info = cls(path)
+        try:
+            with open(path, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    with memoryview(mm) as mv:
+                        info._parse(mv)
+        except (OSError, ValueError, struct.error, IndexError) as ex:
+            debug('Not parsing as ELF: {}\n{}'.format(path, ex))
+            return None
+        return info
+
+    @classmethod
+    def from_buffer(cls, path, data):
+        """ Parse the first part of an ELF file, already read into `data`.
+            Returns None if it is not ELF, or if the headers that are
+            needed are not in `data`.
+        """
+        info = cls(path)
+        try:
+            with memoryview(data) as mv:
+                info._parse(mv)
+        except (ValueError, struct.error, IndexError) as ex:
+            debug('Not parsing buffer as ELF: {}\n{}'.format(path, ex))
+            return None
+        return info
+
+    @property
+    def type_name(self):
+        """ The e_type, as a human readable string. """
+        if self.pie:
+            return 'pie executable'
+        return self.types.get(self.elf_type, 'type ({})'.format(self.elf_type))
+
+
+class LdCache(object):
+    """ An index of the dynamic loader's cache (/etc/ld.so.cache), to
+        find shared libraries by name without running `ldconfig -p` or
+        `ldd`. Only the new format (glibc-ld.so.cache1.1) is read, with
+        or without the old format in front of it.
+        The file is parsed the first time it is needed.
+    """
+    default_file = '/etc/ld.so.cache'
+    magic_old = b'ld.so-1.7.0'
+    magic_new = b'glibc-ld.so.cache1.1'
+    # Header: magic, nlibs, len_strings, flags, padding, extension_offset,
+    # and unused space.
+    header_size = 48
+    # Entry: flags, key, value, osversion, hwcap.
+    entry_fmt = 'iIIIQ'
+    # Low bits of an entry's flags, for glibc libraries.
+    FLAG_ELF_LIBC6 = 0x0003
+    FLAG_TYPE_MASK = 0x00ff
+    FLAG_ARCH_MASK = 0xff00
+    # Architecture bits for (e_machine, ELF class).
+    arch_flags = {
+        (3, 32): 0x0000,
+        (40, 32): 0x0900,
+        (21, 64): 0x0500,
+        (22, 64): 0x0400,
+        (62, 64): 0x0300,
+        (183, 64): 0x0a00,
+        (243, 64): 0x1000,
+    }
+
+    def __init__(self, filename=None):
+        self.filename = filename or self.default_file
+        # {soname: [(flags, hwcap, path), ...]}, in cache order.
+        self._entries = None
+
+    def __repr__(self):
+        return '{}(filename={!r}, entries={})'.format(
+            type(self).__name__,
+            self.filename,
+            None if self._entries is None else len(self._entries),
+        )
+
+    def _load(self):
+        """ Read and parse the cache file. """
+        self._entries = {}
+        try:
+            with open(self.filename, 'rb') as f:
+                data = f.read()
+        except OSError as ex:
+            debug('Cannot read ld.so cache: {}\n{}'.format(self.filename, ex))
+            return
+        try:
+            self._parse(data)
+        except (ValueError, struct.error) as ex:
+            debug('Cannot parse ld.so cache: {}\n{}'.format(
+                self.filename,
+                ex,
+            ))
+
+    def _parse(self, data):
+        """ Parse the new format entries in `data`.
+            Raises ValueError if the new format is not found.
+        """
+        start = 0
+        if data.startswith(self.magic_old):
+            # Skip the old entries (3 ints each), the new header is
+            # aligned after them.
+            nlibs, = struct.unpack_from('<I', data, len(self.magic_old) + 1)
+            start = len(self.magic_old) + 1 + 4 + (nlibs * 12)
+            start = (start + 7) & ~7
+        if data[start:start + len(self.magic_new)] != self.magic_new:
+            raise ValueError('Not a new format cache file.')
+        e = '>' if data[start + 28] == 3 else '<'
+        nlibs, _ = struct.unpack_from(e + 'II', data, start + 20)
+        entsize = struct.calcsize(e + self.entry_fmt)
+
+        def getstr(offset):
+            # String offsets are from the start of the new header.
+            offset += start
+            return data[offset:data.index(b'\0', offset)].decode(
+                errors='replace'
+            )
+
+        for i in range(nlibs):
+            flags, key, value, _, hwcap = struct.unpack_from(
+                e + self.entry_fmt,
+                data,
+                start + self.header_size + (i * entsize),
+            )
+            self._entries.setdefault(getstr(key), []).append(
+                (flags, hwcap, getstr(value))
+            )
+
+    def lookup(self, name, machine=None):
+        """ Return the path for a library name, like the dynamic loader
+            would find it in the cache. When `machine` is given as
+            (e_machine, ELF class), only libraries for it are used.
+            Libraries in glibc-hwcaps subdirectories are only used when
+            there is nothing else.
+            Returns None if the name isn't in the cache.
+        """
+        if self._entries is None:
+            self._load()
+        archflags = self.arch_flags.get(machine, None)
+        found = None
+        for flags, hwcap, path in self._entries.get(name, ()):
+            if (flags & self.FLAG_TYPE_MASK) != self.FLAG_ELF_LIBC6:
+                continue
+            if (archflags is not None) and (
+                    (flags & self.FLAG_ARCH_MASK) != archflags):
+                continue
+            if not hwcap:
+                return path
+            found = found or path
+        return found
+
+
+class LibraryResolver(object):
+    """ Finds the shared libraries that ELF files need, in the order the
+        dynamic loader (ld.so) searches for them, without running the
+        loader or `ldd`. Every library's ResolvedPath and ELF headers are
+        shared by all of the files in a batch.
+    """
+    # Loader defaults, after the cache.
+    default_dirs = {
+        32: ('/lib', '/usr/lib'),
+        64: ('/lib64', '/usr/lib64', '/lib', '/usr/lib'),
+    }
+    # Matches library names, like: libc.so.6
+    soname_pat = re.compile(r'^lib[^/]*\.so(\.[\d.]+)?$')
+
+    def __init__(self, ldcache=None, env_dirs=None):
+        """
+            Arguments:
+                ldcache (LdCache)   : The loader cache to use.
+                                      Default: LdCache()
+                env_dirs (list(str)): Dirs to search before the cache,
+                                      like $LD_LIBRARY_PATH does.
+                                      Default: $LD_LIBRARY_PATH
+        """
+        self.ldcache = LdCache() if ldcache is None else ldcache
+        if env_dirs is None:
+            env_dirs = [
+                s for s in os.environ.get('LD_LIBRARY_PATH', '').split(':')
+                if s
+            ]
+        self.env_dirs = tuple(env_dirs)
+        # {path: ElfInfo or None}
+        self.elfs = {}
+        # {(name, machine, search dirs): (path, source) or None}
+        self.found = {}
+        # {(path, use_mime, elf): ResolvedPath}
+        self.resolved = {}
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return '{}(ldcache={!r}, env_dirs={!r}, libraries={})'.format(
+            type(self).__name__,
+            self.ldcache,
+            self.env_dirs,
+            len(self.resolved),
+        )
+
+    @staticmethod
+    def _expand(dirs, origin, elf):
+        """ Split an RPATH/RUNPATH string, expanding $ORIGIN and $LIB.
+        """
+        libdir = 'lib64' if elf.elf_class == 64 else 'lib'
+        expanded = []
+        for dirpath in dirs.split(':'):
+            for var, value in (('ORIGIN', origin), ('LIB', libdir)):
+                dirpath = dirpath.replace('${{{}}}'.format(var), value)
+                dirpath = dirpath.replace('${}'.format(var), value)
+            if dirpath:
+                expanded.append(dirpath)
+        return tuple(expanded)
+
+    def _matches(self, path, machine):
+        """ Return True if `path` is an ELF file for `machine`. """
+        elf = self.elf_info(path)
+        return (elf is not None) and (
+            (elf.machine_id, elf.elf_class) == machine
+        )
+
+    def closure(self, resolved):
+        """ Return a list of SharedLibrary for every library that the
+            target of a ResolvedPath needs, directly or not, in the order
+            the loader would load them. Each library is only listed once.
+            Returns None if the target is not a dynamic ELF file.
+        """
+        target = os.path.realpath(resolved.target)
+        elf = self.elf_info(target)
+        if (elf is None) or (not elf.dynamic):
+            return None
+        machine = (elf.machine_id, elf.elf_class)
+        # The executable's RPATH is used for everything it loads, unless
+        # it has a RUNPATH.
+        main_rpath = ()
+        if elf.rpath and not elf.runpath:
+            main_rpath = self._expand(
+                elf.rpath,
+                os.path.dirname(target),
+                elf,
+            )
+        libraries = []
+        seen = set()
+        queue = deque([(os.path.basename(resolved.path), target, elf)])
+        with self._lock:
+            while queue:
+                parent, objpath, objelf = queue.popleft()
+                for name in objelf.needed:
+                    if name in seen:
+                        continue
+                    seen.add(name)
+                    found = self.find(
+                        name,
+                        objpath,
+                        objelf,
+                        machine,
+                        main_rpath=main_rpath,
+                    )
+                    if found is None:
+                        libraries.append(SharedLibrary(name, parent))
+                        continue
+                    libpath, source = found
+                    lib = self.resolve(libpath, resolved)
+                    libraries.append(
+                        SharedLibrary(name, parent, source=source, lib=lib)
+                    )
+                    libtarget = os.path.realpath(lib.target)
+                    libelf = self.elf_info(libtarget)
+                    if libelf is not None:
+                        queue.append((name, libtarget, libelf))
+        return libraries
+
+    def elf_info(self, path):
+        """ Return a (memoized) ElfInfo for a file, or None. """
+        elf = self.elfs.get(path, False)
+        if elf is False:
+            elf = self.elfs[path] = ElfInfo.from_file(path)
+        return elf
+
+    def find(self, name, objpath, objelf, machine, main_rpath=()):
+        """ Find a library that `objpath` (with ElfInfo `objelf`) needs.
+            Returns (path, source), or None if it can't be found.
+        """
+        origin = os.path.dirname(objpath)
+        searches = []
+        if os.path.sep in name:
+            searches.append(('path', (os.path.dirname(name),)))
+            name = os.path.basename(name)
+        elif objelf.runpath:
+            searches.append(('LD_LIBRARY_PATH', self.env_dirs))
+            searches.append((
+                'RUNPATH',
+                self._expand(objelf.runpath, origin, objelf),
+            ))
+        else:
+            rpath = ()
+            if objelf.rpath:
+                rpath = self._expand(objelf.rpath, origin, objelf)
+            searches.append(('RPATH', rpath + main_rpath))
+            searches.append(('LD_LIBRARY_PATH', self.env_dirs))
+        key = (name, machine, tuple(searches))
+        if key in self.found:
+            return self.found[key]
+        found = None
+        for source, dirs in searches:
+            for dirpath in dirs:
+                trypath = os.path.join(dirpath, name)
+                if self._matches(trypath, machine):
+                    found = (trypath, source)
+                    break
+            if (found is not None) or (source == 'path'):
+                # Names with a slash are never searched for.
+                break
+        else:
+            path = self.ldcache.lookup(name, machine=machine)
+            if path is not None:
+                found = (path, 'ld.so.cache')
+            else:
+                for dirpath in self.default_dirs.get(objelf.elf_class, ()):
+                    trypath = os.path.join(dirpath, name)
+                    if self._matches(trypath, machine):
+                        found = (trypath, 'default')
+                        break
+        self.found[key] = found
+        return found
+
+    def resolve(self, path, parent):
+        """ Return a (shared) ResolvedPath for a library, using the
+            settings of the ResolvedPath `parent`.
+        """
+        key = (path, parent.use_mime, parent.use_elf)
+        lib = self.resolved.get(key, None)
+        if lib is None:
+            lib = self.resolved[key] = ResolvedPath(
+                path,
+                use_mime=parent.use_mime,
+                max_width=parent.max_width,
+                stats=parent.stats,
+                elf=parent.use_elf,
+            )
+        return lib
+
+    def lookup(self, name):
+        """ Return the path for a library name from the loader cache, for
+            this machine's libraries. Returns None if it isn't a library
+            name, or isn't in the cache.
+        """
+        if not self.soname_pat.match(name):
+            return None
+        machine = None
+        elf = self.elf_info(os.path.realpath(sys.executable))
+        if elf is not None:
+            machine = (elf.machine_id, elf.elf_class)
+        return self.ldcache.lookup(name, machine=machine)
+
+
+class SharedLibrary(object):
+    """ A library needed by an ELF file, see: LibraryResolver """
+    __slots__ = ('name', 'needed_by', 'source', 'lib')
+
+    def __init__(self, name, needed_by, source=None, lib=None):
+        """
+            Arguments:
+                name (str)         : The DT_NEEDED name.
+                needed_by (str)    : The library (or file) that needs it.
+                source (str)       : Where it was found, like: ld.so.cache
+                lib (ResolvedPath) : The library, or None when missing.
+        """
+        self.name = name
+        self.needed_by = needed_by
+        self.source = source
+        self.lib = lib
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, source={!r}, lib={!r})'.format(
+            type(self).__name__,
+            self.name,
+            self.needed_by,
+            self.source,
+            None if self.lib is None else self.lib.path,
+        )
+
+    def as_dict(self):
+        """ A JSON-friendly dict for this library. """
+        return {
+            'name': self.name,
+            'needed_by': self.needed_by,
+            'source': self.source,
+            'file': None if self.lib is None else self.lib.as_dict(),
+        }
+
+    def formatted(self):
+        """ Printable/colorized lines for this library. """
+        if self.lib is None:
+            return '{} {}'.format(
+                colr_str(self.name, **COLOR_ARGS['link']),
+                colr_str(
+                    '(missing, for {})'.format(self.needed_by),
+                    fore='red',
+                ),
+            )
+        return '\n'.join((
+            '{} ({}, for {})'.format(
+                colr_str(self.name, **COLOR_ARGS['link']),
+                self.source,
+                self.needed_by,
+            ),
+            self.lib.formatted(),
+        ))
 
-    def _broken(self, path=None):
-        """ Determine if a path is a broken link. """
-        path = path or self.path
-        return os.path.islink(path) and (not os.path.exists(path))
 
-    def _exists(self, path=None):
-        """ Determine whether a path exists,
-            or is at least an existing broken link.
+class FileCapabilities(object):
+    """ File capabilities, decoded from a security.capability xattr
+        (struct vfs_cap_data, revisions 1 through 3).
+    """
+    __slots__ = ('effective', 'inheritable', 'permitted', 'rootid', 'version')
+    # Capability names, by number, from linux/capability.h.
+    names = (
+        'cap_chown', 'cap_dac_override', 'cap_dac_read_search',
+        'cap_fowner', 'cap_fsetid', 'cap_kill', 'cap_setgid', 'cap_setuid',
+        'cap_setpcap', 'cap_linux_immutable', 'cap_net_bind_service',
+        'cap_net_broadcast', 'cap_net_admin', 'cap_net_raw', 'cap_ipc_lock',
+        'cap_ipc_owner', 'cap_sys_module', 'cap_sys_rawio', 'cap_sys_chroot',
+        'cap_sys_ptrace', 'cap_sys_pacct', 'cap_sys_admin', 'cap_sys_boot',
+        'cap_sys_nice', 'cap_sys_resource', 'cap_sys_time',
+        'cap_sys_tty_config', 'cap_mknod', 'cap_lease', 'cap_audit_write',
+        'cap_audit_control', 'cap_setfcap', 'cap_mac_override',
+        'cap_mac_admin', 'cap_syslog', 'cap_wake_alarm',
+        'cap_block_suspend', 'cap_audit_read', 'cap_perfmon', 'cap_bpf',
+        'cap_checkpoint_restore',
+    )
+    # Masks for the magic_etc header.
+    revision_mask = 0xFF000000
+    effective_flag = 0x000001
+    # {revision: (u32 words per set, has rootid)}
+    revisions = {
+        0x01000000: (1, False),
+        0x02000000: (2, False),
+        0x03000000: (2, True),
+    }
+
+    def __init__(
+            self, permitted=0, inheritable=0, effective=False, version=2,
+            rootid=None):
         """
-        # os.path.exists() returns False for existing broken links.
-        path = path or self.path
-        return os.path.islink(path) or os.path.exists(path)
+            Arguments:
+                permitted (int)   : Bitmask of permitted capabilities.
+                inheritable (int) : Bitmask of inheritable capabilities.
+                effective (bool)  : Whether the capabilities are made
+                                    effective when the file is run.
+                version (int)     : Revision of the xattr format.
+                rootid (int)      : Root uid of the user namespace, for
+                                    revision 3.
+        """
+        self.permitted = permitted
+        self.inheritable = inheritable
+        self.effective = effective
+        self.version = version
+        self.rootid = rootid
 
-    def _expand(self, path):
-        """ Expand user paths, and use abspath when needed.
-            Return the expanded path.
+    def __bool__(self):
+        return bool(self.permitted or self.inheritable)
+
+    def __repr__(self):
+        return '{}(permitted={:#x}, inheritable={:#x}, effective={})'.format(
+            type(self).__name__,
+            self.permitted,
+            self.inheritable,
+            self.effective,
+        )
+
+    def __str__(self):
+        """ Capabilities in the `getcap` text form, like:
+            cap_net_admin,cap_net_raw=ep
         """
-        try:
-            if '~' in path:
-                path = path.expanduser(path)
-            if '..' in path:
-                path = path.abspath(path)
-        except Exception as exabs:
-            errfmt = 'Init error (abspath/expanduser): {}\n{}'
-            debug(errfmt.format(exabs, exabs))
+        # {flags: [capability name, ...]}, in capability order.
+        groups = OrderedDict()
+        for num in range(max(self.permitted, self.inheritable).bit_length()):
+            bit = 1 << num
+            flags = ''.join((
+                'e' if self.effective else '',
+                'i' if self.inheritable & bit else '',
+                'p' if self.permitted & bit else '',
+            ))
+            if flags not in ('', 'e'):
+                groups.setdefault(flags, []).append(self.cap_name(num))
+        text = ' '.join(
+            '{}={}'.format(','.join(names), flags)
+            for flags, names in groups.items()
+        )
+        if self.rootid:
+            text = '{} [rootid={}]'.format(text, self.rootid)
+        return text
 
-        return path
+    def as_dict(self):
+        """ A JSON-friendly dict for these capabilities. """
+        return {
+            'version': self.version,
+            'effective': self.effective,
+            'permitted': self.cap_names(self.permitted),
+            'inheritable': self.cap_names(self.inheritable),
+            'rootid': self.rootid,
+            'text': str(self),
+        }
 
-    def _follow_links(self, path=None):
-        path = path or self.path
+    @classmethod
+    def cap_name(cls, num):
+        """ Return the name for a capability number. """
         try:
-            symlink = os.readlink(path)
-        except OSError as exreadlink:
-            debug('_follow_links(): readlink: {}'.format(exreadlink))
-        else:
-            basepath = os.path.split(path)[0]
-            absolutepath = os.path.join(basepath, symlink)
-            try:
-                absolutepath = os.path.abspath(absolutepath)
-            except RecursionError:
-                # Circular link.
-                # The "circle" can start anywhere in a symlink chain,
-                # so I'm using a RecursionError to detect it right now.
-                exc = CircularLink(self.path, path)
-                self.circular = exc.start
-                debug(exc)
-                raise exc
-            except Exception as exabs:
-                debug('_follow_links({}): abspath: {}'.format(path, exabs))
-            else:
-                yield absolutepath
-                yield from self._follow_links(absolutepath)
+            return cls.names[num]
+        except IndexError:
+            return 'cap_{}'.format(num)
 
-    def _get_filetype(self, path=None):
-        """ Determine a file's type like the `file` command. """
-        path = path or self.path
+    @classmethod
+    def cap_names(cls, mask):
+        """ Return a list of capability names for a bitmask. """
+        return [
+            cls.cap_name(num)
+            for num in range(mask.bit_length())
+            if mask & (1 << num)
+        ]
+
+    @classmethod
+    def from_bytes(cls, data):
+        """ Decode a security.capability xattr value.
+            Raises ValueError for unknown revisions or short values.
+        """
+        if len(data) < 4:
+            raise ValueError('capability data is too short.')
+        magic = struct.unpack_from('<I', data)[0]
+        revision = magic & cls.revision_mask
         try:
-            ftype = magic.from_file(path, mime=self.use_mime)
-        except EnvironmentError as ex:
-            if ex.errno == 40:
-                # Circular symlink, this should already be caught in
-                # _follow_links, which is called before this in _resolve.
-                debug('_get_filetype: Magic error: {}\n{}'.format(path, ex))
-                exc = CircularLink(self.path, path)
-                self.circular = exc.start
-            debug('_get_filetype: Magic error: {}\n{}'.format(path, ex))
-            if self.broken:
-                return '<broken link to: {}>'.format(path)
-            ftype = None
-        if ftype is None and os.path.isdir(path):
-            ftype = 'directory'
+            words, has_rootid = cls.revisions[revision]
+        except KeyError:
+            raise ValueError(
+                'unknown capability revision: {:#x}'.format(revision)
+            )
+        fmt = '<{}I'.format(1 + (words * 2) + int(has_rootid))
+        if len(data) < struct.calcsize(fmt):
+            raise ValueError('capability data is too short.')
+        values = struct.unpack_from(fmt, data)
+        permitted = inheritable = 0
+        for i in range(words):
+            # Each u32 word is a (permitted, inheritable) pair.
+            permitted |= values[1 + (i * 2)] << (i * 32)
+            inheritable |= values[2 + (i * 2)] << (i * 32)
+        return cls(
+            permitted=permitted,
+            inheritable=inheritable,
+            effective=bool(magic & cls.effective_flag),
+            version=revision >> 24,
+            rootid=values[-1] if has_rootid else None,
+        )
 
-        return ftype or '<unknown>'
 
-    def _locate(self, ignore_cwd=False):
-        """ If this is not an absolute path, it will try to locate it
-            in one of the PATH dirs.
-            Sets self.path, and returns the full absolute path on success.
-            Returns None for non-existing paths.
+class PrivilegeAudit(object):
+    """ Finds setuid/setgid bits and file capabilities for final targets.
+        Each distinct file (by device and inode) has it's security.capability
+        xattr read once, no matter how many links point to it, and the
+        mode bits come from the stat results used to resolve it.
+    """
+    xattr = 'security.capability'
+
+    def __init__(self, root=None):
         """
-        if self._exists(self.path):
-            debug('_locate(\'{p}\') = {p}'.format(p=self.path))
-            if not ignore_cwd:
-                self.exists = True
-                return self.path
-            debug('_locate(\'{p}\'): Ignoring CWD...'.format(p=self.path))
+            Arguments:
+                root (RootFS) : Files are inside this root. User and group
+                                names are not looked up on the host.
+        """
+        self.root = root
+        # {(st_dev, st_ino): Privileges}
+        self._files = {}
+        # {uid: name} and {gid: name}
+        self._users = {}
+        self._groups = {}
+        self._lock = threading.Lock()
+        # Distinct dirs and paths checked by the last sweep().
+        self.swept_dirs = 0
+        self.swept_paths = 0
 
-        debug('_locate(\'{}\'): Not in CWD...'.format(self.path))
+    def __repr__(self):
+        return '{}(root={!r}, files={})'.format(
+            type(self).__name__,
+            None if self.root is None else self.root.root,
+            len(self._files),
+        )
 
-        dirs = self.get_env_path()
-        for dirpath in dirs:
-            trypath = os.path.join(dirpath, self.path)
-            if self._exists(trypath):
-                debug('_locate(\'{}\') = {}'.format(self.path, trypath))
-                self.path = trypath
-                self.exists = True
-                return self.path
+    def _group_name(self, gid):
+        """ Return a memoized group name for `gid`, or None. """
+        if self.root is not None:
+            return None
+        try:
+            return self._groups[gid]
+        except KeyError:
+            pass
+        try:
+            name = grp.getgrgid(gid).gr_name
+        except KeyError:
+            name = None
+        self._groups[gid] = name
+        return name
 
-        debug('_locate(\'{}\') failed!'.format(self.path))
-        self.exists = False
-        return None
+    def _host(self, path):
+        """ Return the host path for `path`, see: RootFS.host() """
+        return path if self.root is None else self.root.host(path)
 
-    def _resolve(self):
-        """ Resolve this path, following symlinks, determining file type,
-            and filling in attributes along the way.
+    def _user_name(self, uid):
+        """ Return a memoized user name for `uid`, or None. """
+        if self.root is not None:
+            return None
+        try:
+            return self._users[uid]
+        except KeyError:
+            pass
+        try:
+            name = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            name = None
+        self._users[uid] = name
+        return name
+
+    def check(self, path, st):
+        """ Return Privileges for a final target (a host path), given it's
+            stat result. Returns None for anything that isn't a regular
+            file.
+        """
+        if (st is None) or (not stat.S_ISREG(st.st_mode)):
+            return None
+        key = (st.st_dev, st.st_ino)
+        with self._lock:
+            privileges = self._files.get(key, None)
+            if privileges is not None:
+                return privileges
+        privileges = Privileges(
+            st.st_mode,
+            st.st_uid,
+            st.st_gid,
+            capabilities=self.read_capabilities(path),
+            user=self._user_name(st.st_uid) if (
+                st.st_mode & stat.S_ISUID) else None,
+            group=self._group_name(st.st_gid) if (
+                st.st_mode & stat.S_ISGID) else None,
+        )
+        with self._lock:
+            return self._files.setdefault(key, privileges)
+
+    def read_capabilities(self, path):
+        """ Read and decode the security.capability xattr for a file.
+            Returns None when there is none, or it can't be read.
         """
-        debug('Resolving: {}'.format(self.path))
         try:
-            self.symlink_to = [p for p in self._follow_links()]
-        except CircularLink as ex:
-            self.symlink_to = ex.chain[1:]
-            symlink_len = len(self.symlink_to)
-            self.filetype = '<circular link: {} {} deep>'.format(
-                symlink_len,
-                'level' if symlink_len == 1 else 'levels',
+            data = os.getxattr(path, self.xattr, follow_symlinks=False)
+        except OSError as ex:
+            if ex.errno not in (errno.ENODATA, errno.ENOTSUP):
+                debug('Cannot read capabilities: {}\n{}'.format(path, ex))
+            return None
+        try:
+            return FileCapabilities.from_bytes(data)
+        except ValueError as ex:
+            debug('Bad capabilities for: {}\n{}'.format(path, ex))
+            return None
+
+    def sweep(self, index, stats=None):
+        """ Check every location in a PathIndex, and yield (path,
+            Privileges) for each one that ends in a privileged file.
+            Locations in a dir that is already checked (by device and
+            inode) are skipped. Distinct names that link to the same file
+            are still reported.
+            Only the stat results and one xattr read per distinct file are
+            needed, nothing else is read.
+            The counts are in `swept_dirs` and `swept_paths` afterwards.
+        """
+        stats = StatCache() if stats is None else stats
+        # {dirpath: (st_dev, st_ino)}, so a dir that is in $PATH twice
+        # (like /bin and /usr/bin on merged-/usr systems) is only checked
+        # once.
+        dirkeys = {}
+        for dirpath in index.dirs:
+            st = stats.stat(self._host(dirpath))
+            dirkeys[dirpath] = dirpath if st is None else (
+                st.st_dev,
+                st.st_ino,
             )
-            self.target = self.path
+        self.swept_dirs = len(set(dirkeys.values()))
+        self.swept_paths = 0
+        # {(dir key, name)}
+        checked = set()
+        for name in sorted(index.names):
+            for dirpath in index.names[name]:
+                key = (dirkeys[dirpath], name)
+                if key in checked:
+                    continue
+                checked.add(key)
+                self.swept_paths += 1
+                path = os.path.join(dirpath, name)
+                privileges = self._sweep_check(path, stats)
+                if privileges is not None:
+                    yield path, privileges
+
+    def _sweep_check(self, path, stats):
+        """ Return Privileges for a $PATH entry if it is privileged,
+            otherwise None. Files that nobody can execute are skipped
+            without reading their xattrs.
+        """
+        if self.root is None:
+            # The xattr is read without following links, so it must be
+            # read from the target itself.
+            hostpath = os.path.realpath(path)
         else:
-            if self.symlink_to:
-                self.target = self.symlink_to[-1]
-            self.filetype = self._get_filetype(self.target)
-            try:
-                # For old libmagic versions, the info will not be as good.
-                self.filetype = self.filetype.decode()
-            except AttributeError:
-                pass
-        if self.filetype == 'directory':
-            self.target = os.path.abspath(self.target or self.path)
-        self.resolved = True
+            target = self.root.realpath(path)
+            if target is None:
+                # Circular link.
+                return None
+            hostpath = self.root.host(target)
+        st = stats.stat(hostpath)
+        if (st is None) or not (st.st_mode & 0o111):
+            return None
+        privileges = self.check(hostpath, st)
+        if (privileges is None) or not privileges.privileged:
+            return None
+        return privileges
 
-    def formatted(self, dir_only=False, short_mode=False):
-        """ Printable/colorized string representation of this resolved path.
+
+class Privileges(object):
+    """ Setuid/setgid bits and file capabilities for a file,
+        see: PrivilegeAudit
+    """
+    __slots__ = ('capabilities', 'gid', 'group', 'mode', 'uid', 'user')
+
+    def __init__(
+            self, mode, uid, gid, capabilities=None, user=None, group=None):
         """
-        if not self.exists:
-            return ''
-        if not self.resolved:
-            return str(self.path)
+            Arguments:
+                mode (int)                     : File mode bits.
+                uid (int)                      : Owner uid.
+                gid (int)                      : Owner gid.
+                capabilities (FileCapabilities): Decoded capabilities.
+                user (str)                     : Owner name, if known.
+                group (str)                    : Group name, if known.
+        """
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.capabilities = capabilities
+        self.user = user
+        self.group = group
 
-        if dir_only:
-            return self.formatted_dir()
-        if short_mode:
-            return self.formatted_target()
+    def __repr__(self):
+        return '{}(mode={:o}, uid={}, gid={}, capabilities={!r})'.format(
+            type(self).__name__,
+            stat.S_IMODE(self.mode),
+            self.uid,
+            self.gid,
+            self.capabilities,
+        )
 
-        lines = ['{}:'.format(C(self.path, **COLOR_ARGS['cmd']))]
-        indent = 4
-        linklen = len(self.symlink_to)
-        lastlink = linklen - 1
-        for i, symlink in enumerate(self.symlink_to):
-            linkstatus = ''
-            if self.circular:
-                if symlink == self.circular:
-                    linkstatus = C('⭠', 'red', style='bright')
-                else:
-                    linkstatus = ''
-            elif self._broken(symlink):
-                linkstatus = C('(broken)', fore='red')
-            elif not self._exists(symlink):
-                linkstatus = C('(missing)', fore='red')
-            else:
-                symlink = C(
-                    symlink,
-                    **COLOR_ARGS['target' if i == lastlink else 'link']
-                )
-            indention = ' ' * indent
-            lines.append('{}⯈ {} {}'.format(indention, symlink, linkstatus))
-            indent += 4
+    def as_dict(self):
+        """ A JSON-friendly dict for these privileges. """
+        return {
+            'mode': '{:04o}'.format(stat.S_IMODE(self.mode)),
+            'setuid': self.setuid,
+            'setgid': self.setgid,
+            'uid': self.uid,
+            'user': self.user,
+            'gid': self.gid,
+            'group': self.group,
+            'capabilities': None if not self.capabilities else (
+                self.capabilities.as_dict()
+            ),
+        }
 
-        # Indent some more for labels.
-        indent += 7
-        if self.resolved:
-            typelbl = 'Type:'.rjust(indent)
-            if self.max_width > 0:
-                prepend = ' ' * (len(typelbl) + 1)
-                typeinfo = FormatBlock(self.filetype).format(
-                    width=self.max_width,
-                    prepend=prepend,
-                    strip_first=True,
-                )
-            else:
-                typeinfo = self.filetype
-            lines.append(
-                '{} {}'.format(
-                    typelbl,
-                    C(typeinfo, **COLOR_ARGS['type'])
-                )
-            )
-        return '\n'.join(lines)
+    def formatted(self):
+        """ Printable/colorized string for these privileges. """
+        parts = []
+        if self.setuid:
+            parts.append('setuid {}'.format(
+                self.user or 'uid {}'.format(self.uid)
+            ))
+        if self.setgid:
+            parts.append('setgid {}'.format(
+                self.group or 'gid {}'.format(self.gid)
+            ))
+        if self.capabilities:
+            parts.append(str(self.capabilities))
+        if not parts:
+            return colr_str('none', **COLOR_ARGS['type'])
+        return colr_str(', '.join(parts), fore='red', style='bright')
 
-    def formatted_dir(self):
-        """ Format the parent directory for self.target if it is set. """
-        if self.target:
-            pdir, _ = os.path.split(self.target)
-            if not pdir:
-                pdir = os.path.abspath(pdir)
-            return str(C(pdir, **COLOR_ARGS['target']))
-        return ''
+    @property
+    def privileged(self):
+        """ Whether running the file can gain privileges. """
+        return self.setuid or self.setgid or bool(self.capabilities)
 
-    def formatted_target(self):
-        """ Formats self.target if it is set.
-            Broken links will have 'dead:' prepended to them,
-            circular links will have 'circular' prepended to them.
+    @property
+    def setgid(self):
+        """ Whether the setgid bit is set. Without group execute, it
+            means mandatory locking instead.
         """
-        if self.target:
-            if self.broken:
-                msg = 'circular' if self.circular else 'dead'
-                targetstr = '{}:{}'.format(msg, C(self.target, fore='red'))
-            else:
-                targetstr = C(self.target, **COLOR_ARGS['target'])
-            return str(targetstr)
-        return ''
+        return bool(
+            (self.mode & stat.S_ISGID) and (self.mode & stat.S_IXGRP)
+        )
 
-    @classmethod
-    def get_env_path(cls):
-        """ Return a tuple of dirs in $PATH. """
-        return tuple(
-            path for path in
-            (s.strip() for s in os.environ.get('PATH', '').split(':'))
-            if path
+    @property
+    def setuid(self):
+        """ Whether the setuid bit is set. """
+        return bool(self.mode & stat.S_ISUID)
+
+
+class FileHasher(object):
+    """ Hashes files by (device, inode), so each distinct file is only
+        hashed once no matter how many links point to it.
+        Files are read with mmap (or large buffered reads when that isn't
+        possible). Large files are hashed in a thread pool, in parallel
+        with everything else.
+    """
+    # Files at least this big are hashed in the thread pool.
+    large_size = 4 * 1024 * 1024
+    # Read size when mmap can't be used.
+    buffer_size = 1024 * 1024
+
+    def __init__(self, algorithm='sha256', jobs=None):
+        """
+            Arguments:
+                algorithm (str) : A hashlib algorithm name.
+                jobs (int)      : Number of threads for large files.
+                                  Default: os.cpu_count()
+        """
+        algorithm = (algorithm or '').lower()
+        if algorithm not in hashlib.algorithms_available:
+            raise InvalidArg('unknown hash algorithm: {}\n{}'.format(
+                algorithm,
+                'Available: {}'.format(
+                    ', '.join(sorted(hashlib.algorithms_available))
+                ),
+            ))
+        if algorithm.startswith('shake_'):
+            raise InvalidArg(
+                'variable length algorithms are not supported: {}'.format(
+                    algorithm,
+                )
+            )
+        self.algorithm = algorithm
+        self.jobs = max(jobs or os.cpu_count() or 1, 1)
+        # {(st_dev, st_ino): Future}
+        self._digests = {}
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def __repr__(self):
+        return '{}(algorithm={!r}, jobs={}, files={})'.format(
+            type(self).__name__,
+            self.algorithm,
+            self.jobs,
+            len(self._digests),
         )
 
-    def print_all(self):
-        """ Prints str(self) if it's not an empty string. """
-        info = str(self)
-        if info:
-            print('\n{}'.format(info))
+    def hash_file(self, path):
+        """ Hash a single file, and return the hex digest.
+            Returns None if the file can't be read.
+        """
+        h = hashlib.new(self.algorithm)
+        try:
+            with open(path, 'rb') as f:
+                try:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (OSError, ValueError):
+                    # Empty files, or files that can't be mapped.
+                    mm = None
+                if mm is not None:
+                    with mm:
+                        h.update(mm)
+                else:
+                    for chunk in iter(
+                            lambda: f.read(self.buffer_size), b''):
+                        h.update(chunk)
+        except OSError as ex:
+            debug('Cannot hash file: {}\n{}'.format(path, ex))
+            return None
+        return h.hexdigest()
 
-    def print_dir(self, end='\n'):
-        """ Prints the parent directory for self.target if it is set. """
-        s = self.formatted_dir()
-        if s:
-            print(s, end=end)
+    def shutdown(self):
+        """ Wait for any hashes in progress, and stop the thread pool. """
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
 
-    def print_target(self, end='\n'):
-        """ Prints self.target if it is set.
-            Broken links will have 'dead:' prepended to them,
-            circular links will have 'circular' prepended to them.
+    def submit(self, path, stats=None):
+        """ Start hashing a file (unless the same file was already seen),
+            and return a Future for it's hex digest.
+            The digest will be None for anything that is not a regular,
+            readable file.
         """
-        s = self.formatted_target()
-        if s:
-            print(s, end=end)
+        st = os.stat(path) if stats is None else stats.stat(path)
+        if (st is None) or (not stat.S_ISREG(st.st_mode)):
+            future = Future()
+            future.set_result(None)
+            return future
+        key = (st.st_dev, st.st_ino)
+        with self._lock:
+            future = self._digests.get(key, None)
+            if future is not None:
+                return future
+            if st.st_size >= self.large_size:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self.jobs)
+                future = self._pool.submit(self.hash_file, path)
+                self._digests[key] = future
+                return future
+            # Small files are not worth a trip through the pool.
+            future = self._digests[key] = Future()
+        future.set_result(self.hash_file(path))
+        return future
 
 
 class InvalidArg(ValueError):